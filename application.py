@@ -20,11 +20,17 @@ from envisage.ui.tasks.tasks_application import TasksApplication
 from envisage.ui.tasks.tasks_plugin import TasksPlugin
 from pyface.tasks.task_window_layout import TaskWindowLayout
 
+from db.compression import Compressor
 from db.db import DBClient
+from db.export import Exporter
+from db.importer import Importer
+from db.maintenance import Maintenance
+from db.writer import MeasurementWriter
 from hardware.device import Device
 from loggable import Loggable
 from paths import paths
 from plugin import HardwarePlugin
+from scheduler import Scheduler
 from server import Server
 from util import import_klass, yload
 
@@ -43,8 +49,14 @@ def make_device(cfg):
 
 class Application(TasksApplication, Loggable):
     server = None
+    scheduler = None
 
     dbclient = None
+    dbwriter = None
+    dbmaintenance = None
+    exporter = None
+    importer = None
+    dbcompressor = None
 
     def __init__(self, *args, **kw):
         super().__init__(*args, **kw)
@@ -71,24 +83,70 @@ class Application(TasksApplication, Loggable):
         self.initialize()
         return True
 
+    def stop(self):
+        if self.scheduler:
+            self.scheduler.stop()
+            self.info(f"acquisition jobs {self.scheduler.stats()}")
+
+        for device in self.get_services(Device):
+            self.debug(
+                f"{device.name} io {device.io_stats()} cache {device.cache.stats()}"
+            )
+            device.close()
+
+        if self.dbmaintenance:
+            self.dbmaintenance.stop()
+        if self.dbwriter:
+            if self.dbcompressor:
+                for name, device_name, kw in self.dbcompressor.flush_all():
+                    self.dbwriter.add_measurement(name, device_name, **kw)
+                self.info(f"ingest compression {self.dbcompressor.stats()}")
+            self.dbwriter.close()
+        return super().stop()
+
     def initialize(self):
         init = self._get_initization()
-        self.dbclient = dbclient = DBClient()
+        dbcfg = init.get("database") or {}
+        self.dbclient = dbclient = DBClient(dbcfg)
         if bool(int(os.environ.get("BUILD_DB", "0"))):
+            dbclient.backup(block=True)
             dbclient.build()
+        else:
+            dbclient.migrate()
 
         dbclient.backup()
+        self.info(f"database storage settings {dbclient.storage_settings()}")
+
+        self.dbcompressor = Compressor(dbcfg.get("compression", {}))
+        self.dbwriter = MeasurementWriter(dbcfg.get("writer", {}), dbclient=dbclient)
+        self.dbwriter.start()
+
+        self.dbmaintenance = Maintenance(
+            dbcfg.get("maintenance", {}), dbclient=dbclient
+        )
+        self.dbmaintenance.start()
 
+        self.exporter = Exporter(dbcfg.get("export", {}), dbclient=dbclient)
+        self.importer = Importer(dbcfg.get("import", {}), dbclient=dbclient)
+
+        devices = []
         for device_cfg in init.get("devices"):
             if device_cfg.get("enabled", True):
                 device = make_device(device_cfg)
                 if device:
                     self.register_service(Device, device)
 
-                    dbclient.add_device(device.name)
-                    dbclient.add_datastream("default", device.name)
+                    devices.append(device)
                     device.on_trait_change(self._handle_device_update, "update")
 
+        dbclient.register_devices([d.name for d in devices])
+        for device in devices:
+            for channel, calibration in device.calibrations().items():
+                dbclient.add_calibration(device.name, channel, calibration)
+
+        self.scheduler = Scheduler(init.get("scheduler", {}))
+        self.scheduler.start()
+
         server = init.get("server")
 
         if server:
@@ -135,14 +193,18 @@ class Application(TasksApplication, Loggable):
 
     def _handle_device_update(self, obj, name, old, new):
         if new:
-            dbclient = self.dbclient
+            writer = self.dbwriter
             device_name = obj.name
             if "value" in new or "value_string" in new:
-                dbclient.add_measurement(
-                    new.get("datastream", "default"), device_name, **new
-                )
+                name = new.get("datastream", "default")
+                for kw in self.dbcompressor.add(name, device_name, new):
+                    writer.add_measurement(name, device_name, **kw)
             elif "datastream" in new:
-                dbclient.add_datastream(new["datastream"], device_name, unique=False)
+                name = new["datastream"]
+                # samples held back by the compressor belong to the datastream that is ending
+                for kw in self.dbcompressor.flush(name, device_name):
+                    writer.add_measurement(name, device_name, **kw)
+                writer.add_datastream(name, device_name, unique=False)
 
     # private
     def _get_initization(self):
@@ -159,6 +159,25 @@ class Automation(Loggable):
         self._recording_thread = Thread(target=func)
         self._recording_thread.start()
 
+    @is_alive
+    def export(self, streams, start=None, end=None, **kw):
+        """
+        export datastreams to compressed files. see Exporter.export
+
+        :param streams: list of "device_name.name"
+        :return: list of (name, device_name, path, nrows)
+        """
+        return self.application.exporter.export(streams, start, end, **kw)
+
+    @is_alive
+    def import_file(self, path, *args, **kw):
+        """
+        bulk import a persistence file (datalog csv or json) into the database. see Importer
+
+        :return: report dict
+        """
+        return self.application.importer.import_file(path, *args, **kw)
+
     def stop_recording(self):
         if self._recording_event:
             self._recording_event.set()
@@ -210,6 +229,8 @@ class Automation(Loggable):
             sleep=self.sleep,
             start_recording=self.start_recording,
             stop_recording=self.stop_recording,
+            export=self.export,
+            import_file=self.import_file,
             dfunc=self.dev_function,
             message=self.debug,
         )
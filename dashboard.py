@@ -14,12 +14,14 @@
 # limitations under the License.
 # ===============================================================================
 import time
+from functools import partial
 from threading import Thread, Event
 
 from chaco.data_view import DataView
 from enable.component_editor import ComponentEditor
 from enable.container import Container
 from numpy import array
+from pyface.gui import GUI
 from traits.has_traits import on_trait_change
 from traitsui.group import VSplit
 from traitsui.qt4.extra.led_editor import LEDEditor
@@ -38,7 +40,7 @@ from db.db import DBClient
 from figure import Figure
 from hardware.device import Device
 from loggable import Loggable
-from traits.api import Instance, Button, Bool, Float, List, Str
+from traits.api import Instance, Button, Bool, Enum, Float, List, Str
 from traitsui.api import View, UItem, VGroup, HGroup, spring, Item, EnumEditor, HSplit
 
 from paths import paths
@@ -195,7 +197,7 @@ class BaseScan(DeviceCard):
     active = Bool(False)
     period = Float(1)
 
-    _scan_evt = None
+    _subscriptions = List
 
     def __init__(self, application, cfg, *args, **kw):
         super().__init__(application, cfg, *args, **kw)
@@ -203,34 +205,33 @@ class BaseScan(DeviceCard):
 
     def _scan(self):
         if self.active:
-            self._scan_evt.set()
+            self._stop_scan()
             return
-        else:
-            self._scan_evt = Event()
-            self.active = True
-
-        sp = self.period
-
-        def _scan():
-            st = time.time()
-
-            for d in self.devices:
-                d.update = {"clear": True, "datastream": "scan"}
 
-            while not self._scan_evt.is_set():
-                for i, (df, args, kw) in enumerate(self.device_functions):
-                    kw["datastream"] = "scan"
-                    self._scan_hook(i, df, st, args, kw)
-                # time.sleep(sp)
-                self._scan_evt.wait(sp)
-
-            self.active = False
+        self.active = True
+        st = time.time()
+        for d in self.devices:
+            d.update = {"clear": True, "datastream": "scan"}
+
+        scheduler = self.application.scheduler
+        self._subscriptions = [
+            scheduler.subscribe(
+                df,
+                self.period,
+                partial(self._scan_hook, i, st),
+                args=args,
+                kw=dict(kw, datastream="scan"),
+            )
+            for i, (df, args, kw) in enumerate(self.device_functions)
+        ]
 
-        t = Thread(target=_scan)
-        self._scan_thread = t
-        self._scan_thread.start()
+    def _stop_scan(self):
+        for s in self._subscriptions:
+            s.cancel()
+        self._subscriptions = []
+        self.active = False
 
-    def _scan_hook(self, i, df, st, args, kw):
+    def _scan_hook(self, i, st, value):
         pass
 
 
@@ -242,15 +243,15 @@ class Scan(BaseScan):
 
     def _stop_button_fired(self):
         self.start_enabled = True
-        self._scan_evt.set()
+        self._stop_scan()
 
     def _start_button_fired(self):
         self.start_enabled = False
         self.figure.clear_data("s0")
         self._scan()
 
-    def _scan_hook(self, i, df, st, args, kw):
-        self.figure.add_datum(f"s{i}", time.time() - st, df(*args, **kw))
+    def _scan_hook(self, i, st, value):
+        self.figure.add_datum(f"s{i}", time.time() - st, value)
 
     def _figure_default(self):
         f = Figure()
@@ -285,8 +286,8 @@ class LEDReadOut(BaseScan):
         super().__init__(*args, **kw)
         self._scan()
 
-    def _scan_hook(self, i, df, st, args, kw):
-        self.value = df(*args, **kw)
+    def _scan_hook(self, i, st, value):
+        self.value = value
 
     def make_view(self):
         return (Item("value", label=self.name, editor=LEDEditor()),)
@@ -444,6 +445,16 @@ class HistoryDashboard(BaseDashboard):
     datastream_name = Str
     datastream_names = List
 
+    # other datastreams, "device_name.name", drawn aligned to the selected one
+    overlays = List
+    align_method = Enum("linear", "asof", "mean")
+    # hours of history to load, up to now. 0 loads everything
+    window = Float(0)
+    add_overlay_button = Button("Add Overlay")
+    clear_overlays_button = Button("Clear Overlays")
+
+    _load_evt = None
+
     def __init__(self, application, *args, **kw):
         super().__init__(*args, **kw)
         self.application = application
@@ -456,34 +467,150 @@ class HistoryDashboard(BaseDashboard):
 
     def _device_name_changed(self, new):
         if new:
-            dbclient = DBClient()
-            with dbclient.session() as sess:
-                ds = dbclient.get_datastream_names(new, sess=sess)
+            self._load(self._load_datastream_names, new)
+
+    def _datastream_name_changed(self):
+        self._reload()
+
+    def _align_method_changed(self):
+        if self.overlays:
+            self._reload()
+
+    def _window_changed(self):
+        self._reload()
+
+    def _add_overlay_button_fired(self):
+        key = f"{self.device_name}.{self.datastream_name}"
+        if self.datastream_name and key not in self.overlays:
+            self.figure.new_series(key)
+            self.overlays.append(key)
+            self._reload()
+
+    def _clear_overlays_button_fired(self):
+        for key in self.overlays:
+            self.figure.remove_series(key)
+        self.overlays = []
+        self._reload()
+
+    def _reload(self):
+        if not self.datastream_name:
+            self._cancel_load()
+            self.figure.clear_data("default")
+            return
 
-                self.datastream_names = ds
+        start = None
+        if self.window:
+            start = time.time_ns() - int(self.window * 3600e9)
+
+        if self.overlays:
+            streams = [(self.datastream_name, self.device_name)]
+            for key in self.overlays:
+                device_name, name = key.split(".", 1)
+                streams.append((name, device_name))
+            self._load(
+                self._load_aligned,
+                streams,
+                self.align_method,
+                start,
+                self.figure.get_pixel_width(),
+            )
+        else:
+            self._load(
+                self._load_history,
+                self.datastream_name,
+                self.device_name,
+                start,
+                self.figure.get_pixel_width(),
+            )
 
-                self.datastream_name = ""
-                self.datastream_name = ds[0]
+    def _load(self, func, *args):
+        """
+        run a history query on a worker thread. any load that is still running is cancelled first
+        """
+        self._cancel_load()
+        self._load_evt = evt = Event()
+        t = Thread(target=self._run_load, args=(func, args + (evt,)), daemon=True)
+        t.start()
+
+    def _run_load(self, func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            self.warning(f"{func.__name__} failed. {e}")
+            self.debug_exception()
+
+    def _cancel_load(self):
+        if self._load_evt:
+            self._load_evt.set()
+
+    def _load_datastream_names(self, device_name, cancel):
+        dbclient = self.application.dbclient
+        with dbclient.session(readonly=True) as sess:
+            ds = dbclient.get_datastream_names(device_name, sess=sess)
+
+        if not cancel.is_set():
+            GUI.invoke_later(self._set_datastream_names, ds, cancel)
+
+    def _set_datastream_names(self, ds, cancel):
+        if cancel.is_set():
+            return
 
-    def _datastream_name_changed(self, new):
-        if new:
-            dbclient = DBClient()
-            with dbclient.session() as sess:
-                dbdev = dbclient.get_datastream(new, self.device_name, sess=sess)
-                if ms := dbdev.measurements:
-                    x, y = zip(*[(mi.timestamp.timestamp(), mi.value) for mi in ms])
-                    x = array(x)
-                    x -= x.min()
-                    self.figure.new_series("default", xdata=x, ydata=y)
-        else:
-            self.figure.clear_data("default")
+        self.datastream_names = ds
+        self.datastream_name = ""
+        if ds:
+            self.datastream_name = ds[0]
+
+    def _load_history(self, name, device_name, start, npoints, cancel):
+        dbclient = self.application.dbclient
+        for t, y in dbclient.iter_samples(
+            name, device_name, start=start, npoints=npoints, cancel=cancel
+        ):
+            if cancel.is_set():
+                return
+            GUI.invoke_later(self._set_history, t, y, cancel)
+
+    def _load_aligned(self, streams, method, start, npoints, cancel):
+        dbclient = self.application.dbclient
+        # each stream is reduced to about one point per pixel, from the rollups where possible, before aligning
+        result = dbclient.get_aligned(
+            streams,
+            start=start,
+            npoints=npoints,
+            method=method,
+            max_samples=npoints,
+            cancel=cancel,
+        )
+        if result is not None and not cancel.is_set():
+            GUI.invoke_later(self._set_aligned, *result, cancel)
+
+    def _set_aligned(self, grid, values, cancel):
+        if cancel.is_set():
+            return
+
+        x = (grid - grid[0]) * 1e-9
+        self.figure.set_data("default", x, values[0])
+        for key, y in zip(self.overlays, values[1:]):
+            self.figure.set_data(key, x, y)
+
+    def _set_history(self, t, y, cancel):
+        if cancel.is_set():
+            return
+
+        x = (t - t[0]) * 1e-9
+        self.figure.set_data("default", x, y)
 
     def traits_view(self):
         cgrp = VGroup(
             HGroup(
                 Item("device_name", editor=EnumEditor(name="device_names")),
                 Item("datastream_name", editor=EnumEditor(name="datastream_names")),
-            )
+            ),
+            HGroup(
+                UItem("add_overlay_button"),
+                UItem("clear_overlays_button"),
+                Item("align_method"),
+                Item("window", label="Hours"),
+            ),
         )
         fgrp = VGroup(UItem("figure", style="custom"))
         return View(VGroup(cgrp, fgrp))
@@ -0,0 +1,123 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+resample datastreams with different, jittery sample times onto a common time base.
+
+every function takes sorted int64 epoch nanosecond times `t`, float64 `values` and an int64 `grid` and returns a
+float64 array the length of the grid. grid points with no data are nan
+"""
+
+from numpy import (
+    arange,
+    bincount,
+    empty,
+    float64,
+    full,
+    int64,
+    interp,
+    nan,
+    searchsorted,
+)
+
+
+def time_base(start, end, npoints=None, step=None):
+    """
+    evenly spaced int64 grid from start to end, either `npoints` points or every `step` nanoseconds
+    """
+    if step is None:
+        step = max((end - start) // max(npoints - 1, 1), 1)
+    return arange(start, end + 1, step, dtype=int64)
+
+
+def asof(t, values, grid, tolerance=None):
+    """
+    the last value at or before each grid point
+
+    :param tolerance: nanoseconds. values older than this are treated as missing
+    """
+    out = full(len(grid), nan)
+    if not len(t):
+        return out
+
+    idx = searchsorted(t, grid, side="right") - 1
+    valid = idx >= 0
+    if tolerance is not None:
+        valid &= grid - t[idx] <= tolerance
+    out[valid] = values[idx[valid]]
+    return out
+
+
+def linear(t, values, grid, tolerance=None):
+    """
+    values linearly interpolated at each grid point. nan outside the range of `t`
+
+    :param tolerance: nanoseconds. grid points in a gap between samples wider than this are treated as missing
+    """
+    if not len(t):
+        return full(len(grid), nan)
+
+    # interpolate relative to the first sample. epoch nanoseconds lose precision as float64
+    t0 = t[0]
+    out = interp(grid - t0, t - t0, values, left=nan, right=nan)
+    if tolerance is not None:
+        idx = searchsorted(t, grid, side="right")
+        inside = (idx > 0) & (idx < len(t))
+        gap = empty(len(grid), dtype=int64)
+        gap[inside] = t[idx[inside]] - t[idx[inside] - 1]
+        out[inside & (gap > tolerance)] = nan
+    return out
+
+
+def mean(t, values, grid, tolerance=None):
+    """
+    mean of the values in [grid[i], grid[i + 1]) for each grid point. the last bucket is as wide as the one before
+    """
+    n = len(grid)
+    if not len(t) or not n:
+        return full(n, nan)
+
+    b = searchsorted(grid, t, side="right") - 1
+    step = grid[-1] - grid[-2] if n > 1 else 1
+    keep = (b >= 0) & (t < grid[-1] + step)
+    b = b[keep]
+
+    total = bincount(b, weights=values[keep], minlength=n)
+    count = bincount(b, minlength=n)
+    out = full(n, nan)
+    has = count > 0
+    out[has] = total[has] / count[has]
+    return out
+
+
+METHODS = {"asof": asof, "linear": linear, "mean": mean}
+
+
+def align(series, grid, method="linear", tolerance=None):
+    """
+    resample several series onto a common time base
+
+    :param series: list of (t, values)
+    :param method: "asof", "linear" or "mean"
+    :return: float64 array of shape (len(series), len(grid))
+    """
+    func = METHODS[method]
+    out = empty((len(series), len(grid)), dtype=float64)
+    for i, (t, values) in enumerate(series):
+        out[i] = func(t, values, grid, tolerance)
+    return out
+
+
+# ============= EOF =============================================
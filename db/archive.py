@@ -0,0 +1,328 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+from pathlib import Path
+
+from numpy import (
+    array,
+    argsort,
+    load,
+    save,
+    searchsorted,
+    int64,
+    float64,
+    concatenate,
+    empty,
+    ones,
+)
+from traits.api import Bool, Int, Str
+
+from loggable import Loggable
+
+CHUNK_DTYPE = [("t_ns", int64), ("value", float64)]
+INDEX_DTYPE = [
+    ("chunk", int64),
+    ("t_min", int64),
+    ("t_max", int64),
+    ("v_min", float64),
+    ("v_max", float64),
+    ("count", int64),
+]
+
+
+class Archive(Loggable):
+    """
+    Columnar archive tier for sealed samples.
+
+    Each datastream has a directory of chunk files and an index. A chunk is a `.npy` structured array of
+    (t_ns, value) sorted by time, at most `chunk_size` rows. The index, `index.npy`, holds the time range,
+    value range and row count of every chunk so range queries only open the chunks they need and coarse views
+    can be drawn from the index alone.
+
+    Chunks are written uncompressed so reads can memory-map them and return views without copying. At 16 bytes
+    per sample they are still several times smaller than the same rows in SQLite.
+
+    Everything up to `sealed_until` of a datastream lives in the archive; newer samples stay in SQLite. Samples
+    that arrive later but are older than `sealed_until`, e.g. replayed from the spool or imported, are merged
+    into the chunks covering their time by `merge`.
+
+    init.yml
+
+    database:
+      archive:
+        enabled: true
+        chunk_size: 65536
+    """
+
+    root = Str
+    enabled = Bool(False)
+    chunk_size = Int(65536)
+
+    def __init__(self, cfg=None, *args, **kw):
+        super().__init__(cfg, *args, **kw)
+        cfg = self.configobj
+        self.enabled = cfg.get("enabled", self.enabled)
+        self.chunk_size = cfg.get("chunk_size", self.chunk_size)
+
+    def get_index(self, did):
+        p = self._index_path(did)
+        if p.is_file():
+            return load(p)
+        return empty(0, dtype=INDEX_DTYPE)
+
+    def sealed_until(self, did):
+        """
+        :return: t_ns of the newest archived sample of datastream `did` or None
+        """
+        index = self.get_index(did)
+        if len(index):
+            return int(index["t_max"].max())
+
+    def append(self, did, t, v):
+        """
+        archive samples of datastream `did`. `t` must be sorted and newer than `sealed_until(did)`
+
+        :return: number of chunks written
+        """
+        if not len(t):
+            return 0
+
+        index = self.get_index(did)
+        n = int(index["chunk"].max()) + 1 if len(index) else 0
+        root = self._datastream_root(did)
+        root.mkdir(parents=True, exist_ok=True)
+
+        rows = []
+        for i in range(0, len(t), self.chunk_size):
+            chunk = empty(len(t[i : i + self.chunk_size]), dtype=CHUNK_DTYPE)
+            chunk["t_ns"] = t[i : i + self.chunk_size]
+            chunk["value"] = v[i : i + self.chunk_size]
+            self._write(self._chunk_path(did, n), chunk)
+            rows.append(
+                (
+                    n,
+                    chunk["t_ns"][0],
+                    chunk["t_ns"][-1],
+                    chunk["value"].min(),
+                    chunk["value"].max(),
+                    len(chunk),
+                )
+            )
+            n += 1
+
+        # the index is written last so a chunk is only visible once it is complete
+        index = concatenate((index, array(rows, dtype=INDEX_DTYPE)))
+        self._write(self._index_path(did), index)
+        return len(rows)
+
+    def merge(self, did, t, v):
+        """
+        merge samples older than `sealed_until(did)` into the archived chunks. each sample goes to the last chunk
+        starting at or before it, or the first chunk, and the chunk is rewritten in time order. samples equal in
+        time and value to an archived sample are already archived and are skipped, so merging is idempotent
+
+        :return: number of samples added
+        """
+        index = self.get_index(did)
+        if not len(t) or not len(index):
+            return 0
+
+        order = argsort(t, kind="stable")
+        t, v = t[order], v[order]
+        # chunks are numbered in time order
+        pos = searchsorted(index["t_min"], t, side="right") - 1
+        pos[pos < 0] = 0
+
+        added = 0
+        for i in sorted(set(pos.tolist())):
+            m = pos == i
+            row = index[i]
+            path = self._chunk_path(did, row["chunk"])
+            chunk = load(path)
+            ct, cv = merge_samples(chunk["t_ns"], chunk["value"], t[m], v[m])
+            if len(ct) == len(chunk):
+                continue
+
+            merged = empty(len(ct), dtype=CHUNK_DTYPE)
+            merged["t_ns"] = ct
+            merged["value"] = cv
+            self._write(path, merged)
+            added += len(ct) - len(chunk)
+            index[i] = (
+                row["chunk"],
+                ct[0],
+                ct[-1],
+                cv.min(),
+                cv.max(),
+                len(ct),
+            )
+
+        if added:
+            self._write(self._index_path(did), index)
+        return added
+
+    def iter_chunks(self, did, start=None, end=None):
+        """
+        yield (t_ns, value) views of the archived samples of `did` within [start, end]. chunks are memory-mapped
+        """
+        for row in self._overlapping(did, start, end):
+            chunk = load(self._chunk_path(did, row["chunk"]), mmap_mode="r")
+            t = chunk["t_ns"]
+            lo = 0 if start is None else searchsorted(t, start, side="left")
+            hi = len(t) if end is None else searchsorted(t, end, side="right")
+            if hi > lo:
+                yield t[lo:hi], chunk["value"][lo:hi]
+
+    def extent(self, did, start=None, end=None):
+        """
+        :return: (count, t_min, t_max) of the archived samples of `did` within [start, end]
+        """
+        n, tmin, tmax = 0, None, None
+        for row in self._overlapping(did, start, end):
+            if (start is None or row["t_min"] >= start) and (
+                end is None or row["t_max"] <= end
+            ):
+                n += int(row["count"])
+                lo, hi = int(row["t_min"]), int(row["t_max"])
+            else:
+                t = load(self._chunk_path(did, row["chunk"]), mmap_mode="r")["t_ns"]
+                a = 0 if start is None else searchsorted(t, start, side="left")
+                b = len(t) if end is None else searchsorted(t, end, side="right")
+                if b <= a:
+                    continue
+                n += int(b - a)
+                lo, hi = int(t[a]), int(t[b - 1])
+
+            tmin = lo if tmin is None else min(tmin, lo)
+            tmax = hi if tmax is None else max(tmax, hi)
+        return n, tmin, tmax
+
+    def overview(self, did, start=None, end=None):
+        """
+        coarse (t_ns, value) min/max points from the chunk index without reading any chunk
+        """
+        rows = self._overlapping(did, start, end)
+        t = array([rows["t_min"], rows["t_max"]]).T.ravel()
+        v = array([rows["v_min"], rows["v_max"]]).T.ravel()
+        return t, v
+
+    def prune(self, did, before):
+        """
+        delete the archived samples of `did` older than `before`. chunks entirely before the cutoff are deleted,
+        a chunk spanning it is rewritten
+
+        :return: number of samples deleted
+        """
+        index = self.get_index(did)
+        if not len(index) or index["t_min"].min() >= before:
+            return 0
+
+        n = 0
+        keep = []
+        drop = []
+        for row in index:
+            path = self._chunk_path(did, row["chunk"])
+            if row["t_max"] < before:
+                n += int(row["count"])
+                drop.append(path)
+                continue
+
+            row = tuple(row)
+            if row[1] < before:
+                chunk = load(path)
+                chunk = chunk[searchsorted(chunk["t_ns"], before, side="left") :]
+                n += row[5] - len(chunk)
+                self._write(path, chunk)
+                row = (
+                    row[0],
+                    chunk["t_ns"][0],
+                    chunk["t_ns"][-1],
+                    chunk["value"].min(),
+                    chunk["value"].max(),
+                    len(chunk),
+                )
+            keep.append(row)
+
+        # chunks are deleted once the index no longer refers to them
+        self._write(self._index_path(did), array(keep, dtype=INDEX_DTYPE))
+        for path in drop:
+            path.unlink(missing_ok=True)
+        return int(n)
+
+    def remove(self, did):
+        """
+        delete every archived chunk of datastream `did`
+
+        :return: number of samples deleted
+        """
+        n = int(self.get_index(did)["count"].sum())
+        root = self._datastream_root(did)
+        if root.is_dir():
+            for p in root.iterdir():
+                p.unlink()
+            root.rmdir()
+        return n
+
+    # private
+    def _overlapping(self, did, start, end):
+        index = self.get_index(did)
+        mask = index["count"] > 0
+        if start is not None:
+            mask &= index["t_max"] >= start
+        if end is not None:
+            mask &= index["t_min"] <= end
+        return index[mask]
+
+    def _write(self, path, a):
+        tmp = path.with_name(f"{path.name}.tmp")
+        with open(tmp, "wb") as wfile:
+            save(wfile, a)
+        os.replace(tmp, path)
+
+    def _datastream_root(self, did):
+        return Path(self.root, str(did))
+
+    def _chunk_path(self, did, n):
+        return Path(self._datastream_root(did), f"chunk_{int(n):06d}.npy")
+
+    def _index_path(self, did):
+        return Path(self._datastream_root(did), "index.npy")
+
+
+def merge_samples(t, v, lt, lv):
+    """
+    merge sorted samples (lt, lv) into sorted (t, v). samples of (lt, lv) equal in time and value to one of
+    (t, v) are dropped
+
+    :return: (t, v) sorted by time
+    """
+    lo = searchsorted(t, lt, side="left")
+    hi = searchsorted(t, lt, side="right")
+    keep = ones(len(lt), dtype=bool)
+    for k in (hi > lo).nonzero()[0]:
+        keep[k] = not (v[lo[k] : hi[k]] == lv[k]).any()
+    lt, lv = lt[keep], lv[keep]
+
+    if not len(lt):
+        return t, v
+
+    t = concatenate((t, lt))
+    v = concatenate((v, lv))
+    order = argsort(t, kind="stable")
+    return t[order], v[order]
+
+
+# ============= EOF =============================================
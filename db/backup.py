@@ -0,0 +1,240 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import shutil
+import sqlite3
+import time
+from pathlib import Path
+from threading import Thread
+
+from traits.api import Int, Float, Bool
+
+from loggable import Loggable
+from paths import paths
+
+BACKUP_SUFFIX = ".backup.db"
+ARCHIVE_SUFFIX = ".archive"
+PARTIAL_SUFFIX = ".partial"
+
+
+class BackupAborted(Exception):
+    pass
+
+
+class BackupManager(Loggable):
+    """
+    Online backups of the recorder database using the SQLite backup API.
+
+    The copy is made on a background thread in steps of `pages` pages, sleeping `sleep` seconds between steps so
+    acquisition is never stalled. SQLite restarts a stepped backup whenever another connection writes to the
+    source. If that happens more than `max_restarts` times the backup is retried as a single step, which under
+    the WAL journal reads a consistent snapshot without blocking the writer.
+
+    Backups are written to a `.partial` file and renamed when complete. Only the newest `keep` backups are
+    retained.
+
+    The archive tier is backed up with the database, as a `.archive` directory next to the `.backup.db`. Archive
+    files are only ever replaced, never modified in place, so the copy hard links them where the filesystem
+    allows and costs no space. The archive is copied after the database so samples sealed in between are in
+    both copies rather than in neither.
+
+    init.yml
+
+    database:
+      backup:
+        enabled: true
+        pages: 1024
+        sleep: 0.01
+        max_restarts: 5
+        keep: 10
+    """
+
+    enabled = Bool(True)
+    pages = Int(1024)
+    sleep = Float(0.01)
+    max_restarts = Int(5)
+    keep = Int(10)
+
+    # results of the last backup
+    last_path = None
+    last_duration = Float
+    last_restarts = Int
+
+    _thread = None
+    _current = None
+
+    def __init__(self, cfg=None, *args, **kw):
+        super().__init__(cfg, *args, **kw)
+        cfg = self.configobj
+        self.enabled = cfg.get("enabled", self.enabled)
+        self.pages = cfg.get("pages", self.pages)
+        self.sleep = cfg.get("sleep", self.sleep)
+        self.max_restarts = cfg.get("max_restarts", self.max_restarts)
+        self.keep = cfg.get("keep", self.keep)
+
+    def start(self, src, block=False, archive=None):
+        """
+        backup the database at `src`
+
+        :param block: if False the backup runs on a background thread and this returns immediately
+        :param archive: root directory of the archive tier to back up with the database
+        """
+        if not self.enabled or not Path(src).is_file():
+            return
+
+        if self.is_alive():
+            self.debug("backup already running")
+            return self._thread
+
+        if block:
+            self._backup(src, archive)
+        else:
+            self._thread = Thread(target=self._backup, args=(src, archive), daemon=True)
+            self._thread.start()
+            return self._thread
+
+    def is_alive(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def join(self, timeout=None):
+        if self._thread:
+            self._thread.join(timeout)
+
+    def get_backups(self):
+        """
+        existing backups, newest first
+        """
+        root = Path(paths.root, "backups")
+        return sorted(
+            root.glob(f"*{BACKUP_SUFFIX}"), key=os.path.getmtime, reverse=True
+        )
+
+    def prune(self):
+        """
+        delete all but the newest `keep` backups and any partial backups left by an interrupted run
+        """
+        root = Path(paths.root, "backups")
+        current = self._current and backup_stem(self._current)
+        for p in root.glob(f"*{PARTIAL_SUFFIX}"):
+            # prune also runs on the backup thread, at the end of a backup. only spare what it is writing
+            if current and p.name.startswith(f"{current}."):
+                continue
+
+            self.debug(f"removing partial backup {p}")
+            if p.is_dir():
+                shutil.rmtree(p)
+            else:
+                p.unlink()
+
+        for p in self.get_backups()[self.keep :]:
+            self.debug(f"removing old backup {p}")
+            p.unlink()
+            archive = archive_path(p)
+            if archive.is_dir():
+                shutil.rmtree(archive)
+
+    # private
+    def _backup(self, src, archive=None):
+        st = time.perf_counter()
+        dest = paths.database_backups()
+        partial = dest.with_name(f"{dest.name}{PARTIAL_SUFFIX}")
+        self.info(f"starting backup {src} -> {dest}")
+        self._current = dest
+        try:
+            restarts = self._copy(src, partial, self.pages)
+            if restarts is None:
+                self.info("stepped backup kept restarting. retrying as a single step")
+                restarts = self._copy(src, partial, -1)
+
+            os.replace(partial, dest)
+            if archive and Path(archive).is_dir():
+                self._copy_archive(archive, archive_path(dest))
+        except BaseException:
+            self.debug_exception()
+            if partial.is_file():
+                partial.unlink()
+            return
+        finally:
+            self._current = None
+
+        self.last_path = dest
+        self.last_restarts = restarts
+        self.last_duration = time.perf_counter() - st
+        self.info(
+            f"backup complete {dest} {dest.stat().st_size} bytes in {self.last_duration:0.3f}s "
+            f"restarts={restarts}"
+        )
+        self.prune()
+
+    def _copy_archive(self, src, dest):
+        partial = dest.with_name(f"{dest.name}{PARTIAL_SUFFIX}")
+
+        def link(s, d):
+            try:
+                os.link(s, d)
+            except OSError:
+                shutil.copy2(s, d)
+
+        shutil.copytree(
+            src,
+            partial,
+            copy_function=link,
+            ignore=shutil.ignore_patterns("*.tmp"),
+        )
+        os.replace(partial, dest)
+
+    def _copy(self, src, dest, pages):
+        """
+        :return: number of restarts or None if the backup was aborted after `max_restarts`
+        """
+        state = {"remaining": None, "restarts": 0}
+
+        def progress(status, remaining, total):
+            prev = state["remaining"]
+            if prev is not None and remaining > prev:
+                state["restarts"] += 1
+                if state["restarts"] > self.max_restarts:
+                    raise BackupAborted()
+            state["remaining"] = remaining
+
+        source = sqlite3.connect(f"file:{src}?mode=ro", uri=True)
+        target = sqlite3.connect(dest)
+        try:
+            source.backup(target, pages=pages, progress=progress, sleep=self.sleep)
+        except BackupAborted:
+            return
+        finally:
+            target.close()
+            source.close()
+
+        return state["restarts"]
+
+
+def backup_stem(backup):
+    """
+    the timestamp part of a backup's name
+    """
+    return backup.name[: -len(BACKUP_SUFFIX)]
+
+
+def archive_path(backup):
+    """
+    the archive directory of a database backup
+    """
+    return backup.with_name(f"{backup_stem(backup)}{ARCHIVE_SUFFIX}")
+
+
+# ============= EOF =============================================
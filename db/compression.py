@@ -0,0 +1,270 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import math
+import numbers
+import time
+from threading import Lock
+
+from traits.api import List
+
+from db.rollup import NS
+from loggable import Loggable
+
+
+class Deadband(object):
+    """
+    keep a sample only if it differs from the last kept sample by more than `absolute`, or by more than
+    `relative` times the last kept value. a sample is always kept once `max_interval` seconds have passed
+    """
+
+    def __init__(self, absolute=None, relative=None, max_interval=None):
+        self.absolute = absolute
+        self.relative = relative
+        self.max_interval = max_interval
+        self._last = None
+
+    def add(self, t, v):
+        """
+        :return: list of (t_ns, value) to keep
+        """
+        last = self._last
+        if last is None or self._exceeds(t, v, *last):
+            self._last = (t, v)
+            return [(t, v)]
+        return []
+
+    def flush(self):
+        return []
+
+    def _exceeds(self, t, v, lt, lv):
+        if self.max_interval and t - lt >= self.max_interval * NS:
+            return True
+        dv = abs(v - lv)
+        if self.absolute is not None and dv > self.absolute:
+            return True
+        if self.relative is not None and dv > self.relative * abs(lv):
+            return True
+        return self.absolute is None and self.relative is None and dv > 0
+
+
+class SwingingDoor(object):
+    """
+    swinging door trending.
+
+    a sample is dropped while a straight line from the last kept sample passes within `deviation` of every sample
+    since. when no such line exists the previous sample is kept and becomes the new pivot. a sample is always kept
+    once `max_interval` seconds have passed since the last one, after the held sample
+    """
+
+    def __init__(self, deviation, max_interval=None):
+        self.deviation = deviation
+        self.max_interval = max_interval
+        self._pivot = None
+        self._held = None
+        self._upper = math.inf
+        self._lower = -math.inf
+
+    def add(self, t, v):
+        """
+        :return: list of (t_ns, value) to keep
+        """
+        pivot = self._pivot
+        if (
+            pivot is None
+            or t <= pivot[0]
+            or self.max_interval
+            and t - pivot[0] >= self.max_interval * NS
+        ):
+            # restart from this sample. the held sample goes first so the trend up to here is not lost
+            held = [self._held] if self._held else []
+            return held + self._keep(t, v)
+
+        upper, lower = self._slopes(pivot, t, v)
+        upper = min(self._upper, upper)
+        lower = max(self._lower, lower)
+        if lower > upper:
+            # the door is open. keep the held sample and swing from there
+            kept = [self._held]
+            self._pivot = self._held
+            self._upper, self._lower = self._slopes(self._pivot, t, v)
+            self._held = (t, v)
+            return kept
+
+        self._upper, self._lower = upper, lower
+        self._held = (t, v)
+        return []
+
+    def flush(self):
+        """
+        keep the held sample, if any. called when the datastream ends
+        """
+        held = self._held
+        if held is None:
+            return []
+        return self._keep(*held)
+
+    def _keep(self, t, v):
+        self._pivot = (t, v)
+        self._held = None
+        self._upper = math.inf
+        self._lower = -math.inf
+        return [(t, v)]
+
+    def _slopes(self, pivot, t, v):
+        pt, pv = pivot
+        dt = (t - pt) / NS
+        return (v + self.deviation - pv) / dt, (v - self.deviation - pv) / dt
+
+
+class Compressor(Loggable):
+    """
+    Ingest-time compression of device updates before they are queued for the measurement writer.
+
+    Rules are matched in order on device and datastream name, like the maintenance retention rules. Each matching
+    datastream gets its own filter state. Events and non-finite values always pass through.
+
+    init.yml
+
+    database:
+      compression:
+        rules:
+          # absolute deadband with a 60 s heartbeat
+          - device: adc
+            deadband: 0.01
+            max_interval: 60
+          # relative deadband
+          - device: mks
+            relative: 0.001
+          # swinging door, 0.05 units either side
+          - datastream: scan
+            swinging_door: 0.05
+            max_interval: 60
+    """
+
+    rules = List
+
+    def __init__(self, cfg=None, *args, **kw):
+        super().__init__(cfg, *args, **kw)
+        self.rules = self.configobj.get("rules", self.rules)
+        self._lock = Lock()
+        self._filters = {}
+        self._counts = {}
+
+    def add(self, name, device_name, kw):
+        """
+        :param kw: measurement keywords as passed to `MeasurementWriter.add_measurement`
+        :return: list of measurement keywords to write
+        """
+        v = kw.get("value")
+        if (
+            "value_string" in kw
+            or not isinstance(v, numbers.Real)
+            or not math.isfinite(v)
+        ):
+            return [kw]
+
+        # filters are not thread safe. updates of one datastream may come from several threads
+        with self._lock:
+            f = self._get_filter(name, device_name)
+            if f is None:
+                return [kw]
+
+            if "t_ns" not in kw:
+                kw["t_ns"] = time.time_ns()
+
+            kept = f.add(kw["t_ns"], v)
+            self._count(name, device_name, 1, len(kept))
+        return [self._measurement(kw, t, v) for t, v in kept]
+
+    def flush(self, name, device_name):
+        """
+        end a datastream. returns the held samples that still need to be written and resets the filter
+        """
+        key = (device_name, name)
+        with self._lock:
+            f = self._filters.pop(key, None)
+            if not f:
+                return []
+
+            kept = f.flush()
+            self._count(name, device_name, 0, len(kept))
+        return [{"datastream": name, "value": v, "t_ns": t} for t, v in kept]
+
+    def flush_all(self):
+        """
+        end every datastream
+
+        :return: list of (name, device_name, kw) still to be written
+        """
+        with self._lock:
+            keys = list(self._filters)
+        return [
+            (name, device_name, kw)
+            for device_name, name in keys
+            for kw in self.flush(name, device_name)
+        ]
+
+    def stats(self):
+        """
+        :return: {"device_name.name": {"in": n, "out": n, "ratio": in / out}}
+        """
+        with self._lock:
+            counts = dict(self._counts)
+
+        return {
+            f"{device_name}.{name}": {
+                "in": nin,
+                "out": nout,
+                "ratio": nin / nout if nout else 0,
+            }
+            for (device_name, name), (nin, nout) in counts.items()
+        }
+
+    # private
+    # call with the lock held
+    def _get_filter(self, name, device_name):
+        key = (device_name, name)
+        if key not in self._filters:
+            self._filters[key] = self._make_filter(name, device_name)
+        return self._filters[key]
+
+    def _make_filter(self, name, device_name):
+        for rule in self.rules:
+            if rule.get("device", device_name) != device_name:
+                continue
+            if rule.get("datastream", name) != name:
+                continue
+
+            max_interval = rule.get("max_interval")
+            if "swinging_door" in rule:
+                return SwingingDoor(rule["swinging_door"], max_interval)
+            return Deadband(rule.get("deadband"), rule.get("relative"), max_interval)
+
+    def _count(self, name, device_name, nin, nout):
+        key = (device_name, name)
+        a, b = self._counts.get(key, (0, 0))
+        self._counts[key] = (a + nin, b + nout)
+
+    def _measurement(self, kw, t, v):
+        if t == kw["t_ns"]:
+            return kw
+        m = dict(kw)
+        m["t_ns"] = t
+        m["value"] = v
+        return m
+
+
+# ============= EOF =============================================
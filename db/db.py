@@ -13,28 +13,67 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ===============================================================================
+import json
 import os
-import shutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
 
 from sqlalchemy import (
     Column,
     Integer,
     String,
-    create_engine,
     ForeignKey,
     Float,
+    BigInteger,
     DateTime,
+    Text,
     func,
+    insert,
+    Index,
+    case,
 )
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.engine.default import DefaultDialect
 from sqlalchemy.orm import declarative_base, declared_attr, sessionmaker, relationship
 from sqlalchemy.sql.sqltypes import NullType, String as SQLString
 
+from numpy import (
+    array,
+    int64,
+    float64,
+    column_stack,
+    concatenate,
+    full,
+    nan,
+    isfinite,
+    searchsorted,
+)
+from traits.api import Instance
+
+from db import rollup
+from db.align import align, time_base
+from db.downsample import MinMaxBuckets, lttb, concatenate_chunks, minmax
+from db.archive import Archive, merge_samples
+from db.backup import BackupManager
+from db.migrations import migrate, set_version, pending_migrations
+from db.storage import StorageProfile
+from hardware.calibration import make_calibration, remap
 from loggable import Loggable
 from paths import paths
 
 Base = declarative_base()
 
+SAMPLE_DTYPE = [("t_ns", int64), ("value", float64)]
+COARSE_DTYPE = [
+    ("bucket", int64),
+    ("tmin", int64),
+    ("vmin", float64),
+    ("tmax", int64),
+    ("vmax", float64),
+]
+
 
 def stringcolumn(size=40, *args, **kw):
     return Column(String(size), *args, **kw)
@@ -110,16 +149,116 @@ class DeviceTbl(Base, NameMixin):
 class DatastreamTbl(Base, NameMixin):
     device_id = foreignkey("DeviceTbl")
     create_date = Column(DateTime, default=func.now())
-    measurements = relationship("MeasurementTbl")
+    samples = relationship("SampleTbl", order_by="SampleTbl.t_ns")
+    events = relationship("EventTbl", order_by="EventTbl.t_ns")
 
+    __table_args__ = (Index("ix_datastream_device_name_id", "device_id", "name", "id"),)
+
+
+class SampleTbl(Base, IDMixin):
+    """
+    numeric samples. t_ns is the acquisition time in integer epoch nanoseconds
+    """
 
-class MeasurementTbl(Base, IDMixin):
     datastream_id = foreignkey("DatastreamTbl")
+    t_ns = Column(BigInteger, nullable=False)
     value = Column(Float)
-    timestamp = Column(DateTime, default=func.now())
-    relative_time_seconds = Column(Float)
+
+    __table_args__ = (Index("ix_sample_datastream_t_ns", "datastream_id", "t_ns"),)
+
+
+class EventTbl(Base, IDMixin):
+    """
+    string and event values. t_ns is the acquisition time in integer epoch nanoseconds
+    """
+
+    datastream_id = foreignkey("DatastreamTbl")
+    t_ns = Column(BigInteger, nullable=False)
     value_string = stringcolumn(140)
 
+    __table_args__ = (Index("ix_event_datastream_t_ns", "datastream_id", "t_ns"),)
+
+
+class RollupTbl(Base, BaseMixin):
+    """
+    per datastream aggregates of SampleTbl. t_ns is the start of the bucket and resolution the bucket width in
+    seconds. rows are maintained incrementally as samples are added. mean is total / count
+    """
+
+    datastream_id = Column(Integer, ForeignKey("DatastreamTbl.id"), primary_key=True)
+    resolution = Column(Integer, primary_key=True)
+    t_ns = Column(BigInteger, primary_key=True)
+    count = Column(Integer)
+    min_value = Column(Float)
+    max_value = Column(Float)
+    total = Column(Float)
+    first_t_ns = Column(BigInteger)
+    first_value = Column(Float)
+    last_t_ns = Column(BigInteger)
+    last_value = Column(Float)
+
+
+class CalibrationTbl(Base, IDMixin):
+    """
+    calibration versions of a device channel. a version is in effect from t_ns, epoch nanoseconds, until the next
+    version. definition is the JSON of Calibration.to_dict
+    """
+
+    device_id = foreignkey("DeviceTbl")
+    channel = stringcolumn(80)
+    version = Column(Integer, nullable=False)
+    t_ns = Column(BigInteger, nullable=False)
+    definition = Column(Text, nullable=False)
+
+    __table_args__ = (
+        Index("ix_calibration_device_channel_t_ns", "device_id", "channel", "t_ns"),
+    )
+
+
+def rollup_upsert():
+    """
+    insert rollup rows or merge them into existing buckets
+    """
+    stmt = sqlite_insert(RollupTbl)
+    ex = stmt.excluded
+    c = RollupTbl.__table__.c
+    return stmt.on_conflict_do_update(
+        index_elements=[c.datastream_id, c.resolution, c.t_ns],
+        set_={
+            "count": c.count + ex.count,
+            "min_value": func.min(c.min_value, ex.min_value),
+            "max_value": func.max(c.max_value, ex.max_value),
+            "total": c.total + ex.total,
+            "first_t_ns": func.min(c.first_t_ns, ex.first_t_ns),
+            "first_value": case(
+                (ex.first_t_ns < c.first_t_ns, ex.first_value), else_=c.first_value
+            ),
+            "last_t_ns": func.max(c.last_t_ns, ex.last_t_ns),
+            "last_value": case(
+                (ex.last_t_ns >= c.last_t_ns, ex.last_value), else_=c.last_value
+            ),
+        },
+    )
+
+
+def split_measurement(kw):
+    """
+    classify a measurement as a numeric sample or a string/event value
+
+    :return: (table, value) where table is SampleTbl or EventTbl
+    """
+    vs = kw.get("value_string")
+    if vs is None:
+        v = kw.get("value")
+        if v is None:
+            return None, None
+        try:
+            return SampleTbl, float(v)
+        except (TypeError, ValueError):
+            vs = v
+
+    return EventTbl, str(vs)
+
 
 class SessionCTX(object):
     def __init__(self, sess):
@@ -137,23 +276,108 @@ class SessionCTX(object):
     def query(self, *args, **kw):
         return self._sess.query(*args, **kw)
 
+    def get(self, *args, **kw):
+        return self._sess.get(*args, **kw)
+
     def add(self, *args, **kw):
         return self._sess.add(*args, **kw)
 
     def flush(self, *args, **kw):
         return self._sess.flush(*args, **kw)
 
+    def execute(self, *args, **kw):
+        return self._sess.execute(*args, **kw)
+
+    def connection(self, *args, **kw):
+        return self._sess.connection(*args, **kw)
+
     def commit(self, *args, **kw):
         return self._sess.commit(*args, **kw)
 
 
+class Catalog(object):
+    """
+    in-memory name -> id map for devices and the active datastream of each device.
+    the active datastream for a (device, name) pair is the most recently created one
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._devices = {}
+        self._datastreams = {}
+
+    def get_device_id(self, device_name):
+        return self._devices.get(device_name)
+
+    def set_device_id(self, device_name, did):
+        with self._lock:
+            self._devices[device_name] = did
+
+    def get_datastream_id(self, name, device_name):
+        return self._datastreams.get((device_name, name))
+
+    def get_datastream_ids(self):
+        return list(self._datastreams.values())
+
+    def set_datastream_id(self, name, device_name, did):
+        with self._lock:
+            self._datastreams[(device_name, name)] = did
+
+    def invalidate(self, device_name=None):
+        with self._lock:
+            if device_name is None:
+                self._devices = {}
+                self._datastreams = {}
+            else:
+                self._devices.pop(device_name, None)
+                self._datastreams = {
+                    k: v for k, v in self._datastreams.items() if k[0] != device_name
+                }
+
+
 class DBClient(Loggable):
+    path = None
+    catalog = Instance(Catalog, ())
+    profile = Instance(StorageProfile)
+    backups = Instance(BackupManager)
+    archive = Instance(Archive)
+    _engine = None
+    _reader_engine = None
     _session_factory = None
+    _reader_session_factory = None
 
     def build(self):
         engine = self._get_engine()
         Base.metadata.drop_all(bind=engine)
-        Base.metadata.create_all(bind=engine)
+        with engine.begin() as connection:
+            set_version(connection, 0)
+        self.catalog.invalidate()
+        return self.migrate()
+
+    def migrate(self):
+        """
+        create or upgrade the database schema to the latest version. an existing database is backed up before any
+        migration is applied
+        """
+        if pending_migrations(self._get_engine()):
+            self.backup(block=True)
+
+        report = migrate(self._get_engine(), Base.metadata)
+        applied = ", ".join(f"{v}:{d} ({et:0.3f}s)" for v, d, et in report["applied"])
+        self.info(
+            f"database schema version {report['from_version']} -> {report['to_version']}. "
+            f"created={report['created']} applied=[{applied}] elapsed={report['elapsed']:0.3f}s"
+        )
+        return report
+
+    def storage_settings(self):
+        """
+        return the storage settings in effect on the writer connection
+        """
+        if not self.profile.in_effect:
+            with self._get_engine().connect():
+                pass
+        return self.profile.in_effect
 
     def get_device(self, name, sess=None):
         with self.session(sess) as sess:
@@ -161,6 +385,15 @@ class DBClient(Loggable):
             q = q.filter(DeviceTbl.name == name)
             return self._fetch_first(q)
 
+    def get_device_id(self, name, sess=None):
+        did = self.catalog.get_device_id(name)
+        if did is None:
+            dev = self.get_device(name, sess=sess)
+            if dev:
+                did = dev.id
+                self.catalog.set_device_id(name, did)
+        return did
+
     def get_datastream_names(self, device_name, sess=None):
         with self.session(sess) as sess:
             q = sess.query(DatastreamTbl)
@@ -172,44 +405,483 @@ class DBClient(Loggable):
 
     def get_datastream(self, name, device_name, sess=None):
         with self.session(sess) as sess:
+            did = self.catalog.get_datastream_id(name, device_name)
+            if did is not None:
+                return sess.get(DatastreamTbl, did)
+
             q = sess.query(DatastreamTbl)
             q = q.join(DeviceTbl)
             q = q.filter(DeviceTbl.name == device_name)
             q = q.filter(DatastreamTbl.name == name)
             q = q.order_by(DatastreamTbl.id.desc())
-            return self._fetch_first(q)
+            d = self._fetch_first(q)
+            if d:
+                self.catalog.set_datastream_id(name, device_name, d.id)
+            return d
 
-    def add_device(self, name):
-        with self.session() as sess:
-            self._add_unique(sess, DeviceTbl, name)
+    def get_datastream_id(self, name, device_name, sess=None):
+        did = self.catalog.get_datastream_id(name, device_name)
+        if did is None:
+            d = self.get_datastream(name, device_name, sess=sess)
+            if d:
+                did = d.id
+        return did
 
-    def add_datastream(self, name, device_name, unique=True):
-        with self.session() as sess:
-            d = None
+    def add_device(self, name, sess=None, commit=True):
+        with self.session(sess) as sess:
+            did = self.get_device_id(name, sess=sess)
+            if did is None:
+                dev = DeviceTbl(name=name)
+                self._add(sess, dev, commit=commit)
+                did = dev.id
+                self.catalog.set_device_id(name, did)
+            return did
+
+    def add_datastream(self, name, device_name, unique=True, sess=None, commit=True):
+        """
+        add a datastream to a device. if `unique` is False a new datastream is always created and becomes the
+        active datastream for (name, device_name)
+
+        :return: id of the active datastream
+        """
+        with self.session(sess) as sess:
             if unique:
-                d = self.get_datastream(name, device_name, sess=sess)
+                did = self.get_datastream_id(name, device_name, sess=sess)
+                if did is not None:
+                    return did
+
+            dev_id = self.get_device_id(device_name, sess=sess)
+            if dev_id is None:
+                self.warning(
+                    f"cannot add datastream {name}. invalid device={device_name}"
+                )
+                return
 
-            if not d:
-                dev = self.get_device(device_name, sess=sess)
-                self._add(sess, DatastreamTbl(name=name, device_id=dev.id))
+            d = DatastreamTbl(name=name, device_id=dev_id)
+            self._add(sess, d, commit=commit)
+            self.catalog.set_datastream_id(name, device_name, d.id)
+            return d.id
 
-    def add_measurement(self, name, device_name, **kw):
+    def register_devices(self, device_names, datastream="default"):
+        """
+        add each device and its default datastream in a single transaction, priming the catalog
+        """
         with self.session() as sess:
-            d = self.get_datastream(name, device_name, sess=sess)
-            if d:
-                kw = {
-                    k: v
-                    for k, v in kw.items()
-                    if k in ("name", "value", "value_string", "relative_time_seconds")
-                }
-                self._add(sess, MeasurementTbl(datastream_id=d.id, **kw))
+            for name in device_names:
+                self.add_device(name, sess=sess, commit=False)
+                self.add_datastream(datastream, name, sess=sess, commit=False)
+            sess.commit()
+
+    def add_measurement(self, name, device_name, sess=None, **kw):
+        return self.add_measurements([(name, device_name, kw)], sess=sess)
+
+    def add_measurements(self, measurements, sess=None):
+        """
+        insert many measurements in a single transaction. numeric values go to SampleTbl, strings to EventTbl.
+        measurements without a `t_ns` are stamped with the current time
+
+        :param measurements: list of (datastream name, device name, measurement kw) tuples
+        :return: number of rows inserted
+        """
+        with self.session(sess) as sess:
+            samples = []
+            events = []
+            for name, device_name, kw in measurements:
+                table, v = split_measurement(kw)
+                if table is None:
+                    continue
+
+                did = self.get_datastream_id(name, device_name, sess=sess)
+                if did is None:
+                    continue
+
+                t_ns = kw.get("t_ns") or time.time_ns()
+                if table is SampleTbl:
+                    samples.append({"datastream_id": did, "t_ns": t_ns, "value": v})
+                else:
+                    events.append(
+                        {"datastream_id": did, "t_ns": t_ns, "value_string": v[:140]}
+                    )
+
+            if samples:
+                sess.execute(insert(SampleTbl), samples)
+                sess.execute(rollup_upsert(), rollup.aggregate(samples))
+            if events:
+                sess.execute(insert(EventTbl), events)
+            if samples or events:
+                sess.commit()
+            return len(samples) + len(events)
+
+    def add_sample_arrays(self, did, t, v, sess=None, commit=True):
+        """
+        bulk insert samples of one datastream from numpy arrays and merge them into the rollups. uses a DBAPI
+        executemany so no ORM or Core objects are built per row. used by the importer
+
+        :param did: datastream id
+        :param t: int64 t_ns array
+        :param v: float64 value array
+        :return: number of rows inserted
+        """
+        if not len(t):
+            return 0
+
+        with self.session(sess) as sess:
+            cursor = self._cursor(sess)
+            try:
+                cursor.executemany(
+                    "INSERT INTO SampleTbl (datastream_id, t_ns, value) VALUES (?, ?, ?)",
+                    zip([did] * len(t), t.tolist(), v.tolist()),
+                )
+            finally:
+                cursor.close()
+
+            sess.execute(rollup_upsert(), rollup.aggregate_arrays(did, t, v))
+            if commit:
+                sess.commit()
+            return len(t)
+
+    def get_samples(
+        self,
+        name,
+        device_name,
+        start=None,
+        end=None,
+        npoints=None,
+        method="minmax",
+        chunk_size=50000,
+        sess=None,
+    ):
+        """
+        get the samples of a datastream as numpy arrays, optionally downsampled.
+
+        archived chunks and the live rows in SQLite are read transparently. rows are streamed from the cursor in
+        chunks of `chunk_size` and archived chunks are memory-mapped, so a minmax downsample only ever holds one
+        chunk plus the buckets in memory
+
+        :param start: start time in epoch nanoseconds, inclusive
+        :param end: end time in epoch nanoseconds, inclusive
+        :param npoints: maximum number of points to return. None returns every sample
+        :param method: "minmax" or "lttb"
+        :return: (t_ns, values) as int64 and float64 arrays
+        """
+        with self.session(sess, readonly=True) as sess:
+            did = self.get_datastream_id(name, device_name, sess=sess)
+            if did is None:
+                return concatenate_chunks([])
+
+            where, params = self._sample_filter(did, start, end)
+            chunks = self._iter_all_samples(
+                sess, did, where, params, start, end, chunk_size
+            )
+            if npoints:
+                n, tmin, tmax = self._extent(sess, did, where, params, start, end)
+                if n > npoints:
+                    if method == "minmax":
+                        env = self._rollup_envelope(
+                            sess, did, n, tmax - tmin, npoints, start, end
+                        )
+                        if env:
+                            return minmax(*env, npoints)
+
+                    if method == "lttb":
+                        t, v = concatenate_chunks(list(chunks))
+                        return lttb(t, v, npoints)
+
+                    mm = MinMaxBuckets(tmin, tmax, max(npoints // 2, 1))
+                    for t, v in chunks:
+                        mm.add(t, v)
+                    return mm.result()
+
+            return concatenate_chunks(list(chunks))
+
+    def iter_samples(
+        self,
+        name,
+        device_name,
+        start=None,
+        end=None,
+        npoints=1000,
+        coarse=8,
+        chunk_size=50000,
+        cancel=None,
+    ):
+        """
+        progressively load a datastream.
+
+        yields (t_ns, values) arrays, each one a better approximation than the last. the first yield is a coarse
+        min/max overview taken from the archive index and computed in SQL with npoints / coarse buckets for the
+        live rows. samples are then streamed in time order into min/max buckets and after every chunk the refined
+        head is yielded joined to the coarse tail. the last yield is the same as get_samples(..., npoints=npoints)
+
+        :param cancel: threading.Event. loading stops as soon as it is set
+        """
+        with self.session(readonly=True) as sess:
+            did = self.get_datastream_id(name, device_name, sess=sess)
+            if did is None:
+                return
+
+            where, params = self._sample_filter(did, start, end)
+            n, tmin, tmax = self._extent(sess, did, where, params, start, end)
+            if not n:
+                return
+
+            chunks = self._iter_all_samples(
+                sess, did, where, params, start, end, chunk_size
+            )
+            if n <= npoints:
+                yield concatenate_chunks(list(chunks))
+                return
+
+            env = self._rollup_envelope(sess, did, n, tmax - tmin, npoints, start, end)
+            if env:
+                yield minmax(*env, npoints)
+                return
+
+            ct, cv = self.archive.overview(did, start, end)
+            lt, lv = self._coarse_samples(
+                sess, where, params, tmin, tmax, max(npoints // coarse, 1)
+            )
+            ct, cv = concatenate((ct, lt)), concatenate((cv, lv))
+            yield ct, cv
+
+            mm = MinMaxBuckets(tmin, tmax, max(npoints // 2, 1))
+            for t, v in chunks:
+                if cancel is not None and cancel.is_set():
+                    return
+
+                mm.add(t, v)
+                ft, fv = mm.result()
+                tail = ct > t[-1]
+                yield concatenate((ft, ct[tail])), concatenate((fv, cv[tail]))
+
+    def get_aligned(
+        self,
+        streams,
+        start=None,
+        end=None,
+        npoints=1000,
+        step=None,
+        method="linear",
+        tolerance=None,
+        max_samples=None,
+        cancel=None,
+    ):
+        """
+        get several datastreams resampled onto a common time base
+
+        samples are fetched one grid step either side of [start, end] so asof and linear have a value to start
+        from at the edges of the window. with `max_samples` each stream is first reduced to a min/max envelope
+        of at most that many points, drawn from the rollups where they exist, so the cost of a display query
+        does not grow with the window
+
+        :param streams: list of (name, device_name)
+        :param start: epoch nanoseconds. defaults to the earliest sample of any stream
+        :param end: epoch nanoseconds. defaults to the latest sample of any stream
+        :param npoints: number of grid points. ignored if `step` is given
+        :param step: grid spacing in nanoseconds
+        :param method: "asof", "linear" or "mean". see db.align
+        :param tolerance: nanoseconds. see db.align
+        :param max_samples: downsample each stream to at most this many points before aligning
+        :param cancel: threading.Event. checked before each stream is loaded
+        :return: (grid, values) int64 grid and a float64 array of shape (len(streams), len(grid)). None if
+            cancelled
+        """
+        pad = step or 0
+        if start is not None and end is not None and not pad:
+            pad = max((end - start) // max(npoints - 1, 1), 1)
+
+        series = []
+        with self.session(readonly=True) as sess:
+            for name, device_name in streams:
+                if cancel is not None and cancel.is_set():
+                    return
+
+                series.append(
+                    self.get_samples(
+                        name,
+                        device_name,
+                        None if start is None else start - pad,
+                        None if end is None else end + pad,
+                        npoints=max_samples,
+                        sess=sess,
+                    )
+                )
 
-    def backup(self):
-        src = paths.database_path
-        if src.is_file():
-            # dest = paths.database_backup()
-            dest = paths.database_backup_path
-            shutil.copyfile(src, dest)
+        if start is None or end is None:
+            ts = [t for t, v in series if len(t)]
+            if not ts:
+                return time_base(0, 0, 1), full((len(streams), 1), nan)
+            if start is None:
+                start = min(int(t[0]) for t in ts)
+            if end is None:
+                end = max(int(t[-1]) for t in ts)
+
+        grid = time_base(start, end, npoints, step)
+        return grid, align(series, grid, method, tolerance)
+
+    def iter_sample_chunks(
+        self, name, device_name, start=None, end=None, chunk_size=50000, sess=None
+    ):
+        """
+        stream every sample of a datastream in time order, archived chunks first, as (t_ns, values) arrays of at
+        most `chunk_size` rows. memory use is independent of the size of the range
+        """
+        with self.session(sess, readonly=True) as sess:
+            did = self.get_datastream_id(name, device_name, sess=sess)
+            if did is None:
+                return
+
+            where, params = self._sample_filter(did, start, end)
+            yield from self._iter_all_samples(
+                sess, did, where, params, start, end, chunk_size
+            )
+
+    def iter_event_chunks(
+        self, name, device_name, start=None, end=None, chunk_size=50000, sess=None
+    ):
+        """
+        stream the events of a datastream in time order as lists of at most `chunk_size` (t_ns, value_string)
+        tuples
+        """
+        with self.session(sess, readonly=True) as sess:
+            did = self.get_datastream_id(name, device_name, sess=sess)
+            if did is None:
+                return
+
+            where = ["datastream_id = ?"]
+            params = [did]
+            if start is not None:
+                where.append("t_ns >= ?")
+                params.append(int(start))
+            if end is not None:
+                where.append("t_ns <= ?")
+                params.append(int(end))
+
+            cursor = self._cursor(sess)
+            try:
+                cursor.execute(
+                    f"SELECT t_ns, value_string FROM EventTbl WHERE {' AND '.join(where)} ORDER BY t_ns",
+                    params,
+                )
+                while rows := cursor.fetchmany(chunk_size):
+                    yield rows
+            finally:
+                cursor.close()
+
+    def get_rollups(
+        self, name, device_name, resolution=60, start=None, end=None, sess=None
+    ):
+        """
+        get the rollup aggregates of a datastream
+
+        :param resolution: bucket width in seconds. one of rollup.RESOLUTIONS
+        :return: numpy structured array with fields t_ns, count, min_value, max_value, mean, first_value,
+            last_value
+        """
+        with self.session(sess, readonly=True) as sess:
+            did = self.get_datastream_id(name, device_name, sess=sess)
+            if did is None:
+                return rollup.to_array([])
+            return self._get_rollups(sess, did, resolution, start, end)
+
+    def add_calibration(self, device_name, channel, calibration, t_ns=None, sess=None):
+        """
+        record the calibration of a device channel. a new version is added only if the definition differs from the
+        version currently in effect
+
+        :param calibration: Calibration or anything make_calibration accepts
+        :param t_ns: when the version takes effect. defaults to now
+        :return: version number in effect
+        """
+        definition = make_calibration(calibration).to_dict()
+        with self.session(sess) as sess:
+            dev_id = self.get_device_id(device_name, sess=sess)
+            if dev_id is None:
+                self.warning(
+                    f"cannot add calibration {channel}. invalid device={device_name}"
+                )
+                return
+
+            versions = self._get_calibrations(sess, dev_id, channel)
+            if versions:
+                version, _, current = versions[-1]
+                if current.to_dict() == definition:
+                    return version
+            else:
+                version = 0
+
+            version += 1
+            self._add_calibration(sess, dev_id, channel, version, t_ns, definition)
+            sess.commit()
+            return version
+
+    def get_calibrations(self, device_name, channel, sess=None):
+        """
+        :return: list of (version, t_ns, Calibration) ordered by t_ns
+        """
+        with self.session(sess, readonly=True) as sess:
+            dev_id = self.get_device_id(device_name, sess=sess)
+            if dev_id is None:
+                return []
+            return self._get_calibrations(sess, dev_id, channel)
+
+    def recalibrate(
+        self, device_name, channel, calibration, datastreams=None, start=None, sess=None
+    ):
+        """
+        re-map the recorded samples of a channel to a new calibration in bulk. each sample is converted back to raw
+        with the calibration version in effect when it was recorded, then mapped with `calibration`. the rollups
+        of the affected buckets are rebuilt and `calibration` becomes the channel's version from `start` on.
+
+        samples recorded before the first version, values the old calibration cannot invert and archived chunks
+        are left unchanged
+
+        :param datastreams: names of the datastreams recorded from the channel. defaults to the channel name
+        :param start: re-map samples from this t_ns on. defaults to all samples
+        :return: number of samples re-mapped
+        """
+        new = make_calibration(calibration)
+        start = int(start or 0)
+        with self.session(sess) as sess:
+            dev_id = self.get_device_id(device_name, sess=sess)
+            if dev_id is None:
+                self.warning(
+                    f"cannot recalibrate {channel}. invalid device={device_name}"
+                )
+                return 0
+
+            versions = self._get_calibrations(sess, dev_id, channel)
+            names = datastreams or [channel]
+            q = sess.query(DatastreamTbl.id)
+            q = q.filter(DatastreamTbl.device_id == dev_id)
+            q = q.filter(DatastreamTbl.name.in_(names))
+
+            n = 0
+            for (did,) in q.all():
+                n += self._remap_samples(sess, did, versions, new, start)
+
+            q = sess.query(CalibrationTbl)
+            q = q.filter(CalibrationTbl.device_id == dev_id)
+            q = q.filter(CalibrationTbl.channel == channel)
+            q = q.filter(CalibrationTbl.t_ns >= start)
+            q.delete()
+            version = max((v for v, _, _ in versions), default=0) + 1
+            self._add_calibration(sess, dev_id, channel, version, start, new.to_dict())
+            sess.commit()
+
+            self.info(
+                f"recalibrated {device_name}.{channel} from {start}. remapped {n} samples"
+            )
+            return n
+
+    def backup(self, block=False):
+        """
+        make a timestamped online backup of the database and the archive tier. by default the backup runs in the
+        background
+        """
+        return self.backups.start(
+            self._get_path(), block=block, archive=self.archive.root
+        )
 
     def _add_unique(self, sess, table, idenfitier, attr="name", **kw):
         with self.session(sess) as sess:
@@ -221,6 +893,292 @@ class DBClient(Loggable):
                 record = table(**kw)
                 self._add(sess, record)
 
+    def _sample_filter(self, did, start, end, table="SampleTbl"):
+        where = [f"{table}.datastream_id = ?", f"{table}.value IS NOT NULL"]
+        params = [did]
+        if start is not None:
+            where.append(f"{table}.t_ns >= ?")
+            params.append(int(start))
+        if end is not None:
+            where.append(f"{table}.t_ns <= ?")
+            params.append(int(end))
+        return " AND ".join(where), params
+
+    def _sample_extent(self, sess, where, params):
+        cursor = self._cursor(sess)
+        try:
+            cursor.execute(
+                f"SELECT COUNT(*), MIN(t_ns), MAX(t_ns) FROM SampleTbl WHERE {where}",
+                params,
+            )
+            return cursor.fetchone()
+        finally:
+            cursor.close()
+
+    def _get_rollups(self, sess, did, resolution, start, end):
+        where = ["datastream_id = ?", "resolution = ?"]
+        params = [did, resolution]
+        # include the bucket containing start
+        if start is not None:
+            where.append("t_ns > ?")
+            params.append(int(start) - resolution * rollup.NS)
+        if end is not None:
+            where.append("t_ns <= ?")
+            params.append(int(end))
+
+        where = " AND ".join(where)
+        cursor = self._cursor(sess)
+        try:
+            cursor.execute(
+                f"SELECT t_ns, count, min_value, max_value, total / count, first_value, last_value "
+                f"FROM RollupTbl WHERE {where} ORDER BY t_ns",
+                params,
+            )
+            return rollup.to_array(cursor.fetchall())
+        finally:
+            cursor.close()
+
+    def _rollup_envelope(self, sess, did, n, span, npoints, start, end):
+        """
+        min/max envelope of [start, end] from the rollups. the resolution picked for `npoints` is used if its
+        rollups cover all `n` samples, else the next coarser one that does. rollups can be missing, e.g. pruned by
+        retention or for samples written before they were kept
+
+        :return: (t_ns, values) or None if the raw samples are needed
+        """
+        r = rollup.pick_resolution(span, npoints // 2)
+        if not r:
+            return
+
+        for resolution in rollup.RESOLUTIONS:
+            if resolution < r:
+                continue
+
+            rows = self._get_rollups(sess, did, resolution, start, end)
+            if len(rows) and self._rollups_cover(
+                sess, did, rows, resolution, n, start, end
+            ):
+                return rollup.envelope(rows, resolution)
+
+    def _rollups_cover(self, sess, did, rows, resolution, n, start, end):
+        """
+        True if the rollups hold every one of the `n` samples of [start, end]. a bucket cut by the edge of the
+        window also counts samples outside it, so each edge bucket is compared to the samples of its own part of
+        the window and the buckets in between to the rest
+        """
+        width = resolution * rollup.NS
+        counts = dict(zip(rows["t_ns"].tolist(), rows["count"].tolist()))
+
+        # bucket: the part of the window it covers
+        edges = {}
+        if start is not None and start % width:
+            b = start - start % width
+            hi = b + width - 1
+            edges[b] = (start, hi if end is None else min(hi, end))
+        if end is not None and (end + 1) % width:
+            b = end - end % width
+            edges[b] = (b if start is None else max(b, start), end)
+
+        inside = n
+        for b, (lo, hi) in edges.items():
+            m = self._count_samples(sess, did, lo, hi)
+            if counts.get(b, 0) < m:
+                return False
+            inside -= m
+
+        return sum(c for b, c in counts.items() if b not in edges) >= inside
+
+    def _count_samples(self, sess, did, start, end):
+        """
+        number of samples in [start, end] over the archive and the live rows
+        """
+        where, params = self._sample_filter(did, start, end)
+        return self._extent(sess, did, where, params, start, end)[0]
+
+    def _extent(self, sess, did, where, params, start, end):
+        """
+        (count, t_min, t_max) over the archive and the live rows
+        """
+        n, tmin, tmax = self._sample_extent(sess, where, params)
+        an, atmin, atmax = self.archive.extent(did, start, end)
+        if an:
+            tmin = atmin if tmin is None else min(tmin, atmin)
+            tmax = atmax if tmax is None else max(tmax, atmax)
+        return n + an, tmin, tmax
+
+    def _iter_all_samples(self, sess, did, where, params, start, end, chunk_size):
+        """
+        archived chunks, then the live rows, in time order. live rows at or before the end of the archive arrived
+        late and are not merged into the archive until the next maintenance run. they are merged into the chunks
+        they fall in here
+        """
+        sealed = self.archive.sealed_until(did)
+        if sealed is None:
+            yield from self._iter_samples(sess, where, params, chunk_size)
+            return
+
+        late = list(
+            self._iter_samples(
+                sess, f"{where} AND SampleTbl.t_ns <= ?", params + [sealed], chunk_size
+            )
+        )
+        lt, lv = concatenate_chunks(late)
+
+        i = 0
+        for t, v in self.archive.iter_chunks(did, start, end):
+            j = searchsorted(lt, t[-1], side="right")
+            if j > i:
+                t, v = merge_samples(t, v, lt[i:j], lv[i:j])
+                i = j
+            yield t, v
+
+        if i < len(lt):
+            yield lt[i:], lv[i:]
+        yield from self._iter_samples(
+            sess, f"{where} AND SampleTbl.t_ns > ?", params + [sealed], chunk_size
+        )
+
+    def _coarse_samples(self, sess, where, params, tmin, tmax, nbuckets):
+        """
+        min/max per time bucket computed by SQLite. the min and max of each bucket are placed at the first and
+        last sample time of the bucket, so this is only suitable as an overview
+        """
+        width = max(tmax - tmin, 1) / nbuckets
+        cursor = self._cursor(sess)
+        try:
+            cursor.execute(
+                f"SELECT CAST((t_ns - ?) / ? AS INTEGER) AS b, MIN(t_ns), MIN(value), MAX(t_ns), MAX(value) "
+                f"FROM SampleTbl WHERE {where} GROUP BY b ORDER BY b",
+                [tmin, width] + params,
+            )
+            rows = array(cursor.fetchall(), dtype=COARSE_DTYPE)
+        finally:
+            cursor.close()
+
+        t = column_stack((rows["tmin"], rows["tmax"])).ravel()
+        v = column_stack((rows["vmin"], rows["vmax"])).ravel()
+        return t, v
+
+    def _iter_samples(self, sess, where, params, chunk_size):
+        cursor = self._cursor(sess)
+        try:
+            cursor.execute(
+                f"SELECT t_ns, value FROM SampleTbl WHERE {where} ORDER BY t_ns", params
+            )
+            while rows := cursor.fetchmany(chunk_size):
+                a = array(rows, dtype=SAMPLE_DTYPE)
+                yield a["t_ns"], a["value"]
+        finally:
+            cursor.close()
+
+    def _get_calibrations(self, sess, dev_id, channel):
+        q = sess.query(CalibrationTbl)
+        q = q.filter(CalibrationTbl.device_id == dev_id)
+        q = q.filter(CalibrationTbl.channel == channel)
+        q = q.order_by(CalibrationTbl.t_ns, CalibrationTbl.version)
+        return [
+            (c.version, c.t_ns, make_calibration(json.loads(c.definition)))
+            for c in q.all()
+        ]
+
+    def _add_calibration(self, sess, dev_id, channel, version, t_ns, definition):
+        c = CalibrationTbl(
+            device_id=dev_id,
+            channel=channel,
+            version=version,
+            t_ns=time.time_ns() if t_ns is None else t_ns,
+            definition=json.dumps(definition, sort_keys=True),
+        )
+        sess.add(c)
+        sess.flush()
+
+    def _remap_samples(self, sess, did, versions, new, start):
+        """
+        re-map the live samples of one datastream, one calibration version window at a time, and rebuild the
+        rollups they fall in
+        """
+        n = 0
+        tmin = tmax = None
+        ends = [t for _, t, _ in versions[1:]] + [None]
+        cursor = self._cursor(sess)
+        try:
+            for (_, t0, old), t1 in zip(versions, ends):
+                lo = max(t0, start)
+                if old == new or (t1 is not None and t1 <= lo):
+                    continue
+
+                where, params = self._sample_filter(did, lo, None)
+                if t1 is not None:
+                    where += " AND SampleTbl.t_ns < ?"
+                    params.append(t1)
+
+                cursor.execute(
+                    f"SELECT id, t_ns, value FROM SampleTbl WHERE {where}", params
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    continue
+
+                a = array(rows, dtype=[("id", int64)] + SAMPLE_DTYPE)
+                v = remap(a["value"], old, new)
+                ok = isfinite(v)
+                if not ok.all():
+                    self.warning(
+                        f"datastream {did}. {(~ok).sum()} values outside the range of calibration {old.to_dict()}"
+                    )
+                a, v = a[ok], v[ok]
+                if not len(a):
+                    continue
+
+                cursor.executemany(
+                    "UPDATE SampleTbl SET value = ? WHERE id = ?",
+                    zip(v.tolist(), a["id"].tolist()),
+                )
+                n += len(a)
+                t = a["t_ns"]
+                tmin = t.min() if tmin is None else min(tmin, t.min())
+                tmax = t.max() if tmax is None else max(tmax, t.max())
+        finally:
+            cursor.close()
+
+        if n:
+            self._rebuild_rollups(sess, did, int(tmin), int(tmax))
+        return n
+
+    def _rebuild_rollups(self, sess, did, tmin, tmax):
+        """
+        recompute every rollup bucket of a datastream overlapping [tmin, tmax] from the samples
+        """
+        w = max(rollup.RESOLUTIONS) * rollup.NS
+        start = tmin - tmin % w
+        end = tmax - tmax % w + w - 1
+
+        sess.execute(
+            RollupTbl.__table__.delete().where(
+                RollupTbl.datastream_id == did,
+                RollupTbl.t_ns >= start,
+                RollupTbl.t_ns <= end,
+            )
+        )
+
+        where, params = self._sample_filter(did, start, end)
+        chunks = list(
+            self._iter_all_samples(sess, did, where, params, start, end, 100000)
+        )
+        if chunks:
+            t = concatenate([c[0] for c in chunks])
+            v = concatenate([c[1] for c in chunks])
+            rows = rollup.aggregate_arrays(did, t, v)
+            if rows:
+                sess.execute(rollup_upsert(), rows)
+
+    def _cursor(self, sess):
+        """
+        a raw DBAPI cursor on the session's connection. used for bulk reads so rows are fetched as plain tuples
+        and can be converted to numpy arrays without building ORM objects
+        """
+        return sess.connection().connection.cursor()
+
     def _fetch_first(self, q, verbose=False):
         if verbose:
             self.debug(literalquery(q.statement))
@@ -233,39 +1191,72 @@ class DBClient(Loggable):
             if commit:
                 sess.commit()
 
-    # def connect(self):
-    #     pass
-    # sess = self.get_session()
-    # self.session_factory = sessionmaker(engine=engine)
+    def _get_engine(self):
+        if self._engine is None:
+            self._engine = self.profile.create_writer_engine(self._get_path())
+        return self._engine
 
-    # def get_session(self, force=False):
-    #     if not self.session or force:
-    #         self.session = self.session_factory()
-    #     return self.session
+    def _get_reader_engine(self):
+        if self._reader_engine is None:
+            # make sure the database exists and the journal mode is set before opening read-only connections
+            self.storage_settings()
+            self._reader_engine = self.profile.create_reader_engine(self._get_path())
+        return self._reader_engine
 
-    def _get_engine(self):
-        url = paths.database_path
-        engine = create_engine(f"sqlite:///{url}")
-        return engine
+    def _get_path(self):
+        return self.path or paths.database_path
+
+    def _archive_default(self):
+        root = Path(self._get_path()).parent / "archive"
+        return Archive(self.configobj.get("archive"), root=str(root))
 
-    def session(self, sess=None):
+    def _backups_default(self):
+        return BackupManager(self.configobj.get("backup"))
+
+    def _profile_default(self):
+        profile = StorageProfile(self.configobj.get("storage"))
+        return profile
+
+    @contextmanager
+    def raw_connection(self, readonly=False):
+        """
+        a DBAPI connection checked out from the writer (or reader) pool. used for maintenance statements that need
+        explicit transaction control
+        """
+        engine = self._get_reader_engine() if readonly else self._get_engine()
+        conn = engine.raw_connection()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def session(self, sess=None, readonly=False):
+        """
+        :param readonly: use a connection from the read-only pool. use for dashboard/history queries
+        """
         if sess is None:
-            factory = self.session_factory()
+            factory = self.session_factory(readonly)
             sess = factory()
 
         sess = SessionCTX(sess)
         return sess
 
-    def session_factory(self):
-        factory = self._session_factory
-        if not factory:
-            factory = sessionmaker(
-                bind=self._get_engine(),
-                # autoflush=self.autoflush,
-                # expire_on_commit=False,
-                # autocommit=self.autocommit,
-            )
-            self._session_factory = factory
+    def session_factory(self, readonly=False):
+        if readonly:
+            factory = self._reader_session_factory
+            if not factory:
+                factory = sessionmaker(bind=self._get_reader_engine())
+                self._reader_session_factory = factory
+        else:
+            factory = self._session_factory
+            if not factory:
+                factory = sessionmaker(
+                    bind=self._get_engine(),
+                    # autoflush=self.autoflush,
+                    # expire_on_commit=False,
+                    # autocommit=self.autocommit,
+                )
+                self._session_factory = factory
 
         return factory
 
@@ -0,0 +1,153 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+from numpy import (
+    full,
+    inf,
+    lexsort,
+    r_,
+    empty,
+    int64,
+    column_stack,
+    floor,
+    clip,
+    abs as nabs,
+    arange,
+    argmax,
+    concatenate,
+)
+
+
+class MinMaxBuckets(object):
+    """
+    streaming min/max downsampler.
+
+    [start, end] is divided into `nbuckets` equal time buckets. chunks of samples are added with `add` and for
+    each bucket only the min and max sample are kept, so memory is proportional to `nbuckets`, not to the number
+    of samples. `result` returns at most 2 * nbuckets points in time order, which preserves spikes that a plain
+    decimation would drop.
+    """
+
+    def __init__(self, start, end, nbuckets):
+        self.start = start
+        self.span = max(end - start, 1)
+        self.nbuckets = nbuckets
+        self.tmin = full(nbuckets, -1, dtype=int64)
+        self.tmax = full(nbuckets, -1, dtype=int64)
+        self.vmin = full(nbuckets, inf)
+        self.vmax = full(nbuckets, -inf)
+
+    def bucket(self, t):
+        b = floor((t - self.start) / self.span * self.nbuckets).astype(int64)
+        return clip(b, 0, self.nbuckets - 1)
+
+    def add(self, t, v):
+        if not len(t):
+            return
+
+        b = self.bucket(t)
+        # sort by bucket then value. the first of each bucket run is the min, the last is the max
+        order = lexsort((v, b))
+        bs = b[order]
+        edge = bs[1:] != bs[:-1]
+        first = order[r_[True, edge]]
+        last = order[r_[edge, True]]
+        ub = b[first]
+
+        better = v[first] < self.vmin[ub]
+        idx = ub[better]
+        self.vmin[idx] = v[first][better]
+        self.tmin[idx] = t[first][better]
+
+        # ties keep the earliest min and the latest max so the result does not depend on how samples are chunked
+        better = v[last] >= self.vmax[ub]
+        idx = ub[better]
+        self.vmax[idx] = v[last][better]
+        self.tmax[idx] = t[last][better]
+
+    def result(self):
+        valid = self.tmin >= 0
+        t = column_stack((self.tmin[valid], self.tmax[valid]))
+        v = column_stack((self.vmin[valid], self.vmax[valid]))
+
+        # order the min and max of each bucket by time
+        swap = t[:, 0] > t[:, 1]
+        t[swap] = t[swap][:, ::-1]
+        v[swap] = v[swap][:, ::-1]
+
+        # a bucket with a single sample has min == max
+        keep = column_stack((full(len(t), True), t[:, 0] != t[:, 1]))
+        return t[keep], v[keep]
+
+
+def minmax(t, v, npoints):
+    """
+    downsample to at most `npoints` using min/max buckets
+    """
+    if len(t) <= npoints:
+        return t, v
+
+    mm = MinMaxBuckets(t[0], t[-1], max(npoints // 2, 1))
+    mm.add(t, v)
+    return mm.result()
+
+
+def lttb(t, v, npoints):
+    """
+    Largest-Triangle-Three-Buckets downsampling. `t` must be sorted.
+
+    the first and last points are always kept. for each bucket the point forming the largest triangle with the
+    previously selected point and the mean of the next bucket is selected. the area computation is vectorized
+    over each bucket
+    """
+    n = len(t)
+    if npoints >= n or npoints < 3:
+        return t, v
+
+    x = (t - t[0]).astype(float)
+    edges = (arange(npoints - 1) * (n - 2) / (npoints - 2)).astype(int64) + 1
+    edges[-1] = n - 1
+
+    selected = empty(npoints, dtype=int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(npoints - 2):
+        s, e = edges[i], edges[i + 1]
+        ns, ne = e, edges[i + 2] if i + 2 < len(edges) else n
+        if ne <= ns:
+            ne = ns + 1
+        mx = x[ns:ne].mean()
+        my = v[ns:ne].mean()
+
+        area = nabs((x[a] - mx) * (v[s:e] - v[a]) - (x[a] - x[s:e]) * (my - v[a]))
+        a = s + argmax(area)
+        selected[i + 1] = a
+
+    return t[selected], v[selected]
+
+
+def concatenate_chunks(chunks, dtype_t=int64):
+    """
+    join a list of (t, v) chunks into a single pair of arrays
+    """
+    if not chunks:
+        return empty(0, dtype=dtype_t), empty(0)
+
+    ts, vs = zip(*chunks)
+    return concatenate(ts), concatenate(vs)
+
+
+# ============= EOF =============================================
@@ -0,0 +1,210 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import heapq
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from traits.api import Any, Enum, Int, Str
+
+from loggable import Loggable
+from persister import COMPRESSION, CSVPersister, ColumnarPersister, NDJSONPersister
+
+PERSISTERS = {
+    "csv": CSVPersister,
+    "ndjson": NDJSONPersister,
+    "binary": ColumnarPersister,
+}
+
+
+def to_ns(t):
+    """
+    convert a datetime, an ISO 8601 string or epoch nanoseconds to epoch nanoseconds
+    """
+    if t is None:
+        return
+    if isinstance(t, str):
+        t = datetime.fromisoformat(t)
+    if isinstance(t, datetime):
+        return int(t.timestamp() * 1e9)
+    return int(t)
+
+
+def parse_stream(stream):
+    """
+    :param stream: (name, device_name) or "device_name.name"
+    :return: (name, device_name)
+    """
+    if isinstance(stream, str):
+        device_name, _, name = stream.partition(".")
+        return name or "default", device_name
+    name, device_name = stream
+    return name, device_name
+
+
+class Exporter(Loggable):
+    """
+    Streaming bulk export of datastreams.
+
+    Every datastream is written to its own compressed file under `<root>/exports` by a pool of `workers`
+    threads. Rows are streamed from the database (and the archive) in chunks of `chunk_size`, so memory use does
+    not depend on the length of the export.
+
+    Each worker holds one read-only connection for the whole datastream. Workers are capped at one less than
+    `database.storage.readers`, so dashboard and history queries always find a free reader during an export.
+
+    Formats
+
+    csv: t_ns,value rows, samples and events merged in time order
+    ndjson: one {"t_ns": ..., "value": ...} object per line, samples and events merged in time order
+    binary: `ColumnarPersister` blocks of int64 t_ns and float64 value. samples only
+
+    init.yml
+
+    database:
+      export:
+        format: csv
+        compression: gzip
+        workers: 4
+        chunk_size: 50000
+    """
+
+    dbclient = Any
+    format = Enum(*PERSISTERS.keys())
+    compression = Enum("gzip", None, "bz2", "xz")
+    workers = Int(4)
+    chunk_size = Int(50000)
+    base = Str("exports")
+
+    def __init__(self, cfg=None, *args, **kw):
+        super().__init__(cfg, *args, **kw)
+        cfg = self.configobj
+        for k in ("format", "compression", "workers", "chunk_size"):
+            if k in cfg:
+                setattr(self, k, cfg[k])
+
+    def export(self, streams, start=None, end=None, format=None, compression=""):
+        """
+        export datastreams
+
+        :param streams: list of (name, device_name) or "device_name.name"
+        :param start: datetime, ISO 8601 string or epoch nanoseconds
+        :param end: datetime, ISO 8601 string or epoch nanoseconds
+        :param format: "csv", "ndjson" or "binary". defaults to `self.format`
+        :param compression: "gzip", "bz2", "xz" or None. defaults to `self.compression`
+        :return: list of (name, device_name, path, nrows), one per stream
+        :raises ValueError: on an unknown format or compression, before anything is written
+        """
+        if format is None:
+            format = self.format
+        if compression == "":
+            compression = self.compression
+        if format not in PERSISTERS:
+            raise ValueError(f"invalid export format={format}")
+        if compression and compression not in COMPRESSION:
+            raise ValueError(f"invalid export compression={compression}")
+
+        start, end = to_ns(start), to_ns(end)
+        streams = [parse_stream(s) for s in streams]
+
+        st = time.perf_counter()
+        # leave a reader for dashboard and history queries
+        readers = self.dbclient.profile.readers - 1
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(self.workers, readers, len(streams))),
+            thread_name_prefix="Export",
+        ) as pool:
+            futures = [
+                pool.submit(
+                    self._export_stream,
+                    name,
+                    device_name,
+                    start,
+                    end,
+                    format,
+                    compression,
+                )
+                for name, device_name in streams
+            ]
+            results = [f.result() for f in futures]
+
+        self.info(
+            f"exported {len(results)} datastreams, {sum(r[3] for r in results)} rows "
+            f"in {time.perf_counter() - st:0.3f}s"
+        )
+        return results
+
+    # private
+    def _export_stream(self, name, device_name, start, end, format, compression):
+        klass = PERSISTERS[format]
+        persister = klass(
+            base=self.base,
+            path_name=f"{device_name}_{name}_",
+            compression=compression,
+        )
+        n = 0
+        # samples and events are read on one connection
+        with persister, self.dbclient.session(readonly=True) as sess:
+            if format == "binary":
+                for t, v in self.dbclient.iter_sample_chunks(
+                    name, device_name, start, end, self.chunk_size, sess=sess
+                ):
+                    persister.write((t, v))
+                    n += len(t)
+            else:
+                if format == "csv":
+                    persister.write(("t_ns", "value"))
+                for rows in self._iter_rows(
+                    name, device_name, start, end, format, sess
+                ):
+                    persister.write_many(rows)
+                    n += len(rows)
+
+        self.debug(f"exported {device_name}.{name} {n} rows to {persister.path}")
+        return name, device_name, str(persister.path), n
+
+    def _iter_rows(self, name, device_name, start, end, format, sess):
+        """
+        samples and events of a datastream merged in time order, in lists of at most `chunk_size` rows
+        """
+
+        def samples():
+            for t, v in self.dbclient.iter_sample_chunks(
+                name, device_name, start, end, self.chunk_size, sess=sess
+            ):
+                yield from zip(t.tolist(), v.tolist())
+
+        def events():
+            for rows in self.dbclient.iter_event_chunks(
+                name, device_name, start, end, self.chunk_size, sess=sess
+            ):
+                yield from rows
+
+        rows = heapq.merge(samples(), events(), key=lambda r: r[0])
+        if format == "ndjson":
+            rows = ({"t_ns": t, "value": v} for t, v in rows)
+
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+# ============= EOF =============================================
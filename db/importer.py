@@ -0,0 +1,303 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import csv
+import json
+import time
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+
+from numpy import array, asarray, float64, int64, isfinite, loadtxt
+
+from traits.api import Any, Int
+
+from db.export import parse_stream
+from loggable import Loggable
+from persister import open_compressed
+
+
+def parse_times(col):
+    """
+    convert a column of epoch seconds or ISO 8601 strings to int64 epoch nanoseconds. ISO strings without a
+    timezone are local time, as written by `datetime.now().isoformat()`
+    """
+    try:
+        return (asarray(col, dtype=float64) * 1e9).astype(int64)
+    except ValueError:
+        pass
+
+    if any(
+        s.endswith("Z") or "+" in s[10:] or "-" in s[10:] for s in (col[0], col[-1])
+    ):
+        return array(
+            [int(datetime.fromisoformat(s).timestamp() * 1e9) for s in col], dtype=int64
+        )
+
+    # numpy parses naive ISO strings as UTC. shift by the local offset, unless the batch spans a change of offset
+    first, last = (
+        datetime.fromisoformat(s).astimezone().utcoffset() for s in (col[0], col[-1])
+    )
+    if first != last:
+        return array(
+            [int(datetime.fromisoformat(s).timestamp() * 1e9) for s in col], dtype=int64
+        )
+
+    t = asarray(col, dtype="datetime64[ns]").astype(int64)
+    return t - int(first.total_seconds() * 1e9)
+
+
+def parse_values(col):
+    """
+    :return: (values, mask) float64 values and a mask of the cells that hold a finite number
+    """
+    try:
+        v = asarray(col, dtype=float64)
+    except ValueError:
+        v = array([_to_float(c) for c in col], dtype=float64)
+    return v, isfinite(v)
+
+
+def _to_float(c):
+    try:
+        return float(c)
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+class Importer(Loggable):
+    """
+    Bulk import of persistence files (`CSVPersister` and `JSONPersister` output) into the measurement schema.
+
+    Lines are read in batches of `batch_size`, converted to numpy columns and inserted per datastream with
+    `DBClient.add_sample_arrays`, one transaction per batch. all-numeric CSV batches are parsed by numpy.loadtxt,
+    anything else falls back to the csv module. quoted fields must not span lines
+
+    CSV. the first column (or `time_column`) is the acquisition time, epoch seconds or ISO 8601. `columns` maps
+    the other columns, by index or header name, to "device_name.datastream". unmapped columns are imported to
+    `device_name` with the header, or "column<i>", as the datastream name
+
+    JSON. every list of payloads in the file is imported. each payload has a `time_field` in epoch seconds; its
+    other numeric fields become datastreams of `device_name`, nested fields are joined with "."
+    """
+
+    dbclient = Any
+    batch_size = Int(200000)
+
+    def __init__(self, cfg=None, *args, **kw):
+        super().__init__(cfg, *args, **kw)
+        self.batch_size = self.configobj.get("batch_size", self.batch_size)
+
+    def import_file(self, path, *args, **kw):
+        """
+        import a CSV or JSON file. the format is taken from the suffix, compressed files are supported. a file that
+        yields no samples is logged as a warning
+        """
+        suffixes = Path(path).suffixes
+        if ".json" in suffixes:
+            return self.import_json(path, *args, **kw)
+        return self.import_csv(path, *args, **kw)
+
+    def import_csv(
+        self,
+        path,
+        device_name=None,
+        columns=None,
+        time_column=0,
+        header=None,
+        progress=None,
+    ):
+        """
+        :param columns: {column index or header name: "device_name.datastream"}
+        :param header: True if the first row is a header. None detects a header by a non-numeric time cell
+        :param progress: callable(nrows, elapsed) called after every batch
+        :return: report dict
+        """
+        st = time.perf_counter()
+        report = {"path": str(path), "rows": 0, "samples": 0, "datastreams": {}}
+        with open_compressed(path, "r") as rfile:
+            line = rfile.readline()
+            if not line:
+                return self._finish(report, st)
+
+            first = next(csv.reader([line]))
+            if header is None:
+                header = not _is_time(first[time_column])
+
+            names = first if header else [f"column{i}" for i in range(len(first))]
+            lines = rfile if header else _chain(line, rfile)
+            streams = self._map_columns(names, time_column, device_name, columns)
+
+            while batch := list(islice(lines, self.batch_size)):
+                cols = _parse_lines(batch, len(names))
+                if not cols:
+                    continue
+
+                t = parse_times(cols[time_column])
+                data = []
+                for i, stream in streams.items():
+                    v, mask = parse_values(cols[i])
+                    data.append((stream, t[mask], v[mask]))
+
+                n = self._insert(data, report)
+                report["rows"] += len(cols[time_column])
+                report["samples"] += n
+                if progress:
+                    progress(report["rows"], time.perf_counter() - st)
+
+        return self._finish(report, st)
+
+    def import_json(self, path, device_name, time_field="time", progress=None):
+        """
+        :return: report dict
+        """
+        st = time.perf_counter()
+        report = {"path": str(path), "rows": 0, "samples": 0, "datastreams": {}}
+        with open_compressed(path, "r") as rfile:
+            obj = json.load(rfile)
+
+        payloads = [
+            p
+            for v in obj.values()
+            if isinstance(v, list)
+            for p in v
+            if isinstance(p, dict)
+        ]
+        for i in range(0, len(payloads), self.batch_size):
+            batch = payloads[i : i + self.batch_size]
+            series = {}
+            for p in batch:
+                t = p.get(time_field)
+                if t is None:
+                    continue
+                t = int(t * 1e9)
+                for name, v in _flatten(p, exclude=time_field):
+                    ts, vs = series.setdefault(name, ([], []))
+                    ts.append(t)
+                    vs.append(v)
+
+            data = []
+            for name, (ts, vs) in series.items():
+                v, mask = parse_values(vs)
+                data.append(
+                    ((name, device_name), asarray(ts, dtype=int64)[mask], v[mask])
+                )
+
+            report["samples"] += self._insert(data, report)
+            report["rows"] += len(batch)
+            if progress:
+                progress(report["rows"], time.perf_counter() - st)
+
+        return self._finish(report, st)
+
+    # private
+    def _map_columns(self, names, time_column, device_name, columns):
+        columns = columns or {}
+        streams = {}
+        for i, name in enumerate(names):
+            if i == time_column:
+                continue
+
+            stream = columns.get(i, columns.get(name))
+            if stream is None:
+                if columns or device_name is None:
+                    continue
+                stream = (name, device_name)
+            streams[i] = parse_stream(stream)
+        return streams
+
+    def _insert(self, data, report):
+        """
+        insert one batch in a single transaction
+        """
+        dbclient = self.dbclient
+        n = 0
+        with dbclient.session() as sess:
+            for (name, device_name), t, v in data:
+                dbclient.add_device(device_name, sess=sess, commit=False)
+                did = dbclient.add_datastream(
+                    name, device_name, sess=sess, commit=False
+                )
+                n += dbclient.add_sample_arrays(did, t, v, sess=sess, commit=False)
+
+                key = f"{device_name}.{name}"
+                report["datastreams"][key] = report["datastreams"].get(key, 0) + len(t)
+            sess.commit()
+        return n
+
+    def _finish(self, report, st):
+        et = time.perf_counter() - st
+        report["elapsed"] = et
+        report["rate"] = report["samples"] / et if et else 0
+        if not report["samples"]:
+            # e.g. a JSON file without a .json suffix parsed as CSV
+            self.warning(
+                f"no samples imported from {report['path']}. check the format and column mapping"
+            )
+            return report
+
+        self.info(
+            f"imported {report['path']} rows={report['rows']} samples={report['samples']} "
+            f"{report['rate']:0.0f} samples/s"
+        )
+        return report
+
+
+def _is_time(cell):
+    try:
+        float(cell)
+        return True
+    except ValueError:
+        pass
+    try:
+        datetime.fromisoformat(cell)
+        return True
+    except ValueError:
+        return False
+
+
+def _parse_lines(lines, ncols):
+    """
+    split csv lines into columns. all-numeric batches are parsed by numpy, anything else by the csv module. rows
+    with missing columns are skipped
+    """
+    try:
+        a = loadtxt(lines, delimiter=",", dtype=float64, ndmin=2)
+        if a.shape[1] == ncols:
+            return list(a.T)
+    except ValueError:
+        pass
+
+    rows = [r for r in csv.reader(lines) if len(r) >= ncols]
+    return list(zip(*rows))
+
+
+def _chain(first, rows):
+    yield first
+    yield from rows
+
+
+def _flatten(obj, prefix="", exclude=None):
+    for k, v in obj.items() if isinstance(obj, dict) else enumerate(obj):
+        if not prefix and k == exclude:
+            continue
+        name = f"{prefix}{k}"
+        if isinstance(v, (dict, list, tuple)):
+            yield from _flatten(v, f"{name}.")
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            yield name, v
+
+
+# ============= EOF =============================================
@@ -0,0 +1,405 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import time
+from contextlib import contextmanager
+from threading import Thread, Event
+
+from numpy import array
+from traits.api import Any, Bool, Float, Int, List, Dict
+
+from db.archive import CHUNK_DTYPE
+from db.rollup import NS
+from loggable import Loggable
+
+DAY = 86400
+
+
+class Maintenance(Loggable):
+    """
+    Background maintenance of the recorder database.
+
+    Each run applies the retention rules, seals old samples into the archive (if `database.archive.enabled`),
+    prunes old empty datastreams, runs ANALYZE and an incremental VACUUM, and records a report of rows deleted,
+    rows archived, space reclaimed and time spent in `last_report`. `raw_days` applies to the archive as well as
+    SampleTbl.
+
+    Sealing moves the samples of the active datastreams up to the start of the current UTC day, and every sample
+    of inactive datastreams, from SampleTbl into the archive. Samples older than the archived range are merged
+    into the archive. Events stay in SQLite.
+
+    Deletes are done in batches of `batch_size` rows, each in its own short transaction on the writer
+    connection, with a `batch_pause` between batches so the measurement writer is never locked out for long.
+
+    init.yml
+
+    database:
+      maintenance:
+        enabled: true
+        interval: 3600
+        batch_size: 5000
+        batch_pause: 0.05
+        analyze: true
+        vacuum_pages: 2000
+        prune_datastreams_days: 7
+        retention:
+          # raw samples for 30 days, then only rollups. 1 s rollups for 90 days
+          - raw_days: 30
+            rollup_days:
+              1: 90
+          - device: adc
+            datastream: scan
+            raw_days: 7
+    """
+
+    dbclient = Any
+
+    enabled = Bool(True)
+    interval = Float(3600)
+    batch_size = Int(5000)
+    batch_pause = Float(0.05)
+    analyze = Bool(True)
+    vacuum_pages = Int(2000)
+    prune_datastreams_days = Float(7)
+    retention = List
+
+    last_report = Dict
+
+    _thread = None
+    _stop_evt = None
+
+    def __init__(self, cfg=None, *args, **kw):
+        super().__init__(cfg, *args, **kw)
+        cfg = self.configobj
+        for k in (
+            "enabled",
+            "interval",
+            "batch_size",
+            "batch_pause",
+            "analyze",
+            "vacuum_pages",
+            "prune_datastreams_days",
+            "retention",
+        ):
+            if k in cfg:
+                setattr(self, k, cfg[k])
+
+    def start(self):
+        if not self.enabled or (self._thread and self._thread.is_alive()):
+            return
+
+        self._stop_evt = Event()
+        self._thread = Thread(target=self._loop, name="Maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        if self._stop_evt:
+            self._stop_evt.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def run(self, now_ns=None):
+        """
+        run all maintenance jobs once
+
+        :param now_ns: reference time for retention. defaults to now
+        :return: report dict
+        """
+        if now_ns is None:
+            now_ns = time.time_ns()
+
+        st = time.perf_counter()
+        report = {"deleted": {}, "timings": {}}
+        size_before, used_before = self._database_size()
+
+        jst = time.perf_counter()
+        for rule in self.retention:
+            for table, n in self._apply_rule(rule, now_ns).items():
+                report["deleted"][table] = report["deleted"].get(table, 0) + n
+        report["timings"]["retention"] = time.perf_counter() - jst
+
+        archive = self.dbclient.archive
+        if archive.enabled and not self._stopped():
+            jst = time.perf_counter()
+            n, deleted = self._seal(archive, now_ns)
+            report["archived"] = n
+            report["deleted"]["SampleTbl"] = (
+                report["deleted"].get("SampleTbl", 0) + deleted
+            )
+            report["timings"]["archive"] = time.perf_counter() - jst
+
+        if self.prune_datastreams_days:
+            jst = time.perf_counter()
+            cutoff = now_ns - int(self.prune_datastreams_days * DAY * NS)
+            report["deleted"]["DatastreamTbl"] = self._prune_datastreams(cutoff)
+            report["timings"]["prune_datastreams"] = time.perf_counter() - jst
+
+        if self.analyze and not self._stopped():
+            jst = time.perf_counter()
+            self._execute("ANALYZE")
+            report["timings"]["analyze"] = time.perf_counter() - jst
+
+        if self.vacuum_pages and not self._stopped():
+            jst = time.perf_counter()
+            self._incremental_vacuum(self.vacuum_pages)
+            report["timings"]["vacuum"] = time.perf_counter() - jst
+
+        size_after, used_after = self._database_size()
+        report["size_before"] = size_before
+        report["size_after"] = size_after
+        # bytes returned to the filesystem and bytes freed for reuse inside the file
+        report["reclaimed"] = size_before - size_after
+        report["freed"] = used_before - used_after
+        report["elapsed"] = time.perf_counter() - st
+
+        self.last_report = report
+        self.info(
+            f"maintenance deleted={report['deleted']} reclaimed={report['reclaimed']} bytes "
+            f"freed={report['freed']} bytes "
+            f"elapsed={report['elapsed']:0.3f}s"
+        )
+        return report
+
+    # private
+    def _loop(self):
+        while not self._stop_evt.wait(self.interval):
+            try:
+                self.run()
+            except BaseException:
+                self.debug_exception()
+
+    def _stopped(self):
+        return bool(self._stop_evt and self._stop_evt.is_set())
+
+    def _apply_rule(self, rule, now_ns):
+        deleted = {}
+        dids = self._match_datastreams(rule.get("device"), rule.get("datastream"))
+        if not dids:
+            return deleted
+
+        raw_days = rule.get("raw_days")
+        if raw_days is not None:
+            cutoff = now_ns - int(raw_days * DAY * NS)
+            for table in ("SampleTbl", "EventTbl"):
+                deleted[table] = self._delete_batched(
+                    table, "t_ns < ?", dids, [cutoff], key="id"
+                )
+
+            archive = self.dbclient.archive
+            n = sum(archive.prune(did, cutoff) for did in dids)
+            if n:
+                deleted["archive"] = n
+
+        n = 0
+        for resolution, days in (rule.get("rollup_days") or {}).items():
+            cutoff = now_ns - int(days * DAY * NS)
+            n += self._delete_batched(
+                "RollupTbl",
+                "resolution = ? AND t_ns < ?",
+                dids,
+                [int(resolution), cutoff],
+                key="rowid",
+            )
+        if n:
+            deleted["RollupTbl"] = n
+        return deleted
+
+    def _match_datastreams(self, device_name, datastream_name):
+        sql = "SELECT DatastreamTbl.id FROM DatastreamTbl JOIN DeviceTbl ON DeviceTbl.id = DatastreamTbl.device_id"
+        where = []
+        params = []
+        if device_name:
+            where.append("DeviceTbl.name = ?")
+            params.append(device_name)
+        if datastream_name:
+            where.append("DatastreamTbl.name = ?")
+            params.append(datastream_name)
+        if where:
+            sql = f"{sql} WHERE {' AND '.join(where)}"
+
+        return [r[0] for r in self._fetchall(sql, params)]
+
+    def _delete_batched(self, table, where, dids, params, key="id"):
+        """
+        delete matching rows of each datastream, at most `batch_size` rows per transaction
+        """
+        total = 0
+        for did in dids:
+            while not self._stopped():
+                n = self._execute(
+                    f"DELETE FROM {table} WHERE {key} IN (SELECT {key} FROM {table} "
+                    f"WHERE datastream_id = ? AND {where} LIMIT ?)",
+                    [did] + params + [self.batch_size],
+                )
+                total += n
+                if n < self.batch_size:
+                    break
+                time.sleep(self.batch_pause)
+        return total
+
+    def _seal(self, archive, now_ns):
+        """
+        move sealed samples from SampleTbl to the archive
+
+        :return: (rows archived, rows deleted from SampleTbl)
+        """
+        day = DAY * NS
+        today = now_ns - now_ns % day
+        active = set(self.dbclient.catalog.get_datastream_ids())
+        dids = [
+            r[0] for r in self._fetchall("SELECT DISTINCT datastream_id FROM SampleTbl")
+        ]
+
+        archived = deleted = 0
+        for did in dids:
+            if self._stopped():
+                break
+
+            # rows at or before the archived range arrived late, from the spool or an import, or are leftovers of
+            # an interrupted run. merge them into the archive before deleting them
+            sealed = archive.sealed_until(did)
+            if sealed is not None:
+                with self._snapshot() as conn:
+                    max_id, chunks = self._read_samples(
+                        conn, did, "t_ns <= ?", [sealed], archive.chunk_size
+                    )
+                    for a in chunks:
+                        archived += archive.merge(did, a["t_ns"], a["value"])
+                if max_id is not None:
+                    deleted += self._delete_batched(
+                        "SampleTbl", "t_ns <= ? AND id <= ?", [did], [sealed, max_id]
+                    )
+
+            where = []
+            params = []
+            if sealed is not None:
+                where.append("t_ns > ?")
+                params.append(sealed)
+            if did in active:
+                where.append("t_ns < ?")
+                params.append(today)
+
+            with self._snapshot() as conn:
+                max_id, chunks = self._read_samples(
+                    conn, did, " AND ".join(where) or "1", params, archive.chunk_size
+                )
+                for a in chunks:
+                    archive.append(did, a["t_ns"], a["value"])
+                    archived += len(a)
+            if max_id is not None:
+                # deleted only once the archive index is written
+                deleted += self._delete_batched(
+                    "SampleTbl",
+                    "t_ns <= ? AND id <= ?",
+                    [did],
+                    [archive.sealed_until(did), max_id],
+                )
+        return archived, deleted
+
+    @contextmanager
+    def _snapshot(self):
+        """
+        a read-only connection inside one read transaction, so every query on it sees the same snapshot
+        """
+        with self.dbclient.raw_connection(readonly=True) as conn:
+            conn.execute("BEGIN")
+            try:
+                yield conn
+            finally:
+                conn.rollback()
+
+    def _read_samples(self, conn, did, where, params, chunk_size):
+        """
+        the matching samples of a datastream in time order. call on a snapshot connection
+
+        :return: (largest id read or None, iterator of CHUNK_DTYPE arrays). rows committed after the snapshot have
+            larger ids, so deleting up to this id never deletes a row that was not read
+        """
+        sql = f"FROM SampleTbl WHERE datastream_id = ? AND {where}"
+        (max_id,) = conn.execute(f"SELECT MAX(id) {sql}", [did] + params).fetchone()
+        cursor = conn.execute(f"SELECT t_ns, value {sql} ORDER BY t_ns", [did] + params)
+
+        def chunks():
+            while rows := cursor.fetchmany(chunk_size):
+                yield array(rows, dtype=CHUNK_DTYPE)
+
+        return max_id, chunks()
+
+    def _prune_datastreams(self, cutoff_ns):
+        """
+        delete datastreams that hold no data, in SQLite or the archive, were created before the cutoff and are not
+        the active datastream of any device. every scan start creates a datastream so these accumulate
+        """
+        active = set(self.dbclient.catalog.get_datastream_ids())
+        rows = self._fetchall(
+            "SELECT id FROM DatastreamTbl WHERE create_date < datetime(?, 'unixepoch') "
+            "AND NOT EXISTS (SELECT 1 FROM SampleTbl WHERE datastream_id = DatastreamTbl.id) "
+            "AND NOT EXISTS (SELECT 1 FROM EventTbl WHERE datastream_id = DatastreamTbl.id) "
+            "AND NOT EXISTS (SELECT 1 FROM RollupTbl WHERE datastream_id = DatastreamTbl.id)",
+            [cutoff_ns // NS],
+        )
+        archive = self.dbclient.archive
+        dids = [
+            r[0]
+            for r in rows
+            if r[0] not in active and not archive.get_index(r[0])["count"].sum()
+        ]
+        n = 0
+        for i in range(0, len(dids), self.batch_size):
+            chunk = dids[i : i + self.batch_size]
+            marks = ",".join("?" * len(chunk))
+            n += self._execute(
+                f"DELETE FROM DatastreamTbl WHERE id IN ({marks})", chunk
+            )
+
+        # the archive directory of a datastream whose samples were all retired by retention
+        for did in dids:
+            archive.remove(did)
+        return n
+
+    def _incremental_vacuum(self, pages):
+        with self.dbclient.raw_connection() as conn:
+            mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+            if mode != 2:
+                self.debug(
+                    "incremental vacuum unavailable. auto_vacuum is not INCREMENTAL for this database"
+                )
+                return
+            # executescript steps the pragma to completion. execute only frees a single page
+            conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+
+    def _database_size(self):
+        """
+        :return: (file size, bytes in use) of the main database
+        """
+        with self.dbclient.raw_connection() as conn:
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size, (page_count - freelist) * page_size
+
+    def _execute(self, sql, params=()):
+        with self.dbclient.raw_connection() as conn:
+            cursor = conn.execute(sql, params)
+            n = cursor.rowcount
+            conn.commit()
+            return n
+
+    def _fetchall(self, sql, params=()):
+        with self.dbclient.raw_connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+
+# ============= EOF =============================================
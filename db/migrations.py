@@ -0,0 +1,174 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import time
+
+from sqlalchemy import inspect, text
+
+from db.rollup import RESOLUTIONS, NS
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """
+    register a schema migration. migrations are applied in order of version to any database whose
+    `user_version` is lower than `version`. each migration runs in its own transaction
+    """
+
+    def dec(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+
+    return dec
+
+
+def has_table(connection, name):
+    return inspect(connection).has_table(name)
+
+
+def latest_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def get_version(connection):
+    return connection.execute(text("PRAGMA user_version")).scalar()
+
+
+def set_version(connection, version):
+    connection.execute(text(f"PRAGMA user_version={int(version)}"))
+
+
+def pending_migrations(engine):
+    """
+    migrations that would be applied to an existing database
+    """
+    with engine.connect() as connection:
+        if not inspect(connection).get_table_names():
+            return []
+        version = get_version(connection)
+    return [m for m in MIGRATIONS if m[0] > version]
+
+
+def migrate(engine, metadata):
+    """
+    bring the database at `engine` up to the latest schema version.
+
+    a new database is created from `metadata` and stamped with the latest version. an existing database is
+    migrated in place one version at a time
+
+    :return: dict report with the start and end versions, the migrations applied and the elapsed time
+    """
+    st = time.perf_counter()
+    with engine.begin() as connection:
+        version = get_version(connection)
+        new = version == 0 and not inspect(connection).get_table_names()
+        if new:
+            metadata.create_all(bind=connection)
+            set_version(connection, latest_version())
+
+    report = {"from_version": version, "created": new, "applied": []}
+    if not new:
+        for v, description, func in MIGRATIONS:
+            if v <= version:
+                continue
+
+            mst = time.perf_counter()
+            with engine.begin() as connection:
+                func(connection, metadata)
+                set_version(connection, v)
+            report["applied"].append((v, description, time.perf_counter() - mst))
+
+    report["to_version"] = latest_version() if new else max(version, latest_version())
+    report["elapsed"] = time.perf_counter() - st
+    return report
+
+
+# migrations
+@migration(1, "baseline schema")
+def _baseline(connection, metadata):
+    metadata.create_all(bind=connection)
+
+
+@migration(2, "add measurement and datastream lookup indexes")
+def _lookup_indexes(connection, metadata):
+    if has_table(connection, "MeasurementTbl"):
+        connection.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS ix_measurement_datastream_timestamp "
+                "ON MeasurementTbl (datastream_id, timestamp)"
+            )
+        )
+    connection.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_datastream_device_name_id "
+            "ON DatastreamTbl (device_id, name, id)"
+        )
+    )
+
+
+@migration(3, "move measurements to nanosecond SampleTbl and EventTbl")
+def _samples_events(connection, metadata):
+    for name in ("SampleTbl", "EventTbl"):
+        metadata.tables[name].create(bind=connection, checkfirst=True)
+
+    if has_table(connection, "MeasurementTbl"):
+        # MeasurementTbl.timestamp is an SQLite datetime string with one second resolution
+        t_ns = "CAST(ROUND((julianday(timestamp) - 2440587.5) * 86400000) AS INTEGER) * 1000000"
+        connection.execute(
+            text(
+                f"INSERT INTO SampleTbl (datastream_id, t_ns, value) "
+                f"SELECT datastream_id, {t_ns}, value FROM MeasurementTbl "
+                f"WHERE value IS NOT NULL AND value_string IS NULL ORDER BY id"
+            )
+        )
+        connection.execute(
+            text(
+                f"INSERT INTO EventTbl (datastream_id, t_ns, value_string) "
+                f"SELECT datastream_id, {t_ns}, value_string FROM MeasurementTbl "
+                f"WHERE value_string IS NOT NULL ORDER BY id"
+            )
+        )
+        connection.execute(text("DROP TABLE MeasurementTbl"))
+
+
+@migration(4, "add RollupTbl and backfill it from SampleTbl")
+def _rollups(connection, metadata):
+    metadata.tables["RollupTbl"].create(bind=connection, checkfirst=True)
+    for r in RESOLUTIONS:
+        connection.execute(
+            text(
+                "INSERT OR REPLACE INTO RollupTbl (datastream_id, resolution, t_ns, count, min_value, max_value, "
+                "total, first_t_ns, first_value, last_t_ns, last_value) "
+                "SELECT g.datastream_id, :r, g.b, g.n, g.vmin, g.vmax, g.total, "
+                "g.ft, (SELECT s.value FROM SampleTbl s WHERE s.datastream_id = g.datastream_id "
+                "AND s.t_ns = g.ft ORDER BY s.id LIMIT 1), "
+                "g.lt, (SELECT s.value FROM SampleTbl s WHERE s.datastream_id = g.datastream_id "
+                "AND s.t_ns = g.lt ORDER BY s.id DESC LIMIT 1) "
+                "FROM (SELECT datastream_id, t_ns - t_ns % :w AS b, COUNT(*) AS n, MIN(value) AS vmin, "
+                "MAX(value) AS vmax, SUM(value) AS total, MIN(t_ns) AS ft, MAX(t_ns) AS lt "
+                "FROM SampleTbl WHERE value IS NOT NULL GROUP BY datastream_id, b) g"
+            ),
+            {"r": r, "w": r * NS},
+        )
+
+
+@migration(5, "add CalibrationTbl")
+def _calibrations(connection, metadata):
+    metadata.tables["CalibrationTbl"].create(bind=connection, checkfirst=True)
+
+
+# ============= EOF =============================================
@@ -0,0 +1,172 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+from numpy import (
+    add,
+    argsort,
+    array,
+    column_stack,
+    diff,
+    flatnonzero,
+    float64,
+    int64,
+    maximum,
+    minimum,
+    r_,
+)
+
+# bucket widths in seconds
+RESOLUTIONS = (1, 60, 3600)
+NS = 1000000000
+
+ROLLUP_DTYPE = [
+    ("t_ns", int64),
+    ("count", int64),
+    ("min_value", float64),
+    ("max_value", float64),
+    ("mean", float64),
+    ("first_value", float64),
+    ("last_value", float64),
+]
+
+
+def aggregate(samples, resolutions=RESOLUTIONS):
+    """
+    aggregate a batch of samples into rollup rows, one per (datastream, resolution, bucket).
+
+    the rows are partial aggregates meant to be merged into RollupTbl with an upsert so rollups are maintained
+    incrementally as samples are ingested
+
+    :param samples: list of dicts with datastream_id, t_ns and value
+    :return: list of RollupTbl row dicts
+    """
+    aggs = {}
+    for s in samples:
+        did, t, v = s["datastream_id"], s["t_ns"], s["value"]
+        for r in resolutions:
+            w = r * NS
+            key = (did, r, t - t % w)
+            a = aggs.get(key)
+            if a is None:
+                aggs[key] = [1, v, v, v, t, v, t, v]
+            else:
+                a[0] += 1
+                if v < a[1]:
+                    a[1] = v
+                if v > a[2]:
+                    a[2] = v
+                a[3] += v
+                if t < a[4]:
+                    a[4], a[5] = t, v
+                if t >= a[6]:
+                    a[6], a[7] = t, v
+
+    return [
+        {
+            "datastream_id": did,
+            "resolution": r,
+            "t_ns": t,
+            "count": a[0],
+            "min_value": a[1],
+            "max_value": a[2],
+            "total": a[3],
+            "first_t_ns": a[4],
+            "first_value": a[5],
+            "last_t_ns": a[6],
+            "last_value": a[7],
+        }
+        for (did, r, t), a in aggs.items()
+    ]
+
+
+def aggregate_arrays(did, t, v, resolutions=RESOLUTIONS):
+    """
+    vectorized `aggregate` for the samples of a single datastream
+
+    :param t: int64 t_ns array
+    :param v: float64 value array
+    :return: list of RollupTbl row dicts
+    """
+    if not len(t):
+        return []
+
+    order = argsort(t, kind="stable")
+    t, v = t[order], v[order]
+
+    rows = []
+    for r in resolutions:
+        w = r * NS
+        b = t - t % w
+        start = r_[0, flatnonzero(diff(b)) + 1]
+        end = r_[start[1:], len(t)] - 1
+        count = end - start + 1
+        mins = minimum.reduceat(v, start)
+        maxs = maximum.reduceat(v, start)
+        totals = add.reduceat(v, start)
+        rows.extend(
+            {
+                "datastream_id": did,
+                "resolution": r,
+                "t_ns": bt,
+                "count": n,
+                "min_value": mn,
+                "max_value": mx,
+                "total": tot,
+                "first_t_ns": ft,
+                "first_value": fv,
+                "last_t_ns": lt,
+                "last_value": lv,
+            }
+            for bt, n, mn, mx, tot, ft, fv, lt, lv in zip(
+                b[start].tolist(),
+                count.tolist(),
+                mins.tolist(),
+                maxs.tolist(),
+                totals.tolist(),
+                t[start].tolist(),
+                v[start].tolist(),
+                t[end].tolist(),
+                v[end].tolist(),
+            )
+        )
+    return rows
+
+
+def pick_resolution(span_ns, nbuckets, resolutions=RESOLUTIONS):
+    """
+    the coarsest rollup resolution that is still at least as fine as a bucket of `span_ns / nbuckets`.
+
+    :return: resolution in seconds or None if raw samples are needed
+    """
+    width = span_ns / max(nbuckets, 1)
+    rs = [r for r in resolutions if r * NS <= width]
+    return max(rs) if rs else None
+
+
+def envelope(rollups, resolution):
+    """
+    convert rollup rows to min/max points placed at the middle of each bucket, suitable for min/max downsampling
+    """
+    mid = rollups["t_ns"] + resolution * NS // 2
+    t = column_stack((mid, mid)).ravel()
+    v = column_stack((rollups["min_value"], rollups["max_value"])).ravel()
+    return t, v
+
+
+def to_array(rows):
+    return array(rows, dtype=ROLLUP_DTYPE)
+
+
+# ============= EOF =============================================
@@ -0,0 +1,243 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import math
+import os
+import struct
+import zlib
+from pathlib import Path
+from threading import Lock
+
+from traits.api import Bool, Int, Str
+
+from db.db import SampleTbl, split_measurement
+from loggable import Loggable
+from paths import paths
+
+# t_ns, value, device name, datastream name, value_string, crc32
+RECORD = struct.Struct("<qd32s32s140sI")
+BODY = struct.Struct("<qd32s32s140s")
+
+# value_string of a datastream creation. the value is `unique`
+DATASTREAM = b"\x01datastream"
+
+
+def pack(name, device_name, kw):
+    """
+    :param kw: measurement kw, or {"datastream": True, "unique": bool, "t_ns": int} for a datastream creation
+    :return: a spool record or None if it cannot be spooled
+    """
+    n, d = name.encode(), device_name.encode()
+    if len(n) > 32 or len(d) > 32:
+        return
+
+    if kw.get("datastream"):
+        text, value = DATASTREAM, float(bool(kw.get("unique")))
+    else:
+        table, value = split_measurement(kw)
+        if table is None:
+            return
+
+        if table is SampleTbl:
+            text = b""
+        else:
+            text = value.encode()[:140]
+            value = math.nan
+
+    body = BODY.pack(int(kw["t_ns"]), value, d, n, text)
+    return body + struct.pack("<I", zlib.crc32(body))
+
+
+def unpack(record):
+    """
+    :return: (name, device_name, kw) or None if the record fails its CRC
+    """
+    t_ns, value, d, n, text, crc = RECORD.unpack(record)
+    if zlib.crc32(record[: BODY.size]) != crc:
+        return
+
+    kw = {"t_ns": t_ns}
+    text = text.rstrip(b"\0")
+    if text == DATASTREAM:
+        kw["datastream"] = True
+        kw["unique"] = bool(value)
+    elif text:
+        kw["value_string"] = text.decode(errors="replace")
+    else:
+        kw["value"] = value
+    return n.rstrip(b"\0").decode(), d.rstrip(b"\0").decode(), kw
+
+
+class Spool(Loggable):
+    """
+    Append-only write-ahead spool for measurements the database cannot take right now. Datastream creations are
+    spooled in line with the measurements so replay keeps them in order.
+
+    Records are fixed size, `RECORD.size` bytes, each with a CRC32 so a torn or corrupt record is detected and
+    skipped on replay. The replay position is kept in a `.offset` file next to the spool. Once everything has
+    been replayed the spool is truncated.
+
+    Replay is at-least-once. A crash between a replayed batch being committed and the offset being written replays
+    that batch again.
+
+    init.yml
+
+    database:
+      writer:
+        spool:
+          enabled: true
+          path: ~/laba/spool/measurements.spool
+          max_bytes: 1073741824
+          fsync: false
+    """
+
+    path = Str
+    enabled = Bool(True)
+    max_bytes = Int(1 << 30)
+    fsync = Bool(False)
+
+    ncorrupt = Int
+
+    def __init__(self, cfg=None, *args, **kw):
+        super().__init__(cfg, *args, **kw)
+        cfg = self.configobj
+        for k in ("enabled", "path", "max_bytes", "fsync"):
+            if k in cfg:
+                setattr(self, k, cfg[k])
+
+        if not self.path:
+            self.path = str(Path(paths.root, "spool", "measurements.spool"))
+        self.path = str(Path(self.path).expanduser())
+
+        self._lock = Lock()
+        self._recover()
+
+    def append(self, items):
+        """
+        :param items: list of (name, device_name, kw)
+        :return: number of measurements spooled
+        """
+        if not self.enabled:
+            return 0
+
+        records = [r for r in (pack(*item) for item in items) if r]
+        if not records:
+            return 0
+
+        with self._lock:
+            if self._size() + len(records) * RECORD.size > self.max_bytes:
+                self.warning(f"spool full. {self.path}")
+                return 0
+
+            with open(self.path, "ab") as wfile:
+                wfile.write(b"".join(records))
+                wfile.flush()
+                if self.fsync:
+                    os.fsync(wfile.fileno())
+        return len(records)
+
+    def pending(self):
+        """
+        number of records not yet replayed
+        """
+        with self._lock:
+            return (self._size() - self._get_offset()) // RECORD.size
+
+    def read(self, n):
+        """
+        read up to `n` records from the replay position. a datastream creation is read on its own, so a replay
+        that fails part way never makes it twice
+
+        :return: (items, offset). pass `offset` to `commit` once the items are in the database
+        """
+        with self._lock:
+            offset = self._get_offset()
+            size = self._size()
+        if offset >= size:
+            return [], offset
+
+        with open(self.path, "rb") as rfile:
+            rfile.seek(offset)
+            buf = rfile.read(min(n * RECORD.size, size - offset))
+
+        items = []
+        end = offset + len(buf) // RECORD.size * RECORD.size
+        for i in range(0, len(buf) - RECORD.size + 1, RECORD.size):
+            item = unpack(buf[i : i + RECORD.size])
+            if item is None:
+                self.ncorrupt += 1
+                self.warning(f"skipping corrupt spool record at {offset + i}")
+            elif item[2].get("datastream"):
+                if items:
+                    end = offset + i
+                else:
+                    items.append(item)
+                    end = offset + i + RECORD.size
+                break
+            else:
+                items.append(item)
+        return items, end
+
+    def commit(self, offset):
+        """
+        mark everything before `offset` as replayed. truncates the spool once it is fully replayed
+        """
+        with self._lock:
+            if offset >= self._size():
+                with open(self.path, "wb"):
+                    pass
+                offset = 0
+            self._set_offset(offset)
+
+    # private
+    def _recover(self):
+        """
+        drop a partial record left at the end of the spool by a crash mid-write
+        """
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        size = self._size()
+        if size % RECORD.size:
+            self.warning(f"truncating torn record at the end of {self.path}")
+            with open(self.path, "r+b") as wfile:
+                wfile.truncate(size - size % RECORD.size)
+
+        n = self.pending()
+        if n:
+            self.info(f"{n} spooled measurements waiting to be replayed")
+
+    def _size(self):
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def _offset_path(self):
+        return f"{self.path}.offset"
+
+    def _get_offset(self):
+        try:
+            with open(self._offset_path(), "r") as rfile:
+                return int(rfile.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _set_offset(self, offset):
+        tmp = f"{self._offset_path()}.tmp"
+        with open(tmp, "w") as wfile:
+            wfile.write(str(offset))
+        os.replace(tmp, self._offset_path())
+
+
+# ============= EOF =============================================
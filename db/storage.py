@@ -0,0 +1,138 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+from traits.api import HasTraits, Str, Int, Dict
+
+PRAGMAS = (
+    "journal_mode",
+    "synchronous",
+    "cache_size",
+    "mmap_size",
+    "busy_timeout",
+    "auto_vacuum",
+)
+SETTINGS = PRAGMAS + ("readers",)
+
+
+class StorageProfile(HasTraits):
+    """
+    SQLite storage settings for the recorder database.
+
+    The writer engine owns a single connection so all writes are serialized in-process. Readers get their own
+    pool of read-only connections which, with the WAL journal, never block the writer.
+
+    init.yml
+
+    database:
+      storage:
+        journal_mode: wal
+        auto_vacuum: incremental
+        synchronous: normal
+        cache_size: -16000
+        mmap_size: 67108864
+        busy_timeout: 5000
+        readers: 4
+    """
+
+    journal_mode = Str("wal")
+    # only takes effect on a new database or after a full VACUUM
+    auto_vacuum = Str("incremental")
+    synchronous = Str("normal")
+    # negative values are KiB, positive values are pages
+    cache_size = Int(-16000)
+    mmap_size = Int(64 * 1024 * 1024)
+    # milliseconds
+    busy_timeout = Int(5000)
+    readers = Int(4)
+
+    # settings reported by the database after the writer connection was configured
+    in_effect = Dict
+
+    def __init__(self, cfg=None, *args, **kw):
+        super().__init__(*args, **kw)
+        if cfg:
+            self.trait_set(**{k: v for k, v in cfg.items() if k in SETTINGS})
+
+    def create_writer_engine(self, path):
+        engine = create_engine(
+            f"sqlite:///{path}",
+            poolclass=QueuePool,
+            pool_size=1,
+            max_overflow=0,
+            connect_args={
+                "timeout": self.busy_timeout / 1000,
+                "check_same_thread": False,
+            },
+        )
+        event.listen(engine, "connect", self._configure_writer)
+        return engine
+
+    def create_reader_engine(self, path):
+        engine = create_engine(
+            f"sqlite:///file:{path}?mode=ro&uri=true",
+            poolclass=QueuePool,
+            pool_size=self.readers,
+            max_overflow=0,
+            connect_args={
+                "timeout": self.busy_timeout / 1000,
+                "check_same_thread": False,
+            },
+        )
+        event.listen(engine, "connect", self._configure_reader)
+        return engine
+
+    def query_settings(self, dbapi_connection):
+        cursor = dbapi_connection.cursor()
+        try:
+            settings = {}
+            for p in PRAGMAS:
+                cursor.execute(f"PRAGMA {p}")
+                settings[p] = cursor.fetchone()[0]
+            return settings
+        finally:
+            cursor.close()
+
+    def _configure_writer(self, dbapi_connection, connection_record):
+        self._execute(
+            dbapi_connection,
+            f"PRAGMA auto_vacuum={self.auto_vacuum}",
+            f"PRAGMA journal_mode={self.journal_mode}",
+            f"PRAGMA synchronous={self.synchronous}",
+            *self._common_pragmas(),
+        )
+        self.in_effect = self.query_settings(dbapi_connection)
+
+    def _configure_reader(self, dbapi_connection, connection_record):
+        self._execute(dbapi_connection, "PRAGMA query_only=1", *self._common_pragmas())
+
+    def _common_pragmas(self):
+        return (
+            f"PRAGMA cache_size={self.cache_size}",
+            f"PRAGMA mmap_size={self.mmap_size}",
+            f"PRAGMA busy_timeout={self.busy_timeout}",
+        )
+
+    def _execute(self, dbapi_connection, *statements):
+        cursor = dbapi_connection.cursor()
+        try:
+            for s in statements:
+                cursor.execute(s)
+        finally:
+            cursor.close()
+
+
+# ============= EOF =============================================
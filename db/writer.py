@@ -0,0 +1,413 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import time
+from collections import deque
+from queue import Queue, Full, Empty
+from threading import Thread, Event, Lock
+
+from traits.api import Any, Int, Float, Instance
+
+from db.spool import Spool
+from loggable import Loggable
+
+MEASUREMENT = "measurement"
+DATASTREAM = "datastream"
+FLUSH = "flush"
+STOP = "stop"
+
+
+class MeasurementWriter(Loggable):
+    """
+    Asynchronous group-commit writer for measurements.
+
+    Device updates are put on a bounded queue and drained by a single background thread that inserts them in
+    batches. A batch is committed when it reaches `batch_size` items or when `commit_interval` seconds have
+    elapsed since its first item, whichever comes first.
+
+    Measurements that cannot be written go to the write-ahead `spool` instead of being lost: measurements that
+    arrive while the queue is full, and batches whose commit fails, e.g. because the database is locked. After a
+    failed commit new batches go straight to the spool for `retry_interval` seconds so the queue keeps draining.
+    The spool is replayed into the database in batches of `replay_batch_size`, one batch after every successful
+    commit and whenever the queue is idle, so it drains under continuous acquisition too.
+
+    Spooled measurements are replayed into the newest datastream of their name. A datastream creation that
+    arrives while anything is spooled, or that fails, is therefore spooled too, and the measurements of that
+    datastream follow it through the spool until the spool has been replayed.
+
+    init.yml
+
+    database:
+      writer:
+        batch_size: 500
+        commit_interval: 1.0
+        queue_size: 10000
+        retry_interval: 5.0
+        replay_batch_size: 5000
+        spool:
+          enabled: true
+    """
+
+    dbclient = Any
+
+    batch_size = Int(500)
+    commit_interval = Float(1.0)
+    queue_size = Int(10000)
+    retry_interval = Float(5.0)
+    replay_batch_size = Int(5000)
+    spool = Instance(Spool)
+
+    # counters
+    nqueued = Int
+    nwritten = Int
+    ndropped = Int
+    nspooled = Int
+    nreplayed = Int
+    ncommits = Int
+    last_commit_latency = Float
+    max_commit_latency = Float
+    total_commit_latency = Float
+
+    _queue = None
+    _thread = None
+    _retry_at = 0
+    _replay = False
+
+    def __init__(self, cfg=None, *args, **kw):
+        super().__init__(cfg, *args, **kw)
+        cfg = self.configobj
+        self.batch_size = cfg.get("batch_size", self.batch_size)
+        self.commit_interval = cfg.get("commit_interval", self.commit_interval)
+        self.queue_size = cfg.get("queue_size", self.queue_size)
+        self.retry_interval = cfg.get("retry_interval", self.retry_interval)
+        self.replay_batch_size = cfg.get("replay_batch_size", self.replay_batch_size)
+        self._queue = Queue(maxsize=self.queue_size)
+        self._lock = Lock()
+        # items waiting behind a full queue, see add_datastream
+        self._overflow = deque()
+        # datastream creations not yet handled by the writer thread
+        self._ndatastreams = 0
+        # (device_name, name) of datastreams whose creation is in the spool
+        self._spooled_streams = set()
+        if self.spool is None:
+            self.spool = Spool(cfg.get("spool"))
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._thread = Thread(target=self._run, name="MeasurementWriter", daemon=True)
+        self._thread.start()
+
+    def add_measurement(self, name, device_name, **kw):
+        """
+        queue a measurement. never blocks the caller. if the queue is full the measurement is spooled, or dropped
+        and counted in `ndropped` if it cannot be spooled either
+
+        :param name: datastream name
+        :param device_name:
+        :param kw: measurement values. `t_ns` is the acquisition time in epoch nanoseconds, defaults to now
+        :return: True if the measurement was queued
+        """
+        if "t_ns" not in kw:
+            kw["t_ns"] = time.time_ns()
+
+        item = (MEASUREMENT, name, device_name, kw)
+        with self._lock:
+            if self._put(item):
+                self.nqueued += 1
+                return True
+
+            # a datastream creation is still waiting. the measurement must stay behind it
+            ordered = bool(self._overflow or self._ndatastreams)
+            if ordered and len(self._overflow) < self.queue_size:
+                self._overflow.append(item)
+                self.nqueued += 1
+                return True
+
+        if not ordered and self.spool.append([(name, device_name, kw)]):
+            self.nspooled += 1
+            self._replay = True
+            return True
+
+        self.ndropped += 1
+        self.warning(f"writer queue full. dropped measurement {device_name}.{name}")
+        return False
+
+    def add_datastream(self, name, device_name, unique=False):
+        """
+        queue the creation of a datastream so that it is ordered with respect to the measurements around it. never
+        blocks the caller.
+
+        if the queue is full the creation, and everything added after it, wait in memory behind the queue until
+        the writer thread gets to them. only the writer thread decides whether a creation is made or spooled, so
+        no measurement is written to the wrong side of it
+        """
+        with self._lock:
+            self._ndatastreams += 1
+            self._put(
+                (DATASTREAM, name, device_name, {"unique": unique}), overflow=True
+            )
+
+    def flush(self, timeout=None):
+        """
+        block until everything queued before this call has been committed
+
+        :return: True if the flush completed within `timeout`
+        """
+        if not self.is_alive():
+            return True
+
+        evt = Event()
+        with self._lock:
+            self._put((FLUSH, None, None, evt), overflow=True)
+        return evt.wait(timeout)
+
+    def close(self, timeout=None):
+        """
+        commit any pending measurements and stop the writer thread
+        """
+        if not self.is_alive():
+            return
+
+        with self._lock:
+            self._put((STOP, None, None, None), overflow=True)
+        self._thread.join(timeout)
+        self.info(
+            f"writer closed. written={self.nwritten} dropped={self.ndropped} commits={self.ncommits} "
+            f"spooled={self.nspooled} replayed={self.nreplayed}"
+        )
+
+    def is_alive(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    @property
+    def mean_commit_latency(self):
+        if self.ncommits:
+            return self.total_commit_latency / self.ncommits
+        return 0
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "queued": self.nqueued,
+            "written": self.nwritten,
+            "dropped": self.ndropped,
+            "spooled": self.nspooled,
+            "replayed": self.nreplayed,
+            "spool_pending": self.spool.pending(),
+            "commits": self.ncommits,
+            "last_commit_latency": self.last_commit_latency,
+            "mean_commit_latency": self.mean_commit_latency,
+            "max_commit_latency": self.max_commit_latency,
+        }
+
+    # private
+    def _put(self, item, overflow=False):
+        """
+        queue `item` unless the queue is full or items are already waiting in the overflow. call with the lock held
+
+        :param overflow: append to the overflow instead of failing
+        :return: True if the item was queued
+        """
+        if not self._overflow:
+            try:
+                self._queue.put_nowait(item)
+                return True
+            except Full:
+                pass
+
+        if overflow:
+            self._overflow.append(item)
+        return False
+
+    def _get(self, timeout):
+        """
+        the next item. the queue first, then the overflow, which only fills once the queue is full
+        """
+        with self._lock:
+            try:
+                return self._queue.get_nowait()
+            except Empty:
+                if self._overflow:
+                    return self._overflow.popleft()
+        return self._queue.get(timeout=timeout)
+
+    def _run(self):
+        # whatever a previous run left in the spool goes first
+        while self.spool.pending() and self._replay_spool():
+            pass
+
+        batch = []
+        deadline = None
+        self._replay = self.spool.pending() > 0
+        while True:
+            if batch:
+                timeout = max(0, deadline - time.monotonic())
+            elif self._replay:
+                timeout = self.commit_interval
+            else:
+                timeout = None
+
+            try:
+                kind, name, device_name, payload = self._get(timeout)
+            except Empty:
+                if batch:
+                    self._commit(batch)
+                    batch = []
+                else:
+                    self._replay_spool()
+                continue
+
+            if kind == MEASUREMENT:
+                if not batch:
+                    deadline = time.monotonic() + self.commit_interval
+                batch.append((name, device_name, payload))
+                if len(batch) >= self.batch_size:
+                    self._commit(batch)
+                    batch = []
+                continue
+
+            # any control item forces the pending batch out first to preserve ordering
+            self._commit(batch)
+            batch = []
+
+            if kind == DATASTREAM:
+                self._add_datastream(name, device_name, payload)
+                with self._lock:
+                    self._ndatastreams -= 1
+            elif kind == FLUSH:
+                payload.set()
+            elif kind == STOP:
+                break
+
+    def _add_datastream(self, name, device_name, payload):
+        """
+        create a datastream, or spool the creation if anything is waiting in the spool or the database is failing.
+        spooled measurements are replayed into the newest datastream of their name, so the creation has to wait
+        its turn behind them. the measurements of that datastream then follow it through the spool until the
+        spool is replayed
+        """
+        if (
+            self._spooled_streams
+            or self.spool.pending()
+            or time.monotonic() < self._retry_at
+        ):
+            self._spool_datastream(name, device_name, payload)
+            return
+
+        try:
+            self.dbclient.add_datastream(name, device_name, **payload)
+        except BaseException:
+            self.debug_exception()
+            self._retry_at = time.monotonic() + self.retry_interval
+            self._spool_datastream(name, device_name, payload)
+
+    def _spool_datastream(self, name, device_name, payload):
+        kw = {"datastream": True, "t_ns": time.time_ns(), **payload}
+        if self.spool.append([(name, device_name, kw)]):
+            self._spooled_streams.add((device_name, name))
+            self._replay = True
+        else:
+            self.warning(
+                f"could not spool datastream {device_name}.{name}. measurements continue in the previous one"
+            )
+
+    def _commit(self, batch):
+        if self._spooled_streams:
+            held = [m for m in batch if (m[1], m[0]) in self._spooled_streams]
+            if held:
+                self._spool(held)
+                batch = [m for m in batch if (m[1], m[0]) not in self._spooled_streams]
+
+        if batch:
+            if time.monotonic() < self._retry_at:
+                self._spool(batch)
+                return
+
+            st = time.perf_counter()
+            try:
+                self.dbclient.add_measurements(batch)
+            except BaseException:
+                self.debug_exception()
+                self._retry_at = time.monotonic() + self.retry_interval
+                self._spool(batch)
+                return
+
+            et = time.perf_counter() - st
+            self.nwritten += len(batch)
+            self.ncommits += 1
+            self.last_commit_latency = et
+            self.total_commit_latency += et
+            self.max_commit_latency = max(self.max_commit_latency, et)
+
+        if self._replay:
+            self._replay_spool()
+
+    def _spool(self, batch):
+        n = self.spool.append(batch)
+        self.nspooled += n
+        self._replay = True
+        if n < len(batch):
+            self.ndropped += len(batch) - n
+            self.warning(f"dropped {len(batch) - n} measurements. could not spool")
+
+    def _replay_spool(self):
+        """
+        write one batch of spooled measurements, or one spooled datastream creation, to the database
+
+        :return: True if anything was written
+        """
+        if time.monotonic() < self._retry_at:
+            return False
+
+        items, offset = self.spool.read(self.replay_batch_size)
+        try:
+            self._write_spooled(items)
+        except BaseException:
+            self.debug_exception()
+            self._retry_at = time.monotonic() + self.retry_interval
+            return False
+
+        self.spool.commit(offset)
+        self.nreplayed += len(items)
+        if not self.spool.pending():
+            self._replay = False
+            self._spooled_streams.clear()
+            self.info(f"spool replayed. {self.nreplayed} measurements")
+        return bool(items)
+
+    def _write_spooled(self, items):
+        """
+        write spooled items in order. each datastream creation is made between the measurements around it
+        """
+        run = []
+        for name, device_name, kw in items:
+            if kw.get("datastream"):
+                if run:
+                    self.dbclient.add_measurements(run)
+                    run = []
+                self.dbclient.add_datastream(name, device_name, unique=kw["unique"])
+            else:
+                run.append((name, device_name, kw))
+        if run:
+            self.dbclient.add_measurements(run)
+
+
+# ============= EOF =============================================
@@ -53,9 +53,22 @@ class Figure(Loggable):
         if ydata is None:
             ydata = []
         plot = self.get_plot(plotid)
-        plot.data.set_data("x0", xdata)
-        plot.data.set_data("y0", ydata)
-        plot.plot(("x0", "y0"), name=name, type=type, **kw)
+        # each series needs its own data names. series sharing names share datasources
+        n = len(plot.plots)
+        xname, yname = f"x{n}", f"y{n}"
+        while xname in plot.data.arrays:
+            n += 1
+            xname, yname = f"x{n}", f"y{n}"
+
+        plot.data.set_data(xname, xdata)
+        plot.data.set_data(yname, ydata)
+        plot.plot((xname, yname), name=name, type=type, **kw)
+
+    def remove_series(self, name, plotid=0):
+        plot = self.get_plot(plotid)
+        if name in plot.plots:
+            plot.delplot(name)
+            plot.request_redraw()
 
     def add_datum(self, name, x, y, plotid=0):
         series = self.get_series(name, plotid)
@@ -79,6 +92,11 @@ class Figure(Loggable):
             #
             self.set_x_limits(l + step, h + step, plotid)
 
+    def set_data(self, name, x, y, plotid=0):
+        series = self.get_series(name, plotid)
+        series.index.set_data(x)
+        series.value.set_data(y)
+
     def clear_data(self, name=None, plotid=0):
         series = self.get_series(name, plotid)
         series.index.set_data([])
@@ -91,6 +109,13 @@ class Figure(Loggable):
     def get_plot(self, idx):
         return self.plotcontainer.components[idx]
 
+    def get_pixel_width(self, idx=0, default=1000):
+        """
+        width of the plot area in pixels. used to limit how many points are requested for a series
+        """
+        plot = self.get_plot(idx)
+        return int(plot.width) or default
+
     def set_x_limits(self, l, h, idx=0):
         plot = self.get_plot(idx)
         plot.index_range.low = l
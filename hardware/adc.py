@@ -13,13 +13,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ===============================================================================
-import itertools
-
-from numpy import polyval
+import time
+from threading import Lock
 
+from hardware.calibration import ChannelMapper, make_calibration, IDENTITY
 from hardware.device import Device
 from hardware.util import get_float
-from traits.api import HasTraits, Str, List
+from hardware.worker import LOW
+from traits.api import HasTraits, Str, List, Any
 
 # class ADC(Device):
 #     @get_float()
@@ -27,50 +28,159 @@ from traits.api import HasTraits, Str, List
 #         self.debug(f'read channel {channel}')
 #         self.driver.read_channel(channel)
 
-counter = itertools.count()
-
 
 class Channel(HasTraits):
+    """
+    an ADC or DAC channel. `mapping` is the legacy polynomial, "3,2,1" highest power first, `calibration` a
+    definition as in hardware.calibration
+    """
+
     name = Str
     address = Str
-    mapping = List
+    calibration = Any(IDENTITY)
 
     def __init__(self, *args, **kw):
-        if kw["mapping"]:
-            mapping = kw.pop("mapping")
-            self.mapping = [float(c) for c in mapping.split(",")]
-
+        mapping = kw.pop("mapping", None)
+        calibration = kw.pop("calibration", None)
         super().__init__(*args, **kw)
+        self.calibration = make_calibration(calibration or mapping)
 
     def map_value(self, v):
         """
-        return v(olts) converted to channel units
+        return v(olts) converted to channel units. a failed read (None) stays None
 
         :param v:
         :return:
         """
-        if v is None:
-            v = next(counter)
+        return self.calibration(v)
 
-        if self.mapping:
-            v = polyval(self.mapping, v)
-        return v
+    def unmap_value(self, v):
+        """
+        return the v(olts) that give the channel value `v`
+        """
+        return self.calibration.inverse(v)
 
 
 class ADC(Device):
     channels = List(Channel)
 
+    _mapper = None
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        # datastream: t_ns of the last read published to it
+        self._published = {}
+        self._publish_lock = Lock()
+
     def load(self, cfg):
         self.channels = [Channel(**ci) for ci in cfg["channels"]]
 
-    def get_value(self, idx=0, datastream="default"):
+    def calibrations(self):
+        return {c.name: c.calibration for c in self.channels}
+
+    def get_values(self, datastreams=None, priority=LOW):
+        """
+        read every channel with one driver call and map them through their calibrations together. each value is
+        published as an update and stored in the read cache
+
+        :param datastreams: one datastream name per channel. defaults to the channel names
+        :return: float64 array, one value per channel. nan for a failed read
+        """
+        channels = self.channels
+        addresses = [c.address for c in channels]
+        raw = self.io(self.driver.read_channels, addresses, priority=priority)
+        t_ns = time.time_ns()
+
+        if self._mapper is None:
+            self._mapper = ChannelMapper([c.calibration for c in channels])
+        values = self._mapper(raw)
+        self.debug(f"get values volts={raw}, values={values}")
+
+        datastreams = datastreams or [c.name for c in channels]
+        for ch, name, v in zip(channels, datastreams, values.tolist()):
+            self.cache.put(ch.address, (v, t_ns))
+            self._publish(name, v, t_ns)
+        return values
+
+    def _channels_changed(self):
+        self._mapper = None
+
+    def _channels_items_changed(self):
+        self._mapper = None
+
+    def get_value(self, idx=0, datastream="default", priority=LOW, max_age=None):
+        """
+        read a channel through the read cache. concurrent callers share one read. the shared value is published
+        once to every caller's datastream, with the time of the read
+
+        :param max_age: seconds. accept a cached value this old, defaults to the cache's max_age
+        """
         ch = self.channels[idx]
-        v = self.driver.read_channel(ch.address)
+        v, t_ns = self.cache.get(ch.address, self._read, ch, priority, max_age=max_age)
+        self._publish(datastream, v, t_ns)
+        return v
+
+    def get_value_batch(self, calls):
+        """
+        serve several get_value calls with one driver call. the channels are read together, stored in the read
+        cache and each value is published to its caller's datastream. used by the scheduler to merge the periodic
+        reads of one device
+
+        :param calls: list of (args, kw) of get_value. the highest priority of the calls is used
+        :return: list of values, one per call
+        """
+        calls = [self._get_value_args(*args, **kw) for args, kw in calls]
+        channels = list(
+            {
+                self.channels[idx].address: self.channels[idx] for idx, *_ in calls
+            }.values()
+        )
+        priority = min(c[2] for c in calls)
+        raw = self.io(
+            self.driver.read_channels, [c.address for c in channels], priority=priority
+        )
+        t_ns = time.time_ns()
+
+        values = {}
+        for ch, v in zip(channels, raw):
+            values[ch.address] = vv = ch.map_value(v)
+            self.cache.put(ch.address, (vv, t_ns))
+        self.debug(f"get value batch volts={raw}, values={list(values.values())}")
+
+        result = []
+        published = set()
+        for idx, datastream, *_ in calls:
+            address = self.channels[idx].address
+            v = values[address]
+            if (datastream, address) not in published:
+                published.add((datastream, address))
+                # several channels may share a datastream and the time of the read. each one is published
+                self._publish(datastream, v, t_ns, force=True)
+            result.append(v)
+        return result
+
+    def _get_value_args(self, idx=0, datastream="default", priority=LOW, max_age=None):
+        return idx, datastream, priority, max_age
+
+    def _read(self, ch, priority):
+        v = self.io(self.driver.read_channel, ch.address, priority=priority)
+        t_ns = time.time_ns()
         vv = ch.map_value(v)
         self.debug(f"get value volts={v}, value={vv}")
+        return vv, t_ns
+
+    def _publish(self, datastream, v, t_ns, force=False):
+        """
+        publish a read as an update of `datastream` unless it already has been
+
+        :param force: publish even if another value with the same time was
+        """
+        with self._publish_lock:
+            if not force and self._published.get(datastream) == t_ns:
+                return
+            self._published[datastream] = t_ns
 
-        self.update = {"datastream": datastream, "value": vv}
-        return vv
+        self.update = {"datastream": datastream, "value": v, "t_ns": t_ns}
 
 
 # ============= EOF =============================================
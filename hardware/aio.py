@@ -0,0 +1,88 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+the transport event loop for communicators configured with `backend: asyncio`.
+
+one daemon thread runs one asyncio loop that owns every socket and serial port of those communicators. code on
+any other thread calls into it with `run`, coroutines on the loop await `Communicator.aask` directly
+
+the communicators' own threads move onto the loop, e.g. the ethernet reconnect threads, and so does the command
+queue of every device using such a communicator, see hardware.worker.AsyncIOWorker. a device command that awaits
+`aask` runs on the loop, a plain driver call runs on the loop's executor while it waits in `run`. those executor
+threads are shared, so the thread count follows the number of commands running at once rather than the number
+of devices
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock, get_ident
+
+_lock = Lock()
+_loop = None
+_thread = None
+
+
+def get_loop():
+    """
+    the transport loop, started on first use
+    """
+    global _loop, _thread
+    with _lock:
+        if _thread is None or not _thread.is_alive():
+            _loop = asyncio.new_event_loop()
+            _loop.set_default_executor(
+                ThreadPoolExecutor(thread_name_prefix="laba.aio.executor")
+            )
+            _thread = Thread(target=_loop.run_forever, name="laba.aio", daemon=True)
+            _thread.start()
+        return _loop
+
+
+def in_loop():
+    return _thread is not None and _thread.ident == get_ident()
+
+
+def submit(coro):
+    """
+    schedule a coroutine on the transport loop
+
+    :return: concurrent.futures.Future
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def run(coro, timeout=None):
+    """
+    run a coroutine on the transport loop and wait for its result. must not be called from the loop itself
+    """
+    if in_loop():
+        coro.close()
+        raise RuntimeError("blocking call on the transport loop. await instead")
+    return submit(coro).result(timeout)
+
+
+def stop():
+    global _loop, _thread
+    with _lock:
+        if _thread is None:
+            return
+        _loop.call_soon_threadsafe(_loop.stop)
+        _thread.join()
+        _loop.close()
+        _loop = _thread = None
+
+
+# ============= EOF =============================================
@@ -0,0 +1,127 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import time
+from concurrent.futures import Future
+from threading import Lock
+
+from traits.api import Float, Int
+
+from loggable import Loggable
+
+
+class ReadCache(Loggable):
+    """
+    Read-through cache of device reads, keyed by channel.
+
+    A value younger than `max_age` seconds is returned without touching the bus. Concurrent reads of the same key
+    are single-flighted: the first caller reads, everyone arriving while that read is in flight waits for and
+    shares its result. With the default `max_age` of 0 only in-flight reads are shared, so no caller ever gets a
+    value older than its own request.
+
+    init.yml
+
+    devices:
+      - name: adc
+        kind: ADC
+        cache:
+          max_age: 0.5
+    """
+
+    max_age = Float(0)
+
+    nhits = Int
+    nmisses = Int
+    ncoalesced = Int
+
+    def __init__(self, cfg=None, *args, **kw):
+        super().__init__(cfg, *args, **kw)
+        if "max_age" in self.configobj:
+            self.max_age = self.configobj["max_age"]
+
+        self._lock = Lock()
+        self._values = {}
+        self._inflight = {}
+
+    def get(self, key, func, *args, max_age=None, **kw):
+        """
+        the cached value for `key` or the result of `func(*args, **kw)`
+
+        :param max_age: seconds. overrides the cache's max_age for this call
+        """
+        if max_age is None:
+            max_age = self.max_age
+
+        with self._lock:
+            entry = self._values.get(key)
+            if entry and max_age and time.monotonic() - entry[0] <= max_age:
+                self.nhits += 1
+                return entry[1]
+
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                self.nmisses += 1
+                future = self._inflight[key] = Future()
+            else:
+                self.ncoalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            value = func(*args, **kw)
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._values[key] = (time.monotonic(), value)
+            self._inflight.pop(key, None)
+        future.set_result(value)
+        return value
+
+    def put(self, key, value):
+        """
+        store a value read by other means, e.g. a block read of several channels
+        """
+        with self._lock:
+            self._values[key] = (time.monotonic(), value)
+
+    def invalidate(self, key=None):
+        """
+        forget `key`, or every key
+        """
+        with self._lock:
+            if key is None:
+                self._values.clear()
+            else:
+                self._values.pop(key, None)
+
+    def stats(self):
+        """
+        :return: hits, misses and coalesced reads. `saved` is the number of bus transactions avoided
+        """
+        return {
+            "hits": self.nhits,
+            "misses": self.nmisses,
+            "coalesced": self.ncoalesced,
+            "saved": self.nhits + self.ncoalesced,
+        }
+
+
+# ============= EOF =============================================
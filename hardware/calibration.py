@@ -0,0 +1,314 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+channel calibrations. a calibration maps raw readings, usually volts, to channel units and back.
+
+every calibration takes a python float, returning a float, or an array of any shape, returning a float64 array.
+a failed read (None) maps to None, nan maps to nan. `to_dict` gives the definition stored with each calibration
+version in the database, `make_calibration` builds a calibration back from it
+
+init.yml
+
+channels:
+  - name: pressure
+    address: '1'
+    mapping: 3,2,1  # polynomial, highest power first
+  - name: flow
+    address: '2'
+    calibration:
+      kind: piecewise  # or lut
+      points: [[0, 0], [5, 100], [10, 150]]
+  - name: temperature
+    address: '3'
+    calibration:
+      kind: lut
+      start: 0  # raw value of the first entry
+      step: 0.5
+      values: [0, 12.1, 24.5, 37.2]
+"""
+
+import numbers
+
+from numpy import (
+    asarray,
+    diff,
+    float64,
+    full,
+    interp,
+    linspace,
+    nan,
+    zeros,
+    arange,
+)
+
+
+class Calibration(object):
+    kind = None
+
+    def __call__(self, raw):
+        if raw is None:
+            return None
+        if isinstance(raw, numbers.Real):
+            return self._map_scalar(float(raw))
+        return self.map(raw)
+
+    def map(self, raw):
+        """
+        map an array of raw values
+        """
+        raise NotImplementedError
+
+    def inverse(self, value):
+        """
+        the raw value that maps to `value`. used to drive DACs and to re-map stored data
+        """
+        if value is None:
+            return None
+        if isinstance(value, numbers.Real):
+            return float(self._inverse(asarray([value], dtype=float64))[0])
+        return self._inverse(asarray(value, dtype=float64))
+
+    def to_dict(self):
+        raise NotImplementedError
+
+    def __eq__(self, other):
+        return isinstance(other, Calibration) and self.to_dict() == other.to_dict()
+
+    def __hash__(self):
+        return hash(repr(self.to_dict()))
+
+    def _map_scalar(self, x):
+        return float(self.map(asarray([x], dtype=float64))[0])
+
+    def _inverse(self, y):
+        raise NotImplementedError
+
+
+class Polynomial(Calibration):
+    """
+    polynomial in Horner form. `coefficients` are highest power first, as numpy.polyval
+
+    the inverse of a linear polynomial is exact. higher degrees are inverted by interpolation over `domain`, where
+    the polynomial must be monotonic
+    """
+
+    kind = "polynomial"
+
+    def __init__(self, coefficients, domain=(-10, 10)):
+        coefficients = [float(c) for c in coefficients] or [1.0, 0.0]
+        # leading zeros do not change the value, and make the inverse ill defined
+        while len(coefficients) > 1 and coefficients[0] == 0:
+            coefficients.pop(0)
+        self.coefficients = tuple(coefficients)
+        self.domain = tuple(float(d) for d in domain)
+        self._table = None
+
+    @property
+    def degree(self):
+        return len(self.coefficients) - 1
+
+    def map(self, raw):
+        x = asarray(raw, dtype=float64)
+        c = self.coefficients
+        y = full(x.shape, c[0])
+        for ci in c[1:]:
+            y *= x
+            y += ci
+        return y
+
+    def to_dict(self):
+        return {
+            "kind": self.kind,
+            "coefficients": list(self.coefficients),
+            "domain": list(self.domain),
+        }
+
+    def _map_scalar(self, x):
+        # plain python is several times faster than numpy for one value
+        y = 0.0
+        for c in self.coefficients:
+            y = y * x + c
+        return y
+
+    def _inverse(self, y):
+        c = self.coefficients
+        if self.degree == 0:
+            raise ValueError("a constant calibration has no inverse")
+        if self.degree == 1:
+            return (y - c[1]) / c[0]
+
+        if self._table is None:
+            x = linspace(*self.domain, 4097)
+            self._table = _monotonic(x, self.map(x), "polynomial")
+        return _interp_inverse(y, *self._table)
+
+
+class PiecewiseLinear(Calibration):
+    """
+    linear interpolation between (raw, value) points, raw increasing. values outside the points are clamped to
+    the end points
+    """
+
+    kind = "piecewise"
+
+    def __init__(self, points):
+        points = sorted((float(x), float(y)) for x, y in (_pair(p) for p in points))
+        if len(points) < 2:
+            raise ValueError("a piecewise calibration needs at least two points")
+
+        self.x = asarray([p[0] for p in points])
+        self.y = asarray([p[1] for p in points])
+        self._table = None
+
+    def map(self, raw):
+        return interp(asarray(raw, dtype=float64), self.x, self.y)
+
+    def to_dict(self):
+        return {
+            "kind": self.kind,
+            "points": [[x, y] for x, y in zip(self.x.tolist(), self.y.tolist())],
+        }
+
+    def _inverse(self, y):
+        if self._table is None:
+            self._table = _monotonic(self.x, self.y, "piecewise")
+        return _interp_inverse(y, *self._table)
+
+
+class LookupTable(PiecewiseLinear):
+    """
+    `values` tabulated at evenly spaced raw values `start`, `start + step`, ..., interpolated linearly
+    """
+
+    kind = "lut"
+
+    def __init__(self, values, start=0, step=1):
+        values = [float(v) for v in values]
+        self.start = float(start)
+        self.step = float(step)
+        x = self.start + self.step * arange(len(values))
+        super().__init__(zip(x.tolist(), values))
+
+    def to_dict(self):
+        return {
+            "kind": self.kind,
+            "start": self.start,
+            "step": self.step,
+            "values": self.y.tolist(),
+        }
+
+
+IDENTITY = Polynomial([1, 0])
+
+KINDS = {c.kind: c for c in (Polynomial, PiecewiseLinear, LookupTable)}
+
+
+def make_calibration(cfg):
+    """
+    build a calibration from an init.yml `mapping` string ("3,2,1"), a list of polynomial coefficients or a
+    definition dict as returned by `to_dict`. None is the identity
+    """
+    if cfg is None or cfg == "":
+        return IDENTITY
+    if isinstance(cfg, Calibration):
+        return cfg
+    if isinstance(cfg, str):
+        return Polynomial([float(c) for c in cfg.split(",")])
+    if isinstance(cfg, (list, tuple)):
+        return Polynomial(cfg)
+
+    cfg = dict(cfg)
+    kind = cfg.pop("kind", "polynomial")
+    try:
+        klass = KINDS[kind]
+    except KeyError:
+        raise ValueError(f"unknown calibration kind {kind}")
+    return klass(**cfg)
+
+
+class ChannelMapper(object):
+    """
+    maps one raw value per channel, e.g. a block read, with each channel's calibration. polynomial channels are
+    evaluated together as one zero padded coefficient matrix, the others one by one
+    """
+
+    def __init__(self, calibrations):
+        self.calibrations = list(calibrations)
+        n = len(self.calibrations)
+        self._poly = [
+            i for i, c in enumerate(self.calibrations) if isinstance(c, Polynomial)
+        ]
+        self._other = [i for i in range(n) if i not in set(self._poly)]
+
+        degree = max((self.calibrations[i].degree for i in self._poly), default=0)
+        coeffs = zeros((len(self._poly), degree + 1))
+        for row, i in enumerate(self._poly):
+            c = self.calibrations[i].coefficients
+            coeffs[row, degree + 1 - len(c) :] = c
+        self.coefficients = coeffs
+
+    def __call__(self, raw):
+        """
+        :param raw: sequence with one value per channel. None is a failed read
+        :return: float64 array, nan for failed reads
+        """
+        raw = asarray(raw, dtype=float64)
+        out = full(len(self.calibrations), nan)
+        if self._poly:
+            x = raw[self._poly]
+            c = self.coefficients
+            y = c[:, 0].copy()
+            for k in range(1, c.shape[1]):
+                y *= x
+                y += c[:, k]
+            out[self._poly] = y
+        for i in self._other:
+            out[i] = self.calibrations[i].map(raw[i : i + 1])[0]
+        return out
+
+
+def remap(values, old, new):
+    """
+    re-map values stored under calibration `old` to calibration `new`
+    """
+    return new.map(old.inverse(asarray(values, dtype=float64)))
+
+
+def _pair(p):
+    if isinstance(p, str):
+        return p.split(",")
+    return p
+
+
+def _monotonic(x, y, name):
+    """
+    :return: (y, x) sorted by y for interpolating the inverse
+    """
+    d = diff(y)
+    if (d > 0).all():
+        return y, x
+    if (d < 0).all():
+        return y[::-1], x[::-1]
+    raise ValueError(f"{name} calibration is not monotonic and has no inverse")
+
+
+def _interp_inverse(y, ys, xs):
+    out = interp(y, ys, xs)
+    out[(y < ys[0]) | (y > ys[-1])] = nan
+    return out
+
+
+# ============= EOF =============================================
@@ -13,39 +13,807 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ===============================================================================
+import asyncio
+import socket
+import time
+from threading import RLock, Thread, Event
+
 import serial
+from traits.api import Str, Int, Float, Bool, Any, Enum
 
+from hardware import aio
 from loggable import Loggable
 
 
+def checksum(data):
+    """
+    sum of the bytes modulo 256 as two upper case hex digits, as used by the M1000 long form
+    """
+    return f"{sum(data) & 0xFF:02X}".encode()
+
+
 class Communicator(Loggable):
+    """
+    `backend: asyncio` moves the communicator's I/O onto the shared transport loop, see hardware.aio. the
+    blocking `ask` keeps working from any thread, coroutines on the loop await `aask`. the device using the
+    communicator queues its commands on the loop too, see hardware.worker.AsyncIOWorker, so it has no worker
+    thread of its own
+    """
+
     handle = None
+    backend = Enum("thread", "asyncio")
+
+    ntransactions = Int
+    total_latency = Float
+    max_latency = Float
+    last_latency = Float
+
+    _aprimitives = None
 
     def open(self):
         pass
 
+    def close(self):
+        if self.handle:
+            self.handle.close()
+            self.handle = None
+
     def ask(self, msg, *args, **kw):
+        st = time.perf_counter()
         resp = self._ask(msg, *args, **kw)
+        self._record(time.perf_counter() - st)
         self.debug(f"{msg}=>{resp}")
         return resp
 
+    def stats(self):
+        """
+        :return: transaction count and latencies in seconds
+        """
+        n = self.ntransactions
+        return {
+            "transactions": n,
+            "mean_latency": self.total_latency / n if n else 0,
+            "max_latency": self.max_latency,
+            "last_latency": self.last_latency,
+        }
+
+    def _record(self, latency):
+        self.ntransactions += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.last_latency = latency
+
+    def ask_many(self, msgs, *args, **kw):
+        """
+        send several queries and return the replies in order
+        """
+        return [self.ask(msg, *args, **kw) for msg in msgs]
+
+    async def aask(self, msg, *args, **kw):
+        st = time.perf_counter()
+        resp = await self._aask(msg, *args, **kw)
+        self._record(time.perf_counter() - st)
+        self.debug(f"{msg}=>{resp}")
+        return resp
+
+    async def aask_many(self, msgs, *args, **kw):
+        return [await self.aask(msg, *args, **kw) for msg in msgs]
+
     def _ask(self, *args, **kw):
         raise NotImplementedError
 
+    async def _aask(self, *args, **kw):
+        # no native asyncio transport. block an executor thread instead of the loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, lambda: self._ask(*args, **kw))
+
+    @property
+    def _alock(self):
+        """
+        serializes the transactions of this communicator on the transport loop
+        """
+        return self._aprimitive(asyncio.Lock)
+
+    def _aprimitive(self, kind):
+        """
+        an asyncio Lock or Event of this communicator. made on the running loop on first use, and made again if
+        the transport loop was restarted, so it is never bound to another loop
+        """
+        loop = asyncio.get_running_loop()
+        if self._aprimitives is None:
+            self._aprimitives = {}
+
+        entry = self._aprimitives.get(kind)
+        if entry is None or entry[0] is not loop:
+            entry = self._aprimitives[kind] = (loop, kind())
+        return entry[1]
+
 
 class SerialCommunicator(Communicator):
+    """
+    Framed serial I/O.
+
+    Replies are read into a buffer and split into frames:
+
+    - terminator: up to and excluding `terminator`
+    - length: exactly `read_length` bytes
+    - checksum: a terminated frame whose last two characters are the hex checksum of the rest, e.g. the M1000
+      long form "*1RD+00072.00A3". the checksum is stripped from the reply
+
+    A timeout or a bad checksum discards the buffer and flushes the port input before the next query, so a late
+    reply is never taken as the answer to the next one. `ask` returns None in both cases.
+
+    init.yml
+
+    driver:
+      communicator:
+        kind: serial
+        address: /dev/ttyUSB0  # or COM4, or a pyserial url
+        baudrate: 9600
+        bytesize: 8
+        parity: N
+        stopbits: 1
+        timeout: 1
+        terminator: "\\r"
+        write_terminator: "\\r"  # defaults to terminator
+        frame: terminator  # or length or checksum
+        read_length: 0
+        backend: thread  # or asyncio. asyncio needs a port with a file descriptor
+    """
+
+    address = Str("COM1")
+    baudrate = Int(9600)
+    bytesize = Int(8)
+    parity = Str("N")
+    stopbits = Float(1)
+    timeout = Float(1)
+    terminator = Str("\r")
+    write_terminator = Any
+    frame = Str("terminator")
+    read_length = Int
+
+    ntimeouts = Int
+    nbad_frames = Int
+
+    def __init__(self, cfg=None, *args, **kw):
+        super().__init__(cfg, *args, **kw)
+        cfg = self.configobj
+        # `port` is the pre-framing name of `address`
+        if "port" in cfg:
+            self.address = cfg["port"]
+
+        for k in (
+            "address",
+            "baudrate",
+            "bytesize",
+            "parity",
+            "stopbits",
+            "timeout",
+            "terminator",
+            "write_terminator",
+            "frame",
+            "read_length",
+            "backend",
+        ):
+            if k in cfg:
+                setattr(self, k, cfg[k])
+
+        if self.write_terminator is None:
+            self.write_terminator = self.terminator
+
+        self._lock = RLock()
+        self._buffer = bytearray()
+        self._stale = False
+
     def open(self):
-        self.handle = serial.Serial(self.configobj.get("port", "COM1"))
+        try:
+            self.handle = serial.serial_for_url(
+                self.address,
+                baudrate=self.baudrate,
+                bytesize=self.bytesize,
+                parity=self.parity,
+                stopbits=self.stopbits,
+                timeout=self.timeout,
+            )
+        except (serial.SerialException, ValueError) as e:
+            self.warning(f"failed to open serial port {self.address}. {e}")
+            return
+
+        self._buffer.clear()
+        if self.backend == "asyncio":
+            aio.run(self._aattach())
+        return True
+
+    def close(self):
+        if self.handle and self.backend == "asyncio":
+            aio.run(self._adetach())
+        super().close()
 
+    def stats(self):
+        s = super().stats()
+        s["timeouts"] = self.ntimeouts
+        s["bad_frames"] = self.nbad_frames
+        return s
+
+    # private
     def _ask(self, msg, *args, **kw):
-        if self.handle:
-            self.handle.write(msg)
-            return self.handle.read()
+        if self.backend == "asyncio":
+            return aio.run(self._aask(msg, *args, **kw))
+
+        with self._lock:
+            if not self.handle:
+                return
+
+            try:
+                if self._stale:
+                    self._resync()
+                self.handle.write(self._encode(msg))
+                return self._read_frame()
+            except serial.SerialException as e:
+                self.warning(f"serial error {self.address}. {e}")
+                self._stale = True
+
+    def _encode(self, msg):
+        if isinstance(msg, str):
+            msg = msg.encode()
+        term = self.write_terminator.encode()
+        if term and not msg.endswith(term):
+            msg += term
+        return msg
+
+    def _read_frame(self):
+        handle = self.handle
+        buf = self._buffer
+        deadline = time.monotonic() + self.timeout
+        while True:
+            frame = self._split(buf)
+            if frame is not None:
+                return self._validate(frame)
+
+            if time.monotonic() > deadline:
+                break
+
+            chunk = handle.read(handle.in_waiting or 1)
+            if not chunk:
+                break
+            buf.extend(chunk)
+
+        self._on_timeout()
+
+    def _on_timeout(self):
+        self.ntimeouts += 1
+        self.warning(f"timeout {self.address}. partial={bytes(self._buffer)}")
+        self._stale = True
+
+    def _split(self, buf):
+        if self.frame == "length":
+            n = self.read_length
+            if len(buf) >= n:
+                frame = bytes(buf[:n])
+                del buf[:n]
+                return frame
+            return
+
+        term = self.terminator.encode()
+        idx = buf.find(term)
+        if idx >= 0:
+            frame = bytes(buf[:idx])
+            del buf[: idx + len(term)]
+            return frame
+
+    def _validate(self, frame):
+        if self.frame == "checksum":
+            body, cs = frame[:-2], frame[-2:]
+            if checksum(body) != cs.upper():
+                self.nbad_frames += 1
+                self.warning(f"bad checksum {frame}")
+                self._stale = True
+                return
+            frame = body
+
+        return frame.decode(errors="replace")
+
+    def _resync(self):
+        self._buffer.clear()
+        self.handle.reset_input_buffer()
+        self._stale = False
+
+    # asyncio backend
+    async def _aask(self, msg, *args, **kw):
+        async with self._alock:
+            if not self.handle:
+                return
+
+            try:
+                if self._stale:
+                    self._resync()
+                self.handle.write(self._encode(msg))
+                return await asyncio.wait_for(self._aread_frame(), self.timeout)
+            except asyncio.TimeoutError:
+                self._on_timeout()
+            except serial.SerialException as e:
+                self.warning(f"serial error {self.address}. {e}")
+                self._stale = True
+
+    async def _aread_frame(self):
+        while True:
+            frame = self._split(self._buffer)
+            if frame is not None:
+                return self._validate(frame)
+
+            readable = self._aprimitive(asyncio.Event)
+            readable.clear()
+            await readable.wait()
+
+    async def _aattach(self):
+        # reads are driven by the loop, so the port itself never blocks
+        self.handle.timeout = 0
+        asyncio.get_running_loop().add_reader(self.handle.fileno(), self._on_readable)
+
+    async def _adetach(self):
+        asyncio.get_running_loop().remove_reader(self.handle.fileno())
+
+    def _on_readable(self):
+        try:
+            data = self.handle.read(self.handle.in_waiting or 1)
+        except serial.SerialException as e:
+            self.warning(f"serial error {self.address}. {e}")
+            asyncio.get_running_loop().remove_reader(self.handle.fileno())
+            return
+
+        if data:
+            self._buffer.extend(data)
+            self._aprimitive(asyncio.Event).set()
 
 
 class EthernetCommunicator(Communicator):
-    def _ask(self, *args, **kw):
-        pass
+    """
+    One persistent TCP or UDP socket per device.
+
+    The socket is connected in `open`. If the connection fails or drops, `ask` returns None straight away and a
+    background thread reconnects with exponential backoff, so connecting never happens on the caller's thread.
+    After a timeout, input left on the socket is discarded before the next query.
+
+    With `pipeline` all queries given to `ask_many` are sent at once and the replies read back in order. only
+    enable it for instruments that queue several outstanding queries.
+
+    With `backend: asyncio` the socket lives on the shared transport loop and reconnecting is a task on that loop
+    rather than a thread.
+
+    init.yml
+
+    driver:
+      communicator:
+        kind: ethernet
+        address: localhost:8000
+        protocol: tcp  # or udp
+        terminator: "\\n"  # end of a reply
+        write_terminator: "\\n"  # appended to queries that do not already end with it. defaults to terminator
+        timeout: 1
+        connect_timeout: 2
+        reconnect_interval: 0.5
+        max_reconnect_interval: 30
+        pipeline: false
+        backend: thread  # or asyncio
+    """
+
+    host = Str("localhost")
+    port = Int(8000)
+    protocol = Str("tcp")
+    terminator = Str("\n")
+    write_terminator = Any
+    timeout = Float(1)
+    connect_timeout = Float(2)
+    reconnect_interval = Float(0.5)
+    max_reconnect_interval = Float(30)
+    pipeline = Bool(False)
+    buffer_size = Int(4096)
+
+    nreconnects = Int
+    ntimeouts = Int
+
+    def __init__(self, cfg=None, *args, **kw):
+        super().__init__(cfg, *args, **kw)
+        cfg = self.configobj
+        for k in (
+            "host",
+            "port",
+            "protocol",
+            "terminator",
+            "write_terminator",
+            "timeout",
+            "connect_timeout",
+            "reconnect_interval",
+            "max_reconnect_interval",
+            "pipeline",
+            "buffer_size",
+            "backend",
+        ):
+            if k in cfg:
+                setattr(self, k, cfg[k])
+
+        address = cfg.get("address")
+        if address:
+            host, _, port = str(address).rpartition(":")
+            self.host = host or self.host
+            if port:
+                self.port = int(port)
+
+        if self.write_terminator is None:
+            self.write_terminator = self.terminator
+
+        self._lock = RLock()
+        self._buffer = bytearray()
+        self._reader = None
+        self._stale = False
+        self._closed = Event()
+        self._reconnect_thread = None
+        self._reconnect_task = None
+
+    def open(self):
+        """
+        connect. on failure keep trying in the background
+        """
+        self._closed.clear()
+        if self.backend == "asyncio":
+            aio.run(self._aopen())
+        elif not self._connect():
+            self._start_reconnect()
+        return True
+
+    def close(self):
+        self._closed.set()
+        if self.backend == "asyncio":
+            aio.run(self._aclose())
+            return
+
+        with self._lock:
+            self._disconnect()
+
+    def is_connected(self):
+        return self.handle is not None
+
+    def ask_many(self, msgs, *args, **kw):
+        if self.backend == "asyncio":
+            return aio.run(self.aask_many(msgs, *args, **kw))
+        if not self.pipeline:
+            return super().ask_many(msgs, *args, **kw)
+
+        with self._lock:
+            if not self._ready():
+                return [None] * len(msgs)
+
+            resps = []
+            st = time.perf_counter()
+            try:
+                self._send(b"".join(self._encode(m) for m in msgs))
+                for _ in msgs:
+                    resps.append(self._recv())
+            except (socket.timeout, OSError) as e:
+                self._on_error(e)
+            # one round trip for the whole batch
+            self._record(time.perf_counter() - st)
+
+        resps.extend([None] * (len(msgs) - len(resps)))
+        for msg, resp in zip(msgs, resps):
+            self.debug(f"{msg}=>{resp}")
+        return resps
+
+    async def aask_many(self, msgs, *args, **kw):
+        if not self.pipeline:
+            return await super().aask_many(msgs, *args, **kw)
+
+        async with self._alock:
+            if not await self._aready():
+                return [None] * len(msgs)
+
+            resps = []
+            st = time.perf_counter()
+            try:
+                await self._awrite(b"".join(self._encode(m) for m in msgs))
+                for _ in msgs:
+                    resps.append(await asyncio.wait_for(self._aread(), self.timeout))
+            except (asyncio.TimeoutError, OSError, EOFError) as e:
+                self._on_error(e)
+            self._record(time.perf_counter() - st)
+
+        resps.extend([None] * (len(msgs) - len(resps)))
+        for msg, resp in zip(msgs, resps):
+            self.debug(f"{msg}=>{resp}")
+        return resps
+
+    # private
+    def _ask(self, msg, *args, **kw):
+        if self.backend == "asyncio":
+            return aio.run(self._aask(msg, *args, **kw))
+
+        with self._lock:
+            if not self._ready():
+                return
+
+            try:
+                self._send(self._encode(msg))
+                return self._recv()
+            except (socket.timeout, OSError) as e:
+                self._on_error(e)
+
+    def _ready(self):
+        if self.handle is None:
+            self._start_reconnect()
+            return False
+
+        if self._stale:
+            self._drain()
+        return True
+
+    def _on_error(self, e):
+        if isinstance(e, (socket.timeout, asyncio.TimeoutError)):
+            self.ntimeouts += 1
+            self.warning(f"timeout {self.host}:{self.port}")
+            self._stale = True
+        else:
+            self.warning(f"connection to {self.host}:{self.port} lost. {e}")
+            self._disconnect()
+            self._start_reconnect()
+
+    def _encode(self, msg):
+        if isinstance(msg, str):
+            msg = msg.encode()
+        term = self.write_terminator.encode()
+        if term and not msg.endswith(term):
+            msg += term
+        return msg
+
+    def _send(self, data):
+        self.handle.sendall(data)
+
+    def _recv(self):
+        """
+        read one reply. TCP replies end with `terminator`, a UDP reply is one datagram
+        """
+        term = self.terminator.encode()
+        if self.protocol == "udp":
+            data = self.handle.recv(65535)
+            return self._decode(
+                data[: -len(term)] if term and data.endswith(term) else data
+            )
+
+        buf = self._buffer
+        deadline = time.monotonic() + self.timeout
+        while True:
+            if term:
+                idx = buf.find(term)
+                if idx >= 0:
+                    data = bytes(buf[:idx])
+                    del buf[: idx + len(term)]
+                    return self._decode(data)
+            elif buf:
+                data = bytes(buf)
+                buf.clear()
+                return self._decode(data)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("timed out")
+
+            self.handle.settimeout(remaining)
+            chunk = self.handle.recv(self.buffer_size)
+            if not chunk:
+                raise ConnectionResetError("connection closed by peer")
+            buf.extend(chunk)
+
+    def _decode(self, data):
+        return data.decode(errors="replace")
+
+    def _drain(self):
+        """
+        discard late replies to queries that timed out
+        """
+        self._buffer.clear()
+        self.handle.setblocking(False)
+        try:
+            while self.handle.recv(self.buffer_size):
+                pass
+        except OSError:
+            pass
+        finally:
+            self.handle.settimeout(self.timeout)
+        self._stale = False
+
+    def _make_socket(self):
+        if self.protocol == "udp":
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sock.connect((self.host, self.port))
+            except OSError:
+                sock.close()
+                raise
+        else:
+            sock = socket.create_connection(
+                (self.host, self.port), timeout=self.connect_timeout
+            )
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        sock.settimeout(self.timeout)
+        return sock
+
+    def _connect(self):
+        try:
+            sock = self._make_socket()
+        except OSError as e:
+            self.debug(f"connect {self.protocol} {self.host}:{self.port} failed. {e}")
+            return False
+
+        with self._lock:
+            self._disconnect()
+            self.handle = sock
+            self._buffer.clear()
+            self._stale = False
+
+        self.info(f"connected {self.protocol} {self.host}:{self.port}")
+        return True
+
+    def _disconnect(self):
+        if self.handle:
+            try:
+                self.handle.close()
+            except OSError:
+                pass
+            self.handle = None
+            self._reader = None
+
+    def _start_reconnect(self):
+        if self._closed.is_set():
+            return
+
+        if self.backend == "asyncio":
+            task = self._reconnect_task
+            if not task or task.done():
+                loop = asyncio.get_running_loop()
+                self._reconnect_task = loop.create_task(self._areconnect())
+            return
+
+        with self._lock:
+            t = self._reconnect_thread
+            if t and t.is_alive():
+                return
+
+            t = Thread(
+                target=self._reconnect, name=f"{self.name}.reconnect", daemon=True
+            )
+            self._reconnect_thread = t
+            t.start()
+
+    def _reconnect(self):
+        delay = self.reconnect_interval
+        while not self._closed.wait(delay):
+            if self._connect():
+                self.nreconnects += 1
+                return
+            delay = min(delay * 2, self.max_reconnect_interval)
+
+    # asyncio backend
+    async def _aopen(self):
+        if not await self._aconnect():
+            self._start_reconnect()
+
+    async def _aclose(self):
+        if self._reconnect_task:
+            self._reconnect_task.cancel()
+        self._disconnect()
+
+    async def _aask(self, msg, *args, **kw):
+        async with self._alock:
+            if not await self._aready():
+                return
+
+            try:
+                await self._awrite(self._encode(msg))
+                return await asyncio.wait_for(self._aread(), self.timeout)
+            except (asyncio.TimeoutError, OSError, EOFError) as e:
+                self._on_error(e)
+
+    async def _aready(self):
+        if self.handle is None:
+            self._start_reconnect()
+            return False
+
+        if self._stale:
+            await self._adrain()
+        return True
+
+    async def _awrite(self, data):
+        if self.protocol == "udp":
+            self.handle.sendto(data)
+        else:
+            self.handle.write(data)
+            await self.handle.drain()
+
+    async def _aread(self):
+        term = self.terminator.encode()
+        if self.protocol == "udp":
+            data = await self._reader.get()
+            if isinstance(data, Exception):
+                raise data
+            return self._decode(
+                data[: -len(term)] if term and data.endswith(term) else data
+            )
+
+        if term:
+            data = await self._reader.readuntil(term)
+            return self._decode(data[: -len(term)])
+
+        data = await self._reader.read(self.buffer_size)
+        if not data:
+            raise ConnectionResetError("connection closed by peer")
+        return self._decode(data)
+
+    async def _adrain(self):
+        if self.protocol == "udp":
+            while not self._reader.empty():
+                self._reader.get_nowait()
+        else:
+            while True:
+                try:
+                    data = await asyncio.wait_for(
+                        self._reader.read(self.buffer_size), 0.001
+                    )
+                except asyncio.TimeoutError:
+                    break
+                if not data:
+                    break
+        self._stale = False
+
+    async def _aconnect(self):
+        loop = asyncio.get_running_loop()
+        try:
+            if self.protocol == "udp":
+                writer, protocol = await loop.create_datagram_endpoint(
+                    DatagramQueue, remote_addr=(self.host, self.port)
+                )
+                reader = protocol.queue
+            else:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port),
+                    self.connect_timeout,
+                )
+                sock = writer.get_extra_info("socket")
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (asyncio.TimeoutError, OSError) as e:
+            self.debug(f"connect {self.protocol} {self.host}:{self.port} failed. {e}")
+            return False
+
+        self._disconnect()
+        self.handle, self._reader = writer, reader
+        self._stale = False
+        self.info(f"connected {self.protocol} {self.host}:{self.port}")
+        return True
+
+    async def _areconnect(self):
+        delay = self.reconnect_interval
+        while not self._closed.is_set():
+            await asyncio.sleep(delay)
+            if self._closed.is_set():
+                return
+            if await self._aconnect():
+                self.nreconnects += 1
+                return
+            delay = min(delay * 2, self.max_reconnect_interval)
+
+
+class DatagramQueue(asyncio.DatagramProtocol):
+    """
+    queues received datagrams, and errors, for `EthernetCommunicator._aread`
+    """
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.queue.put_nowait(data)
+
+    def error_received(self, exc):
+        self.queue.put_nowait(exc)
 
 
 class TelnetCommunicator(Communicator):
@@ -53,11 +821,11 @@ class TelnetCommunicator(Communicator):
 
 
 class TCPCommunicator(EthernetCommunicator):
-    pass
+    protocol = Str("tcp")
 
 
 class UDPCommunicator(EthernetCommunicator):
-    pass
+    protocol = Str("udp")
 
 
 class ZmqCommunicator(Communicator):
@@ -13,13 +13,60 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ===============================================================================
+import math
+
+from traits.api import List
+
+from hardware.adc import Channel
 from hardware.device import Device
+from hardware.worker import HIGH
 
 
 class DAC(Device):
+    """
+    channels are optional. a value written to a configured channel, by name or address, is converted to volts with
+    the inverse of the channel's calibration
+
+    init.yml
+
+    devices:
+      - name: dac
+        kind: DAC
+        channels:
+          - name: heater
+            address: '1'
+            mapping: 0.5,0  # 0.5 W/V
+    """
+
+    channels = List(Channel)
+
+    def load(self, cfg):
+        self.channels = [Channel(**ci) for ci in cfg.get("channels", [])]
+
+    def calibrations(self):
+        return {c.name: c.calibration for c in self.channels}
+
     def write_channel(self, channel, value):
-        self.debug(f"write channel {channel}, value={value}")
-        self.driver.write_channel(channel, value)
+        """
+        :raises ValueError: if `value` is outside the range of the channel's calibration
+        """
+        ch = self._get_channel(channel)
+        if ch:
+            channel, volts = ch.address, ch.unmap_value(value)
+            if volts is None or not math.isfinite(volts):
+                raise ValueError(
+                    f"{self.name} channel {ch.name}: {value} is outside the calibrated range"
+                )
+        else:
+            volts = value
+
+        self.debug(f"write channel {channel}, value={value}, volts={volts}")
+        self.io(self.driver.write_channel, channel, volts, priority=HIGH)
+
+    def _get_channel(self, channel):
+        for c in self.channels:
+            if channel in (c.name, c.address):
+                return c
 
 
 # ============= EOF =============================================
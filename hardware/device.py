@@ -19,7 +19,9 @@ import random
 from numpy import polyval
 from traits.api import Instance, Event, HasTraits, Str, List
 
+from hardware.cache import ReadCache
 from hardware.driver.driver import Driver
+from hardware.worker import IOWorker, AsyncIOWorker, NORMAL
 from loggable import Loggable
 from util import import_klass
 from traitsui.api import View, Item
@@ -27,6 +29,8 @@ from traitsui.api import View, Item
 
 class Device(Loggable):
     driver = Instance(Driver)
+    worker = Instance(IOWorker)
+    cache = Instance(ReadCache)
     update = Event
 
     def traits_view(self):
@@ -57,5 +61,58 @@ class Device(Loggable):
     def get_value(self, *args, **kw):
         return random.random() + math.log(id(self))
 
+    def calibrations(self):
+        """
+        :return: dict of channel name to hardware.calibration.Calibration. recorded as calibration versions in the
+            database
+        """
+        return {}
+
+    def submit(self, func, *args, priority=NORMAL, **kw):
+        """
+        queue an I/O call on this device's worker. every driver call goes through here so commands from scans,
+        automations, ramps and the server never interleave on the wire
+
+        :param priority: hardware.worker.HIGH, NORMAL or LOW
+        :return: Future
+        """
+        return self.worker.submit(func, *args, priority=priority, **kw)
+
+    def io(self, func, *args, priority=NORMAL, timeout=None, **kw):
+        """
+        submit and wait for the result
+        """
+        return self.worker.call(func, *args, priority=priority, timeout=timeout, **kw)
+
+    async def aio(self, func, *args, priority=NORMAL, **kw):
+        """
+        submit and await the result from a coroutine, e.g. on the transport loop. `func` may be a coroutine
+        function
+        """
+        return await self.worker.acall(func, *args, priority=priority, **kw)
+
+    def io_stats(self):
+        """
+        :return: per priority lane queue depth and latency stats of this device's worker
+        """
+        return self.worker.stats()
+
+    def close(self):
+        if self.worker:
+            self.worker.stop()
+        if self.driver:
+            self.driver.close()
+
+    def _worker_default(self):
+        # a device on the asyncio transport queues its commands on the transport loop instead of a thread
+        klass = IOWorker
+        communicator = self.driver.communicator if self.driver else None
+        if communicator and communicator.backend == "asyncio":
+            klass = AsyncIOWorker
+        return klass(self.configobj.get("worker"), name=f"{self.name}.io")
+
+    def _cache_default(self):
+        return ReadCache(self.configobj.get("cache"), name=f"{self.name}.cache")
+
 
 # ============= EOF =============================================
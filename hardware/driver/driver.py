@@ -23,7 +23,10 @@ class Driver(Loggable):
     communicator = Instance(Communicator)
 
     def ask(self, *args, **kw):
-        self.communicator.ask(*args, **kw)
+        return self.communicator.ask(*args, **kw)
+
+    def ask_many(self, msgs, *args, **kw):
+        return self.communicator.ask_many(msgs, *args, **kw)
 
     def bootstrap(self, cfg):
         self.setup_communicator(cfg["communicator"])
@@ -36,8 +39,14 @@ class Driver(Loggable):
         return True
 
     def open(self):
+        if self.communicator:
+            self.communicator.open()
         return True
 
+    def close(self):
+        if self.communicator:
+            self.communicator.close()
+
     def setup_communicator(self, cfg):
         kind = cfg["kind"]
         klass = import_klass(f"hardware.communicator.{kind.capitalize()}Communicator")
@@ -14,6 +14,7 @@
 # limitations under the License.
 # ===============================================================================
 from hardware.device import Device
+from hardware.worker import HIGH
 from traits.api import Float, HasTraits, Instance
 
 
@@ -72,7 +73,7 @@ class LinearDrive(Device):
         self._move_to(raw, **kw)
 
     def _move_to(self, raw, **kw):
-        self.driver.move_absolute(raw, **kw)
+        self.io(self.driver.move_absolute, raw, priority=HIGH, **kw)
 
 
 # ============= EOF =============================================
@@ -18,10 +18,10 @@ from hardware.device import Device
 
 class SpectrometerController(Device):
     def set_ionbeam_position(self, iso, detector):
-        self.driver.set_ionbeam_position(iso, detector)
+        self.io(self.driver.set_ionbeam_position, iso, detector)
 
     def get_intensities(self, detectors):
-        self.driver.get_intensities(detectors)
+        return self.io(self.driver.get_intensities, detectors)
 
 
 # ============= EOF =============================================
@@ -17,9 +17,10 @@ import time
 from threading import Thread, Event
 
 import bezier
-from numpy import array, linspace
+from numpy import array, diff, interp, linspace
 
 from hardware.device import Device
+from hardware.worker import HIGH
 from loggable import Loggable
 from traits.api import List, Str, Float, Int, Bool, Array
 
@@ -36,45 +37,129 @@ class Switch(Loggable):
 
 
 class RampSwitch(Switch):
+    """
+    a switch that can be ramped along a bezier curve of (fraction of the ramp, voltage) control points.
+
+    each direction's curve is evaluated once, when the switch is loaded or its nodes change, into a lookup table
+    of `resolution` voltages on an even x grid. `ramp` streams the `nsteps` voltages taken from the table. the
+    curve's x must increase along the curve, otherwise the switch fails to load
+
+    init.yml
+
+    switches:
+      - name: A
+        channel: '01'
+        ramp:
+          period: 1
+          nsteps: 10
+          resolution: 1001
+          open:
+            control_points:
+              - 0, 0
+              - 0.5, 10
+              - 1, 10
+          close:
+            control_points:
+              - 0, 10
+              - 0.5, 10
+              - 1, 0
+    """
+
     ramp_period = Float
     min_value = Float
     max_value = Float
     # control_points = List
     nsteps = Int
+    resolution = Int(1001)
     open_nodes = Array
     close_nodes = Array
 
     def __init__(self, cfg, *args, **kw):
         super().__init__(cfg, *args, **kw)
+        self._profiles = {}
+        self._steps = {}
+
         self.ramp_period = cfg["ramp"].get("period", 1)
         self.nsteps = cfg["ramp"].get("nsteps", 10)
+        self.resolution = cfg["ramp"].get("resolution", 1001)
         ocpts = cfg["ramp"]["open"].get("control_points", [])
         ccpts = cfg["ramp"]["close"].get("control_points", [])
-        self.degree = len(ocpts) - 1
         self.open_nodes = array([p.split(",") for p in ocpts], dtype=float).T
         self.close_nodes = array([p.split(",") for p in ccpts], dtype=float).T
 
         self.max_value = self.open_nodes[1].max()
         self.min_value = self.close_nodes[1].min()
 
+        # evaluate and validate both directions up front
+        for state in (True, False):
+            self.ramp_steps(state)
+
     def ramp_max(self):
         return self.open_nodes.max()
 
+    def profile(self, state):
+        """
+        the lookup table of a ramp direction, for ramping and plotting
+
+        :param state: True for the open ramp, False for the close ramp
+        :return: (x, voltage) arrays of `resolution` points, x evenly spaced
+        """
+        profile = self._profiles.get(state)
+        if profile is None:
+            nodes = self.open_nodes if state else self.close_nodes
+            profile = self._profiles[state] = make_profile(
+                nodes, self.resolution, f"{self.name} {'open' if state else 'close'}"
+            )
+        return profile
+
+    def ramp_steps(self, state):
+        """
+        :return: the voltages `ramp` outputs, one per step
+        """
+        steps = self._steps.get(state)
+        if steps is None:
+            x, y = self.profile(state)
+            # skip the first step because we already are at this value
+            xs = linspace(x[0], x[-1], self.nsteps + 1)[1:]
+            steps = self._steps[state] = interp(xs, x, y)
+        return steps
+
     def ramp(self, state):
-        # nodes = array([p.split(",") for p in self.control_points], dtype=float).T
-        nodes = self.open_nodes if state else self.close_nodes
-        curve = bezier.Curve(nodes, degree=self.degree)
-        ma = nodes.max()
+        yield from self.ramp_steps(state).tolist()
+
+    def _open_nodes_changed(self):
+        self._invalidate(True)
+
+    def _close_nodes_changed(self):
+        self._invalidate(False)
+
+    def _nsteps_changed(self):
+        self._steps = {}
+
+    def _resolution_changed(self):
+        self._profiles = {}
+        self._steps = {}
+
+    def _invalidate(self, state):
+        self._profiles.pop(state, None)
+        self._steps.pop(state, None)
+
+
+def make_profile(nodes, resolution, name="ramp"):
+    """
+    evaluate a bezier curve into a lookup table of y on an even x grid
 
-        for j, i in enumerate(linspace(0.0, 1.0, self.nsteps + 1)):
-            if not j:
-                # skip first because we already are at this value
-                continue
+    :param nodes: 2 x n array of control points
+    :return: (x, y) arrays of `resolution` points
+    """
+    curve = bezier.Curve(nodes, degree=nodes.shape[1] - 1)
+    # sample the curve parameter densely enough that linear interpolation is exact to well below a step
+    cx, cy = curve.evaluate_multi(linspace(0.0, 1.0, max(resolution, 1001) * 4))
+    if not (diff(cx) > 0).all():
+        raise ValueError(f"{name} ramp x must increase along the curve")
 
-            curve2 = bezier.Curve([[i, i], [0, ma]], degree=1)
-            intersections = curve.intersect(curve2)
-            output = curve.evaluate_multi(intersections[0, :])[1][0]
-            yield output
+    x = linspace(cx[0], cx[-1], resolution)
+    return x, interp(x, cx, cy)
 
 
 class SwitchController(Device):
@@ -149,7 +234,8 @@ class SwitchController(Device):
                     time.sleep(s.ramp_period)
 
                 self.debug(f"set output {si}")
-                self.driver.set_voltage(s.channel, si)
+                self.io(self.driver.set_voltage, s.channel, si, priority=HIGH)
+                t_ns = time.time_ns()
 
                 if self.canvas:
                     self.canvas.set_switch_voltage(s.name, si)
@@ -160,6 +246,7 @@ class SwitchController(Device):
                     "max_time": max_time,
                     "max_voltage": max_voltage,
                     "value": si,
+                    "t_ns": t_ns,
                     "datastream": "ramp",
                     "switch_name": s.name,
                 }
@@ -180,7 +267,7 @@ class SwitchController(Device):
         channel = switch.channel
         v = switch.max_value if state else switch.min_value
         self.debug(f"actuate channel {channel} state={state}, voltage={v}")
-        self.driver.actuate_channel(channel, v)
+        self.io(self.driver.actuate_channel, channel, v, priority=HIGH)
 
         switch.state = state
         if self.canvas:
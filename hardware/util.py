@@ -15,14 +15,17 @@
 # ===============================================================================
 
 
+def to_float(t, default=None):
+    try:
+        return float(t)
+    except (TypeError, ValueError):
+        return default
+
+
 def get_float(default=None):
     def dec(func):
         def wrapper(*args, **kw):
-            t = func(*args, **kw)
-            try:
-                return float(t)
-            except (TypeError, ValueError):
-                return default
+            return to_float(func(*args, **kw), default)
 
         return wrapper
 
@@ -0,0 +1,367 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import asyncio
+import contextvars
+import itertools
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from queue import PriorityQueue, Empty
+from threading import Thread, Lock, get_ident
+
+from hardware import aio
+from loggable import Loggable
+
+# priority lanes. lower runs first
+HIGH = 0
+NORMAL = 1
+LOW = 2
+LANES = {HIGH: "high", NORMAL: "normal", LOW: "low"}
+
+STOP = object()
+
+# the AsyncIOWorker whose coroutine command is running in the current task
+_current = contextvars.ContextVar("current_worker", default=None)
+
+
+class LaneStats(object):
+    def __init__(self):
+        self.depth = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_service = 0.0
+        self.max_service = 0.0
+
+    def to_dict(self):
+        n = self.completed + self.failed
+        return {
+            "depth": self.depth,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "mean_wait": self.total_wait / n if n else 0,
+            "max_wait": self.max_wait,
+            "mean_service": self.total_service / n if n else 0,
+            "max_service": self.max_service,
+        }
+
+
+class IOWorker(Loggable):
+    """
+    Serializes all I/O of one device on a single thread.
+
+    Commands are submitted with a priority and run one at a time, highest priority first and in submission order
+    within a priority. A running command is never interrupted, so a HIGH command waits at most for the command
+    in progress. `submit` returns a `concurrent.futures.Future`.
+
+    Commands submitted from the worker thread itself, e.g. a driver call made inside another command, run inline
+    instead of being queued behind themselves.
+
+    `stop` lets the command in progress finish and cancels everything still queued, so no caller waits on a
+    future that will never resolve. A stopped worker refuses new commands.
+    """
+
+    def __init__(self, cfg=None, *args, **kw):
+        super().__init__(cfg, *args, **kw)
+        self._queue = PriorityQueue()
+        self._seq = itertools.count()
+        self._lock = Lock()
+        self._stats = {lane: LaneStats() for lane in LANES}
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        with self._lock:
+            if self._stopped or self._thread and self._thread.is_alive():
+                return
+
+            self._thread = Thread(target=self._run, name=f"{self.name}", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        stop the worker. the command in progress finishes, queued commands are cancelled
+        """
+        with self._lock:
+            self._stopped = True
+            self._queue.put((HIGH, -1, STOP))
+        if self.is_alive():
+            self._thread.join(timeout)
+
+    def is_alive(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def submit(self, func, *args, priority=NORMAL, **kw):
+        """
+        queue `func(*args, **kw)`
+
+        :param priority: HIGH, NORMAL or LOW
+        :return: Future
+        :raises RuntimeError: if the worker has been stopped
+        """
+        future = Future()
+        if self._in_worker():
+            self._execute(priority, time.perf_counter(), func, args, kw, future)
+            return future
+
+        if not self.is_alive():
+            self.start()
+
+        item = (func, args, kw, future, time.perf_counter())
+        with self._lock:
+            # checked under the lock so nothing is queued behind STOP
+            if self._stopped:
+                raise RuntimeError(f"{self.name} is stopped")
+
+            s = self._stats[priority]
+            s.depth += 1
+            s.submitted += 1
+            self._queue.put((priority, next(self._seq), item))
+        self._notify()
+        return future
+
+    def call(self, func, *args, priority=NORMAL, timeout=None, **kw):
+        """
+        submit and wait for the result
+        """
+        return self.submit(func, *args, priority=priority, **kw).result(timeout)
+
+    async def acall(self, func, *args, priority=NORMAL, **kw):
+        """
+        submit and await the result from a coroutine
+        """
+        return await asyncio.wrap_future(
+            self.submit(func, *args, priority=priority, **kw)
+        )
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        """
+        :return: {"high"|"normal"|"low": {depth, submitted, completed, failed, mean/max wait, mean/max service}}
+        latencies are in seconds. wait is the time spent queued, service the time spent running
+        """
+        with self._lock:
+            return {LANES[k]: s.to_dict() for k, s in self._stats.items()}
+
+    # private
+    def _in_worker(self):
+        return bool(self._thread and self._thread.ident == get_ident())
+
+    def _notify(self):
+        pass
+
+    def _run(self):
+        while True:
+            priority, _, item = self._queue.get()
+            if item is STOP:
+                self._cancel_pending()
+                break
+
+            func, args, kw, future, queued = item
+            with self._lock:
+                self._stats[priority].depth -= 1
+            self._execute(priority, queued, func, args, kw, future)
+
+    def _cancel_pending(self):
+        while True:
+            try:
+                priority, _, item = self._queue.get_nowait()
+            except Empty:
+                return
+
+            if item is STOP:
+                continue
+
+            item[3].cancel()
+            with self._lock:
+                self._stats[priority].depth -= 1
+
+    def _execute(self, priority, queued, func, args, kw, future):
+        if not future.set_running_or_notify_cancel():
+            return
+
+        st = time.perf_counter()
+        wait = st - queued
+        try:
+            result = func(*args, **kw)
+        except BaseException as e:
+            ok = False
+            future.set_exception(e)
+        else:
+            ok = True
+            future.set_result(result)
+
+        self._record(priority, ok, wait, time.perf_counter() - st)
+
+    def _record(self, priority, ok, wait, service):
+        with self._lock:
+            s = self._stats[priority]
+            if ok:
+                s.completed += 1
+            else:
+                s.failed += 1
+            s.total_wait += wait
+            s.max_wait = max(s.max_wait, wait)
+            s.total_service += service
+            s.max_service = max(s.max_service, service)
+
+
+def _run_coroutine(func, args, kw):
+    return aio.run(func(*args, **kw))
+
+
+class AsyncIOWorker(IOWorker):
+    """
+    IOWorker for a device whose communicator uses `backend: asyncio`. The command queue is drained by a task on
+    the shared transport loop, see hardware.aio, instead of by a thread of its own, with the same priorities,
+    ordering, stats and stop semantics.
+
+    Coroutine functions run on the loop. Plain functions, e.g. driver calls that wait in `Communicator.ask`, run
+    on the loop's executor. Its threads are shared by all devices and are only added while that many commands run
+    at once, so the thread count no longer grows with the number of devices.
+    """
+
+    _task = None
+    _loop = None
+    _wakeup = None
+    # ident of the executor thread running a plain command of this worker
+    _running = None
+
+    def start(self):
+        with self._lock:
+            if self._stopped or self.is_alive():
+                return
+
+            self._loop = aio.get_loop()
+            self._task = aio.submit(self._arun())
+
+    def stop(self, timeout=None):
+        """
+        stop the worker. the command in progress finishes, queued commands are cancelled
+        """
+        with self._lock:
+            self._stopped = True
+            self._queue.put((HIGH, -1, STOP))
+        self._notify()
+        if self.is_alive() and not aio.in_loop():
+            try:
+                self._task.result(timeout)
+            except FutureTimeoutError:
+                pass
+
+    def is_alive(self):
+        return bool(self._task and not self._task.done() and self._loop.is_running())
+
+    def call(self, func, *args, priority=NORMAL, timeout=None, **kw):
+        if aio.in_loop():
+            raise RuntimeError(
+                "blocking call on the transport loop. await acall instead"
+            )
+        return super().call(func, *args, priority=priority, timeout=timeout, **kw)
+
+    async def acall(self, func, *args, priority=NORMAL, **kw):
+        if _current.get() is self:
+            # made inside a coroutine command of this worker. waiting in the queue would wait on itself
+            result = func(*args, **kw)
+            if asyncio.iscoroutine(result):
+                result = await result
+            return result
+        return await super().acall(func, *args, priority=priority, **kw)
+
+    # private
+    def _in_worker(self):
+        return self._running == get_ident()
+
+    def _notify(self):
+        if self.is_alive():
+            self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def _arun(self):
+        self._wakeup = asyncio.Event()
+        _current.set(self)
+        loop = asyncio.get_running_loop()
+        while True:
+            # cleared before looking, so a command queued after the look always wakes the task
+            self._wakeup.clear()
+            try:
+                priority, _, item = self._queue.get_nowait()
+            except Empty:
+                await self._wakeup.wait()
+                continue
+
+            if item is STOP:
+                self._cancel_pending()
+                break
+
+            func, args, kw, future, queued = item
+            with self._lock:
+                self._stats[priority].depth -= 1
+
+            if asyncio.iscoroutinefunction(func):
+                await self._aexecute(priority, queued, func, args, kw, future)
+            else:
+                await loop.run_in_executor(
+                    None,
+                    self._execute_blocking,
+                    priority,
+                    queued,
+                    func,
+                    args,
+                    kw,
+                    future,
+                )
+
+    def _execute(self, priority, queued, func, args, kw, future):
+        if asyncio.iscoroutinefunction(func):
+            # a coroutine command made inside a plain one. it runs on the loop while the executor thread waits
+            func, args, kw = _run_coroutine, (func, args, kw), {}
+        super()._execute(priority, queued, func, args, kw, future)
+
+    def _execute_blocking(self, *args):
+        self._running = get_ident()
+        try:
+            self._execute(*args)
+        finally:
+            self._running = None
+
+    async def _aexecute(self, priority, queued, func, args, kw, future):
+        if not future.set_running_or_notify_cancel():
+            return
+
+        st = time.perf_counter()
+        wait = st - queued
+        try:
+            result = await func(*args, **kw)
+        except BaseException as e:
+            ok = False
+            future.set_exception(e)
+        else:
+            ok = True
+            future.set_result(result)
+
+        self._record(priority, ok, wait, time.perf_counter() - st)
+
+
+# ============= EOF =============================================
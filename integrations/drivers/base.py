@@ -13,7 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ===============================================================================
-from hardware.util import get_float
+from hardware.util import get_float, to_float
 from hardware.driver.driver import Driver
 
 
@@ -26,6 +26,34 @@ class BaseADCDriver(Driver):
     def _read_channel(self, channel):
         raise NotImplementedError
 
+    def read_channels(self, channels):
+        """
+        read several channels in as few round trips as the protocol allows
+
+        :return: list of floats, None for a channel that could not be read
+        """
+        self.debug(f"read channels {channels}")
+        return [to_float(v) for v in self._read_channels(channels)]
+
+    def _read_channels(self, channels):
+        """
+        drivers with a native block read override this. the default sends every channel's read command at once,
+        pipelined if the communicator allows it, or falls back to one read per channel
+        """
+        cmds = [self._make_read_command(c) for c in channels]
+        if None in cmds:
+            return [self._read_channel(c) for c in channels]
+        return [self._parse_read_response(r) for r in self.ask_many(cmds)]
+
+    def _make_read_command(self, channel):
+        """
+        the query for one channel, or None if reads are not a single query
+        """
+        return None
+
+    def _parse_read_response(self, resp):
+        return resp
+
 
 class BaseDACDriver(Driver):
     def write_channel(self, channel, value):
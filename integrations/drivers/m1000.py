@@ -22,9 +22,17 @@ LONG_FORM_PROMPT = "#"
 
 
 class M1000(BaseADCDriver):
-    """ """
+    """
+    init.yml
+
+    driver:
+      kind: M1000
+      address: ''  # module address. empty to address each channel's module
+      block_command: ''  # query returning every channel comma separated. empty to pipeline one RD per channel
+    """
 
     address = Str
+    block_command = Str
 
     # short_form_prompt = "$"
     # long_form_prompt = "#"
@@ -57,15 +65,35 @@ class M1000(BaseADCDriver):
     #     return res
     def load(self, cfg):
         self.address = cfg.get("address", "")
+        self.block_command = cfg.get("block_command", "")
 
     def _read_channel(self, channel):
-        cmd = "RD"
-        addr = self.address
-        cmd = "".join((SHORT_FORM_PROMPT, addr, cmd))
-
+        cmd = self._make_read_command(channel)
         res = self.ask(cmd)
         return self._parse_response(res)
 
+    def _read_channels(self, channels):
+        if not self.block_command:
+            return super()._read_channels(channels)
+
+        cmd = "".join((SHORT_FORM_PROMPT, self.address, self.block_command))
+        values = self._parse_response(self.ask(cmd), kind="block") or []
+        # the block reply lists channels 1..n in order
+        idxs = [int(c) - 1 for c in channels]
+        return [values[i] if 0 <= i < len(values) else None for i in idxs]
+
+    def _make_read_command(self, channel):
+        # a configured address is the module, as it always was, whatever the channel. without one the command
+        # used to be "$RD", which no module answers, so the channel is taken as the module address instead
+        addr = self.address or channel
+        return "".join((SHORT_FORM_PROMPT, addr, "RD"))
+
+    def _parse_read_response(self, resp):
+        try:
+            return self._parse_response(resp)
+        except ValueError:
+            self.warning(f"invalid response {resp}")
+
     def _parse_response(self, r, form="$", kind=None):
         """
         typical response form
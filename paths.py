@@ -86,8 +86,7 @@ class Paths(Loggable):
 
     def new_path(self, base, name, extension=".csv"):
         rp = Path(self.root, base)
-        if not rp.is_dir():
-            rp.mkdir()
+        rp.mkdir(exist_ok=True)
 
         for i in itertools.count():
             p = Path(self.root, base, f"{name}{i:04n}{extension}")
@@ -95,7 +94,7 @@ class Paths(Loggable):
                 return p
 
     def database_backups(self):
-        now = int(datetime.now().timestamp())
+        now = int(datetime.now().timestamp() * 1000)
         return Path(self.root, "backups", f"{now}.backup.db")
 
 
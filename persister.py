@@ -13,29 +13,69 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ===============================================================================
+import bz2
+import gzip
 import json
+import lzma
+import struct
 
 import yaml
-from traits.api import File, Str
+from numpy import frombuffer, int64, float64
+from traits.api import Enum, File, Str
 
 import csv
 
 from loggable import Loggable
 from paths import paths
 
+COMPRESSION = {
+    "gzip": (gzip.open, ".gz"),
+    "bz2": (bz2.open, ".bz2"),
+    "xz": (lzma.open, ".xz"),
+}
+
+
+def open_compressed(path, mode="r", compression=None):
+    """
+    open `path`, compressed with `compression`. if compression is None it is taken from the file suffix
+    """
+    if compression is None:
+        compression = next(
+            (k for k, (_, ext) in COMPRESSION.items() if str(path).endswith(ext)), None
+        )
+    if compression:
+        opener, _ = COMPRESSION[compression]
+        if "b" not in mode and "t" not in mode:
+            mode = f"{mode}t"
+        return opener(path, mode)
+    return open(path, mode)
+
 
 class Persister(Loggable):
     path = File
     path_name = Str
+    base = Str("persistence")
+    extension = ".csv"
+    compression = Enum(None, *COMPRESSION.keys())
+    binary = False
 
     def write(self, data):
         if isinstance(data, dict):
             pass
         self._write_hook(data)
 
+    def write_many(self, rows):
+        self._write_many_hook(rows)
+
     def __enter__(self):
-        self.path = self._new_path(self.path_name)
-        self._handle = open(self.path, "w")
+        if not self.path:
+            extension = self.extension
+            if self.compression:
+                extension = f"{extension}{COMPRESSION[self.compression][1]}"
+            self.path = self._new_path(self.base, self.path_name, extension=extension)
+
+        mode = "wb" if self.binary else "w"
+        self._handle = open_compressed(self.path, mode, self.compression or "")
         self._enter_hook()
 
         return self
@@ -48,7 +88,7 @@ class Persister(Loggable):
         self._handle.close()
 
     def _new_path(self, *args, **kw):
-        return paths.new_path("persistence", *args, **kw)
+        return paths.new_path(*args, **kw)
 
     def _enter_hook(self):
         pass
@@ -56,6 +96,10 @@ class Persister(Loggable):
     def _write_hook(self, data):
         pass
 
+    def _write_many_hook(self, rows):
+        for row in rows:
+            self._write_hook(row)
+
     def _exit_hook(self):
         pass
 
@@ -67,8 +111,13 @@ class CSVPersister(Persister):
     def _write_hook(self, data):
         self._writer.writerow(data)
 
+    def _write_many_hook(self, rows):
+        self._writer.writerows(rows)
+
 
 class JSONPersister(Persister):
+    extension = ".json"
+
     def add(self, key, payload):
         items = self._obj.get(key, [])
         items.append(payload)
@@ -85,6 +134,55 @@ class JSONPersister(Persister):
         json.dump(self._obj, self._handle)
 
 
+class NDJSONPersister(Persister):
+    """
+    one json object per line
+    """
+
+    extension = ".ndjson"
+
+    def _write_hook(self, data):
+        self._handle.write(json.dumps(data))
+        self._handle.write("\n")
+
+
+class ColumnarPersister(Persister):
+    """
+    binary columnar file of (t_ns, value) samples.
+
+    a `MAGIC` header followed by blocks. each block is the row count as a little-endian uint64, then the t_ns
+    column as int64 and the value column as float64. read back with `ColumnarPersister.read`
+    """
+
+    MAGIC = b"LABACOL1"
+    extension = ".bin"
+    binary = True
+
+    def _enter_hook(self):
+        self._handle.write(self.MAGIC)
+
+    def _write_hook(self, data):
+        t, v = data
+        self._handle.write(struct.pack("<Q", len(t)))
+        self._handle.write(t.astype("<i8", copy=False).tobytes())
+        self._handle.write(v.astype("<f8", copy=False).tobytes())
+
+    @classmethod
+    def read(cls, path, compression=None):
+        """
+        yield the (t_ns, values) blocks of a columnar file
+        """
+        with open_compressed(path, "rb", compression) as rfile:
+            if rfile.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError(f"{path} is not a columnar file")
+
+            while header := rfile.read(8):
+                (n,) = struct.unpack("<Q", header)
+                t = frombuffer(rfile.read(8 * n), dtype="<i8").astype(int64)
+                v = frombuffer(rfile.read(8 * n), dtype="<f8").astype(float64)
+                yield t, v
+
+
 class YAMLPersister(Persister):
     def _enter_hook(self):
         pass
@@ -0,0 +1,341 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import heapq
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Condition
+
+from traits.api import Int, Float
+
+from loggable import Loggable
+
+
+def compatible(period, base, tolerance=0.01):
+    """
+    True if `period` is a whole multiple of `base`
+    """
+    k = period / base
+    return round(k) >= 1 and abs(k - round(k)) <= tolerance
+
+
+class Subscription(object):
+    def __init__(self, scheduler, job, call, period, callback):
+        self.scheduler = scheduler
+        self.job = job
+        self.call = call
+        self.period = period
+        self.callback = callback
+        self.last = None
+
+    def cancel(self):
+        self.scheduler.unsubscribe(self)
+
+    def due(self, deadline):
+        """
+        True if this subscriber wants the result for `deadline`. subscribers slower than their job get every
+        k-th result
+        """
+        return (
+            self.last is None
+            or deadline - self.last >= self.period - self.job.period / 2
+        )
+
+
+class Call(object):
+    """
+    one set of arguments of a job and the subscriptions to its result
+    """
+
+    def __init__(self, key, args, kw):
+        self.key = key
+        self.args = args
+        self.kw = kw
+        self.subscriptions = []
+
+
+class Job(object):
+    def __init__(self, key, func, period, batch=None):
+        self.key = key
+        self.func = func
+        self.batch = batch
+        self.period = period
+        # (args, kw) key: Call
+        self.calls = {}
+        self.deadline = 0
+        self.running = False
+        self.cancelled = False
+
+        self.nruns = 0
+        self.nmissed = 0
+        self.nerrors = 0
+        self.total_jitter = 0.0
+        self.max_jitter = 0.0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+
+    @property
+    def subscriptions(self):
+        return [s for c in self.calls.values() for s in c.subscriptions]
+
+    @property
+    def name(self):
+        func = self.func
+        obj = getattr(func, "__self__", None)
+        name = getattr(func, "__name__", str(func))
+        return f"{obj.name}.{name}" if hasattr(obj, "name") else name
+
+    def to_dict(self):
+        n = self.nruns
+        return {
+            "name": self.name,
+            "period": self.period,
+            "subscribers": len(self.subscriptions),
+            "calls": len(self.calls),
+            "runs": n,
+            "missed": self.nmissed,
+            "errors": self.nerrors,
+            "mean_jitter": self.total_jitter / n if n else 0,
+            "max_jitter": self.max_jitter,
+            "mean_duration": self.total_duration / n if n else 0,
+            "max_duration": self.max_duration,
+        }
+
+
+class Scheduler(Loggable):
+    """
+    Runs every periodic device read of the dashboard cards.
+
+    Cards subscribe a (function, period, callback). Deadlines are kept on a fixed grid from a monotonic clock, so
+    a slow read does not push later reads back. A deadline that passes while the job is still running, or before
+    it could be dispatched, is counted as missed and skipped.
+
+    Subscriptions to the same function with the same arguments share one job when their periods are whole
+    multiples of each other. The job runs at the fastest period and slower subscribers get every k-th result.
+
+    Reads of one device are merged further if the device has a batch method for them, `<method>_batch(calls)`
+    taking a list of (args, kw) and returning one result per call, e.g. ADC.get_value_batch. Subscriptions to
+    that method with any arguments then share one job per compatible period, and each run makes one batch call
+    for the calls that are due, e.g. one block read of every channel a scan is plotting.
+
+    Jobs run on a pool of `workers` threads. Commands to one device are serialized by the device's I/O worker.
+
+    init.yml
+
+    scheduler:
+      workers: 4
+    """
+
+    workers = Int(4)
+    tolerance = Float(0.01)
+
+    def __init__(self, cfg=None, *args, **kw):
+        super().__init__(cfg, *args, **kw)
+        cfg = self.configobj
+        for k in ("workers", "tolerance"):
+            if k in cfg:
+                setattr(self, k, cfg[k])
+
+        self._cond = Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._jobs = {}
+        self._pool = None
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        with self._cond:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopped = False
+            self._pool = ThreadPoolExecutor(
+                self.workers, thread_name_prefix=f"{self.name}.worker"
+            )
+            self._thread = Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+        if self._pool:
+            self._pool.shutdown(wait=True)
+
+    def subscribe(self, func, period, callback, args=(), kw=None):
+        """
+        call `callback(func(*args, **kw))` every `period` seconds
+
+        :return: Subscription. call `cancel` to unsubscribe
+        """
+        kw = kw or {}
+        ckey = (tuple(args), repr(sorted(kw.items())))
+        batch = self._get_batch(func)
+        # batched jobs of a device take calls with any arguments
+        key = (func, None) if batch else (func, ckey)
+        with self._cond:
+            for job in self._jobs.get(key, []):
+                if compatible(period, job.period, self.tolerance):
+                    break
+
+                if all(
+                    compatible(s.period, period, self.tolerance)
+                    for s in job.subscriptions
+                ):
+                    # the new subscriber is faster. speed the job up
+                    job.period = period
+                    self._reschedule(job, time.monotonic())
+                    break
+            else:
+                job = Job(key, func, period, batch)
+                self._jobs.setdefault(key, []).append(job)
+                self._reschedule(job, time.monotonic())
+
+            call = job.calls.get(ckey)
+            if call is None:
+                call = job.calls[ckey] = Call(ckey, args, kw)
+
+            sub = Subscription(self, job, call, period, callback)
+            call.subscriptions.append(sub)
+            self._cond.notify()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._cond:
+            job = sub.job
+            if sub not in sub.call.subscriptions:
+                return
+
+            sub.call.subscriptions.remove(sub)
+            if not sub.call.subscriptions:
+                del job.calls[sub.call.key]
+            if not job.calls:
+                job.cancelled = True
+                self._jobs[job.key].remove(job)
+                if not self._jobs[job.key]:
+                    del self._jobs[job.key]
+                return
+
+            # slow the job down if the fastest subscriber left
+            period = min(s.period for s in job.subscriptions)
+            if period > job.period and all(
+                compatible(s.period, period, self.tolerance) for s in job.subscriptions
+            ):
+                job.period = period
+
+    def stats(self):
+        """
+        :return: list of per job dicts. jitter is the delay from a deadline to the start of its run, in seconds
+        """
+        with self._cond:
+            return [job.to_dict() for jobs in self._jobs.values() for job in jobs]
+
+    # private
+    def _get_batch(self, func):
+        obj = getattr(func, "__self__", None)
+        name = getattr(func, "__name__", None)
+        if obj is not None and name:
+            return getattr(obj, f"{name}_batch", None)
+
+    def _reschedule(self, job, deadline):
+        job.deadline = deadline
+        heapq.heappush(self._heap, (deadline, next(self._seq), job))
+
+    def _run(self):
+        with self._cond:
+            while not self._stopped:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                deadline, _, job = self._heap[0]
+                now = time.monotonic()
+                if deadline > now:
+                    self._cond.wait(deadline - now)
+                    continue
+
+                heapq.heappop(self._heap)
+                if job.cancelled or deadline != job.deadline:
+                    # unsubscribed or superseded by a reschedule
+                    continue
+
+                if job.running:
+                    job.nmissed += 1
+                else:
+                    job.running = True
+                    self._pool.submit(self._execute, job, deadline)
+
+                self._reschedule(job, self._next_deadline(job, deadline, now))
+
+    def _next_deadline(self, job, deadline, now):
+        nxt = deadline + job.period
+        if nxt <= now:
+            # fell behind. skip to the next deadline on the grid
+            missed = int((now - nxt) // job.period) + 1
+            job.nmissed += missed
+            nxt += missed * job.period
+        return nxt
+
+    def _execute(self, job, deadline):
+        with self._cond:
+            calls = [
+                c
+                for c in job.calls.values()
+                if any(s.due(deadline) for s in c.subscriptions)
+            ]
+
+        st = time.monotonic()
+        try:
+            if job.batch:
+                values = job.batch([(c.args, c.kw) for c in calls])
+            else:
+                values = [job.func(*c.args, **c.kw) for c in calls]
+        except BaseException:
+            job.nerrors += 1
+            self.debug_exception()
+            values = []
+            ok = False
+        else:
+            ok = True
+
+        et = time.monotonic()
+        with self._cond:
+            job.running = False
+            job.nruns += 1
+            jitter = st - deadline
+            job.total_jitter += jitter
+            job.max_jitter = max(job.max_jitter, jitter)
+            duration = et - st
+            job.total_duration += duration
+            job.max_duration = max(job.max_duration, duration)
+
+            results = []
+            for c, value in zip(calls, values):
+                for s in c.subscriptions:
+                    if s.due(deadline):
+                        s.last = deadline
+                        results.append((s, value))
+
+        for s, value in results:
+            try:
+                s.callback(value)
+            except BaseException:
+                self.debug_exception()
+
+
+# ============= EOF =============================================
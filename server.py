@@ -52,6 +52,12 @@ class Server(Loggable):
             "kwargs": <keyward arguments to pass into the automation when it is executed>
         }
 
+        or
+        {
+            "export": <list of datastreams, "device_name.name">,
+            "kwargs": <start, end, format, compression. see Exporter.export>
+        }
+
         :returns
         {
             "message": ...
@@ -85,6 +91,18 @@ class Server(Loggable):
                             reply = {"message": "OK", "response": func(**kwargs)}
                         except AttributeError:
                             reply = {"message": f"invalid function={func_name}"}
+            elif "export" in message:
+                try:
+                    resp = self.application.exporter.export(
+                        message["export"], **message.get("kwargs", {})
+                    )
+                    reply = {"message": "OK", "response": resp}
+                except (TypeError, ValueError) as e:
+                    reply = {"message": f"invalid export. {e}"}
+                except Exception as e:
+                    # the server must keep answering, whatever went wrong
+                    self.debug_exception()
+                    reply = {"message": f"export failed. {e}"}
             else:
                 automation_name = message.get("automation")
                 if automation_name:
@@ -0,0 +1,148 @@
+import unittest
+
+from numpy import isnan
+from numpy.testing import assert_allclose
+
+from hardware.adc import ADC, Channel
+from hardware.calibration import ChannelMapper
+from hardware.communicator import Communicator
+from integrations.drivers.m1000 import M1000
+
+
+class M1000StandIn(Communicator):
+    """
+    answers M1000 short form reads. module n reads n volts
+    """
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self.queries = []
+        self.batches = []
+
+    def ask_many(self, msgs, *args, **kw):
+        self.batches.append(list(msgs))
+        return super().ask_many(msgs, *args, **kw)
+
+    def _ask(self, msg, *args, **kw):
+        self.queries.append(msg)
+        if msg == "$RB":
+            return "*+00001.00,*+00002.00,*+00003.00,"
+        if msg == "$9RD":
+            return "?"
+        return f"*+0000{msg[1]}.00"
+
+
+class ReadChannelsTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self._driver = M1000()
+        self._driver.load({})
+        self._driver.communicator = M1000StandIn()
+
+    def test_read_channel(self):
+        self.assertEqual(self._driver.read_channel("2"), 2.0)
+        self.assertEqual(self._driver.communicator.queries, ["$2RD"])
+
+    def test_module_address(self):
+        # a configured module address is used for every channel
+        self._driver.load({"address": "2"})
+        self.assertEqual(self._driver.read_channel("1"), 2.0)
+        self.assertEqual(self._driver.read_channel("3"), 2.0)
+        self.assertEqual(self._driver.communicator.queries, ["$2RD", "$2RD"])
+
+    def test_pipelined(self):
+        self.assertEqual(self._driver.read_channels(["1", "2", "3"]), [1.0, 2.0, 3.0])
+        self.assertEqual(self._driver.communicator.batches, [["$1RD", "$2RD", "$3RD"]])
+
+    def test_bad_reply(self):
+        self.assertEqual(self._driver.read_channels(["1", "9"]), [1.0, None])
+
+    def test_block(self):
+        self._driver.load({"block_command": "RB"})
+        self.assertEqual(self._driver.read_channels(["3", "1", "5"]), [3.0, 1.0, None])
+        self.assertEqual(self._driver.communicator.queries, ["$RB"])
+
+
+class MapValuesTestCase(unittest.TestCase):
+    def test_matches_map_value(self):
+        channels = [
+            Channel(name="a", address="1", mapping="3,2,1"),
+            Channel(name="b", address="2", mapping="2,0.5"),
+            Channel(name="c", address="3", mapping=None),
+        ]
+        raw = [1.5, -2.0, 7.0]
+        values = ChannelMapper([c.calibration for c in channels])(raw)
+        assert_allclose(values, [c.map_value(r) for c, r in zip(channels, raw)])
+
+    def test_failed_read(self):
+        channels = [Channel(name="a", address="1", mapping="2,0")]
+        mapper = ChannelMapper([c.calibration for c in channels])
+        self.assertTrue(isnan(mapper([None])[0]))
+        self.assertIsNone(channels[0].map_value(None))
+
+    def test_mixed(self):
+        channels = [
+            Channel(name="a", address="1", mapping="2,0"),
+            Channel(
+                name="b",
+                address="2",
+                calibration={"kind": "piecewise", "points": [[0, 0], [10, 100]]},
+            ),
+            Channel(name="c", address="3", mapping="1,0,0"),
+        ]
+        mapper = ChannelMapper([c.calibration for c in channels])
+        assert_allclose(mapper([1.0, 2.5, 3.0]), [2.0, 25.0, 9.0])
+
+
+class GetValuesTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self._adc = ADC(name="adc")
+        self._adc.load(
+            {
+                "channels": [
+                    {"name": "a", "address": "1", "mapping": "2,0"},
+                    {"name": "b", "address": "2", "mapping": "1,2,3"},
+                ]
+            }
+        )
+        self._adc.driver = M1000()
+        self._adc.driver.load({})
+        self._adc.driver.communicator = M1000StandIn()
+        self._updates = []
+        self._adc.observe(lambda e: self._updates.append(e.new), "update")
+
+    def tearDown(self) -> None:
+        self._adc.close()
+
+    def test_get_values(self):
+        values = self._adc.get_values()
+        assert_allclose(values, [2.0, 11.0])
+        self.assertEqual([u["datastream"] for u in self._updates], ["a", "b"])
+        self.assertEqual(len(self._adc.driver.communicator.batches), 1)
+
+    def test_fills_cache(self):
+        self._adc.get_values()
+        self.assertEqual(self._adc.get_value(1, max_age=10), 11.0)
+        self.assertEqual(len(self._adc.driver.communicator.queries), 2)
+
+    def test_get_value_batch(self):
+        values = self._adc.get_value_batch(
+            [((1,), {"datastream": "scan"}), ((0,), {"datastream": "scan"}), ((1,), {})]
+        )
+        self.assertEqual(values, [11.0, 2.0, 11.0])
+        # one pipelined read of the two channels
+        self.assertEqual(self._adc.driver.communicator.batches, [["$2RD", "$1RD"]])
+        self.assertEqual(
+            [(u["datastream"], u["value"]) for u in self._updates],
+            [("scan", 11.0), ("scan", 2.0), ("default", 11.0)],
+        )
+        self.assertEqual(self._adc.get_value(0, max_age=10), 2.0)
+        self.assertEqual(len(self._adc.driver.communicator.queries), 2)
+
+    def test_channels_changed(self):
+        self._adc.get_values()
+        self._adc.channels = self._adc.channels[:1]
+        assert_allclose(self._adc.get_values(), [2.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
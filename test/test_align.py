@@ -0,0 +1,59 @@
+import unittest
+
+from numpy import array, arange, isnan, allclose, int64, float64
+
+from db.align import align, asof, linear, mean, time_base
+
+
+class AlignTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        # jittery samples every ~10 ns
+        self._t = array([0, 9, 21, 30, 38, 52], dtype=int64)
+        self._v = array([0, 1, 2, 3, 4, 5], dtype=float64)
+        self._grid = time_base(0, 50, step=10)
+
+    def test_time_base(self):
+        self.assertEqual(list(self._grid), [0, 10, 20, 30, 40, 50])
+        self.assertEqual(len(time_base(0, 990, npoints=100)), 100)
+
+    def test_asof(self):
+        v = asof(self._t, self._v, self._grid)
+        self.assertEqual(list(v), [0, 1, 1, 3, 4, 4])
+
+        v = asof(self._t, self._v, self._grid - 5)
+        self.assertTrue(isnan(v[0]))
+
+        v = asof(self._t, self._v, self._grid, tolerance=1)
+        self.assertTrue(isnan(v[2]))
+        self.assertEqual(v[3], 3)
+
+    def test_linear(self):
+        v = linear(self._t, self._v, self._grid)
+        self.assertTrue(
+            allclose(v, [0, 1 + 1 / 12, 1 + 11 / 12, 3, 4 + 2 / 14, 4 + 12 / 14])
+        )
+        self.assertTrue(isnan(linear(self._t, self._v, array([-1, 60]))).all())
+
+        v = linear(self._t, self._v, self._grid, tolerance=12)
+        self.assertTrue(isnan(v[4]) and isnan(v[5]))
+        self.assertFalse(isnan(v[1]))
+
+    def test_mean(self):
+        v = mean(self._t, self._v, self._grid)
+        # [0, 10) -> 0, 9; [20, 30) -> 21; [30, 40) -> 30, 38; [50, 60) -> 52
+        self.assertEqual(list(v[[0, 2, 3, 5]]), [0.5, 2, 3.5, 5])
+        self.assertTrue(isnan(v[1]) and isnan(v[4]))
+
+    def test_align(self):
+        t2 = arange(0, 60, 5, dtype=int64)
+        out = align([(self._t, self._v), (t2, t2 * 2.0)], self._grid, "asof")
+        self.assertEqual(out.shape, (2, 6))
+        self.assertEqual(list(out[1]), list(self._grid * 2.0))
+
+    def test_empty(self):
+        self.assertTrue(isnan(mean(self._t[:0], self._v[:0], self._grid)).all())
+        self.assertTrue(isnan(linear(self._t[:0], self._v[:0], self._grid)).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
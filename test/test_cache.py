@@ -0,0 +1,141 @@
+import threading
+import time
+import unittest
+
+from hardware.adc import ADC, Channel
+from hardware.cache import ReadCache
+from hardware.driver.driver import Driver
+
+
+class SlowDriver(Driver):
+    nreads = 0
+
+    def read_channel(self, channel):
+        self.nreads += 1
+        time.sleep(0.05)
+        return 1.0
+
+
+def concurrent(func, n=8):
+    """
+    call func from n threads at once
+    """
+    barrier = threading.Barrier(n)
+    results = []
+
+    def target():
+        barrier.wait()
+        results.append(func())
+
+    threads = [threading.Thread(target=target) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+class ReadCacheTestCase(unittest.TestCase):
+    def test_single_flight(self):
+        cache = ReadCache()
+        calls = []
+
+        def read():
+            calls.append(1)
+            time.sleep(0.05)
+            return len(calls)
+
+        results = concurrent(lambda: cache.get("1", read))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [1] * 8)
+        self.assertEqual(cache.stats()["saved"], 7)
+
+    def test_no_max_age(self):
+        cache = ReadCache()
+        self.assertEqual(cache.get("1", lambda: 1), 1)
+        self.assertEqual(cache.get("1", lambda: 2), 2)
+        self.assertEqual(cache.nhits, 0)
+
+    def test_max_age(self):
+        cache = ReadCache({"max_age": 0.05})
+        self.assertEqual(cache.get("1", lambda: 1), 1)
+        self.assertEqual(cache.get("1", lambda: 2), 1)
+        self.assertEqual(cache.get("2", lambda: 3), 3)
+        time.sleep(0.06)
+        self.assertEqual(cache.get("1", lambda: 4), 4)
+        self.assertEqual(
+            cache.stats(), {"hits": 1, "misses": 3, "coalesced": 0, "saved": 1}
+        )
+
+    def test_max_age_override(self):
+        cache = ReadCache()
+        cache.get("1", lambda: 1)
+        self.assertEqual(cache.get("1", lambda: 2, max_age=10), 1)
+
+    def test_invalidate(self):
+        cache = ReadCache({"max_age": 10})
+        cache.get("1", lambda: 1)
+        cache.invalidate("1")
+        self.assertEqual(cache.get("1", lambda: 2), 2)
+
+    def test_exception(self):
+        cache = ReadCache()
+
+        def fail():
+            time.sleep(0.05)
+            raise IOError("bus error")
+
+        errors = []
+
+        def get():
+            try:
+                cache.get("1", fail)
+            except IOError as e:
+                errors.append(e)
+
+        concurrent(get, n=4)
+        self.assertEqual(len(errors), 4)
+        self.assertEqual(cache.get("1", lambda: 5), 5)
+
+
+class ADCCacheTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self._adc = ADC(name="adc")
+        self._adc.channels = [Channel(name="1", address="1", mapping="2,0")]
+        self._adc.driver = SlowDriver()
+        self._updates = []
+        self._adc.observe(lambda e: self._updates.append(e.new), "update")
+
+    def tearDown(self) -> None:
+        self._adc.close()
+
+    def test_coalesced_reads(self):
+        results = concurrent(self._adc.get_value)
+        self.assertEqual(results, [2.0] * 8)
+        self.assertEqual(self._adc.driver.nreads, 1)
+        self.assertEqual(len(self._updates), 1)
+        self.assertEqual(self._adc.cache.stats()["coalesced"], 7)
+
+    def test_coalesced_datastreams(self):
+        names = iter(f"ds{i % 2}" for i in range(8))
+        lock = threading.Lock()
+
+        def get():
+            with lock:
+                name = next(names)
+            return self._adc.get_value(datastream=name)
+
+        concurrent(get)
+        self.assertEqual(self._adc.driver.nreads, 1)
+        # every datastream gets the shared read once
+        self.assertEqual(sorted(u["datastream"] for u in self._updates), ["ds0", "ds1"])
+        self.assertEqual(len({u["t_ns"] for u in self._updates}), 1)
+
+    def test_sequential_reads(self):
+        self._adc.get_value()
+        self._adc.get_value()
+        self.assertEqual(self._adc.driver.nreads, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+import unittest
+
+from numpy import isnan, linspace, nan, polyval
+from numpy.testing import assert_allclose
+
+from hardware.calibration import (
+    IDENTITY,
+    ChannelMapper,
+    LookupTable,
+    PiecewiseLinear,
+    Polynomial,
+    make_calibration,
+    remap,
+)
+from hardware.dac import DAC
+from hardware.driver.driver import Driver
+
+
+class PolynomialTestCase(unittest.TestCase):
+    def test_matches_polyval(self):
+        c = Polynomial([3, 2, 1])
+        x = linspace(-5, 5, 11)
+        assert_allclose(c(x), polyval([3, 2, 1], x))
+        self.assertEqual(c(2), polyval([3, 2, 1], 2))
+        self.assertIsInstance(c(2), float)
+
+    def test_failed_read(self):
+        c = Polynomial([2, 0])
+        self.assertIsNone(c(None))
+        self.assertTrue(isnan(c([nan])[0]))
+
+    def test_linear_inverse(self):
+        c = Polynomial([2, 1])
+        self.assertEqual(c.inverse(5), 2)
+        assert_allclose(c.inverse(c(linspace(0, 1, 5))), linspace(0, 1, 5))
+
+    def test_cubic_inverse(self):
+        c = Polynomial([1, 0, 1, 0], domain=(-2, 2))
+        x = linspace(-1.5, 1.5, 7)
+        assert_allclose(c.inverse(c(x)), x, atol=1e-3)
+        # outside the domain
+        self.assertTrue(isnan(c.inverse(100)))
+
+    def test_not_monotonic(self):
+        with self.assertRaises(ValueError):
+            Polynomial([1, 0, 0]).inverse(1)
+
+    def test_leading_zeros(self):
+        self.assertEqual(Polynomial([0, 0, 2, 1]).degree, 1)
+
+
+class InterpolatedTestCase(unittest.TestCase):
+    def test_piecewise(self):
+        c = PiecewiseLinear([[0, 0], [5, 100], [10, 150]])
+        assert_allclose(c([2.5, 7.5, 20]), [50, 125, 150])
+        self.assertEqual(c.inverse(125), 7.5)
+
+    def test_piecewise_decreasing(self):
+        c = PiecewiseLinear(["0,10", "10,0"])
+        self.assertEqual(c.inverse(2.5), 7.5)
+
+    def test_piecewise_not_monotonic(self):
+        c = PiecewiseLinear([[0, 0], [1, 1], [2, 0]])
+        self.assertEqual(c(0.5), 0.5)
+        with self.assertRaises(ValueError):
+            c.inverse(0.5)
+
+    def test_lut(self):
+        c = LookupTable([0, 10, 40], start=1, step=0.5)
+        assert_allclose(c([1, 1.25, 1.75]), [0, 5, 25])
+        self.assertEqual(c.inverse(25), 1.75)
+
+
+class MakeCalibrationTestCase(unittest.TestCase):
+    def test_legacy_mapping(self):
+        self.assertEqual(make_calibration("3,2,1"), Polynomial([3, 2, 1]))
+        self.assertIs(make_calibration(None), IDENTITY)
+
+    def test_round_trip(self):
+        for c in (
+            Polynomial([3, 2, 1]),
+            PiecewiseLinear([[0, 0], [5, 100]]),
+            LookupTable([0, 1, 4], start=-1, step=2),
+        ):
+            d = c.to_dict()
+            self.assertEqual(make_calibration(d), c)
+            self.assertEqual(make_calibration(d).to_dict(), d)
+
+    def test_unknown_kind(self):
+        with self.assertRaises(ValueError):
+            make_calibration({"kind": "spline"})
+
+
+class ChannelMapperTestCase(unittest.TestCase):
+    def test_matches_calibrations(self):
+        cals = [
+            Polynomial([3, 2, 1]),
+            IDENTITY,
+            PiecewiseLinear([[0, 0], [10, 100]]),
+            Polynomial([0.5, 0]),
+        ]
+        raw = [1.5, -2.0, 2.5, None]
+        values = ChannelMapper(cals)(raw)
+        assert_allclose(values[:3], [c(r) for c, r in zip(cals, raw[:3])])
+        self.assertTrue(isnan(values[3]))
+
+    def test_remap(self):
+        old = Polynomial([2, 0])
+        new = Polynomial([3, 1])
+        raw = linspace(0, 1, 5)
+        assert_allclose(remap(old(raw), old, new), new(raw))
+
+
+class DACStandIn(Driver):
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self.writes = []
+
+    def write_channel(self, channel, volts):
+        self.writes.append((channel, volts))
+
+
+class DACTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self._dac = DAC(name="dac")
+        self._dac.load(
+            {
+                "channels": [
+                    {
+                        "name": "heater",
+                        "address": "1",
+                        "calibration": {
+                            "kind": "piecewise",
+                            "points": [[0, 0], [10, 100]],
+                        },
+                    }
+                ]
+            }
+        )
+        self._dac.driver = DACStandIn()
+
+    def tearDown(self) -> None:
+        self._dac.close()
+
+    def test_write(self):
+        self._dac.write_channel("heater", 50)
+        self.assertEqual(self._dac.driver.writes, [("1", 5)])
+
+    def test_out_of_range(self):
+        with self.assertRaises(ValueError):
+            self._dac.write_channel("heater", 200)
+        self.assertEqual(self._dac.driver.writes, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
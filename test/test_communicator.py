@@ -0,0 +1,361 @@
+import asyncio
+import os
+import select
+import socket
+import socketserver
+import threading
+import time
+import unittest
+
+from hardware import aio
+from hardware.device import Device
+from hardware.driver.driver import Driver
+from hardware.communicator import (
+    EthernetCommunicator,
+    UDPCommunicator,
+    SerialCommunicator,
+    checksum,
+)
+
+
+class EchoHandler(socketserver.StreamRequestHandler):
+    """
+    replies "echo:<query>" to every newline terminated query. "slow" replies after 0.3 s, "drop" closes the
+    connection
+    """
+
+    def handle(self):
+        self.server.connections += 1
+        for line in self.rfile:
+            q = line.strip().decode()
+            if q == "drop":
+                return
+            if q == "slow":
+                time.sleep(0.3)
+            self.wfile.write(f"echo:{q}\n".encode())
+
+
+class UDPEchoHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        data, sock = self.request
+        sock.sendto(b"echo:" + data.strip() + b"\n", self.client_address)
+
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    connections = 0
+
+
+def serve(server):
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    return server
+
+
+class TCPCommunicatorTestCase(unittest.TestCase):
+    backend = "thread"
+
+    def setUp(self) -> None:
+        self._server = serve(TCPServer(("127.0.0.1", 0), EchoHandler))
+        self._port = self._server.server_address[1]
+        self._comm = self._make()
+
+    def tearDown(self) -> None:
+        self._comm.close()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _make(self, **kw):
+        cfg = {
+            "address": f"127.0.0.1:{self._port}",
+            "timeout": 0.2,
+            "reconnect_interval": 0.05,
+            "backend": self.backend,
+        }
+        cfg.update(kw)
+        comm = EthernetCommunicator(cfg)
+        comm.open()
+        return comm
+
+    def _wait_connected(self, comm):
+        for _ in range(100):
+            if comm.is_connected():
+                return True
+            time.sleep(0.02)
+
+    def test_address(self):
+        self.assertEqual(self._comm.host, "127.0.0.1")
+        self.assertEqual(self._comm.port, self._port)
+
+    def test_ask(self):
+        self.assertEqual(self._comm.ask("hello"), "echo:hello")
+
+    def test_persistent(self):
+        for i in range(5):
+            self.assertEqual(self._comm.ask(f"q{i}"), f"echo:q{i}")
+        self.assertEqual(self._server.connections, 1)
+
+    def test_terminator_not_doubled(self):
+        self.assertEqual(self._comm.ask("hello\n"), "echo:hello")
+        self.assertEqual(self._comm.ask("again"), "echo:again")
+
+    def test_timeout_resync(self):
+        self.assertIsNone(self._comm.ask("slow"))
+        self.assertEqual(self._comm.ntimeouts, 1)
+        # the late reply to "slow" is discarded
+        time.sleep(0.2)
+        self.assertEqual(self._comm.ask("next"), "echo:next")
+
+    def test_ask_many(self):
+        msgs = [f"q{i}" for i in range(10)]
+        self.assertEqual(self._comm.ask_many(msgs), [f"echo:{m}" for m in msgs])
+
+    def test_pipeline(self):
+        comm = self._make(pipeline=True)
+        try:
+            msgs = [f"q{i}" for i in range(50)]
+            self.assertEqual(comm.ask_many(msgs), [f"echo:{m}" for m in msgs])
+        finally:
+            comm.close()
+
+    def test_reconnect(self):
+        self.assertIsNone(self._comm.ask("drop"))
+        self.assertFalse(self._comm.is_connected())
+        self.assertTrue(self._wait_connected(self._comm))
+        self.assertEqual(self._comm.ask("back"), "echo:back")
+        self.assertEqual(self._comm.nreconnects, 1)
+
+    def test_connect_in_background(self):
+        s = socket.socket()
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+        s.close()
+
+        comm = EthernetCommunicator(
+            {
+                "address": f"127.0.0.1:{port}",
+                "reconnect_interval": 0.05,
+                "backend": self.backend,
+            }
+        )
+        comm.open()
+        try:
+            st = time.perf_counter()
+            self.assertIsNone(comm.ask("hello"))
+            self.assertLess(time.perf_counter() - st, 0.05)
+
+            server = serve(TCPServer(("127.0.0.1", port), EchoHandler))
+            try:
+                self.assertTrue(self._wait_connected(comm))
+                self.assertEqual(comm.ask("hello"), "echo:hello")
+            finally:
+                server.shutdown()
+                server.server_close()
+        finally:
+            comm.close()
+
+
+class UDPCommunicatorTestCase(unittest.TestCase):
+    backend = "thread"
+
+    def setUp(self) -> None:
+        self._server = serve(
+            socketserver.ThreadingUDPServer(("127.0.0.1", 0), UDPEchoHandler)
+        )
+        port = self._server.server_address[1]
+        self._comm = UDPCommunicator(
+            {
+                "address": f"127.0.0.1:{port}",
+                "timeout": 0.5,
+                "backend": self.backend,
+            }
+        )
+        self._comm.open()
+
+    def tearDown(self) -> None:
+        self._comm.close()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def test_ask(self):
+        self.assertEqual(self._comm.ask("hello"), "echo:hello")
+        self.assertEqual(self._comm.ask("again"), "echo:again")
+
+
+class StandInDevice(object):
+    """
+    answers on the master side of a pty. replies are written in two parts to exercise read buffering
+    """
+
+    def __init__(self):
+        self.master, slave = os.openpty()
+        self.path = os.ttyname(slave)
+        self._slave = slave
+        self._alive = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._alive = False
+        self._thread.join(1)
+        os.close(self.master)
+        os.close(self._slave)
+
+    def _run(self):
+        buf = b""
+        while self._alive:
+            r, _, _ = select.select([self.master], [], [], 0.05)
+            if not r:
+                continue
+            buf += os.read(self.master, 1024)
+            while b"\r" in buf:
+                q, buf = buf.split(b"\r", 1)
+                self._reply(q)
+
+    def _reply(self, q):
+        if q == b"$1RD":
+            r = b"*+00072.00\r"
+        elif q == b"#1RD":
+            body = b"*1RD+00072.00"
+            r = body + checksum(body) + b"\r"
+        elif q == b"BAD":
+            r = b"*1RD+00072.0000\r"
+        elif q == b"LEN":
+            r = b"ABCD"
+        elif q == b"SLOW":
+            time.sleep(0.3)
+            r = b"late\r"
+        else:
+            r = b"?" + q + b"\r"
+
+        os.write(self.master, r[:3])
+        time.sleep(0.01)
+        os.write(self.master, r[3:])
+
+
+class SerialCommunicatorTestCase(unittest.TestCase):
+    backend = "thread"
+
+    def setUp(self) -> None:
+        self._device = StandInDevice()
+        self.addCleanup(self._device.close)
+
+    def _make(self, **kw):
+        cfg = {"address": self._device.path, "timeout": 0.2, "backend": self.backend}
+        cfg.update(kw)
+        comm = SerialCommunicator(cfg)
+        self.assertTrue(comm.open())
+        self.addCleanup(comm.close)
+        return comm
+
+    def test_terminator(self):
+        comm = self._make()
+        for _ in range(3):
+            self.assertEqual(comm.ask("$1RD"), "*+00072.00")
+
+    def test_checksum(self):
+        comm = self._make(frame="checksum")
+        self.assertEqual(comm.ask("#1RD"), "*1RD+00072.00")
+        self.assertIsNone(comm.ask("BAD"))
+        self.assertEqual(comm.nbad_frames, 1)
+        self.assertEqual(comm.ask("#1RD"), "*1RD+00072.00")
+
+    def test_length(self):
+        comm = self._make(frame="length", read_length=4)
+        self.assertEqual(comm.ask("LEN"), "ABCD")
+
+    def test_timeout_resync(self):
+        comm = self._make()
+        self.assertIsNone(comm.ask("SLOW"))
+        self.assertEqual(comm.ntimeouts, 1)
+        time.sleep(0.3)
+        self.assertEqual(comm.ask("$1RD"), "*+00072.00")
+
+    def test_stats(self):
+        comm = self._make()
+        comm.ask("$1RD")
+        comm.ask("$1RD")
+        stats = comm.stats()
+        self.assertEqual(stats["transactions"], 2)
+        self.assertGreater(stats["max_latency"], 0.01)
+        self.assertEqual(stats["timeouts"], 0)
+
+    def test_missing_port(self):
+        comm = SerialCommunicator(
+            {"address": "/dev/does-not-exist", "backend": self.backend}
+        )
+        self.assertIsNone(comm.open())
+        self.assertIsNone(comm.ask("$1RD"))
+
+
+class AsyncTCPCommunicatorTestCase(TCPCommunicatorTestCase):
+    backend = "asyncio"
+
+    def test_one_thread(self):
+        aio.get_loop()
+        n = threading.active_count()
+        devices = []
+        for i in range(20):
+            device = Device(name=f"dev{i}")
+            device.driver = Driver(communicator=self._make())
+            devices.append(device)
+        try:
+            for i, device in enumerate(devices):
+                self.assertEqual(
+                    device.io(device.driver.ask, f"q{i}", timeout=1), f"echo:q{i}"
+                )
+            # server side threads, plus executor threads shared by all devices. no thread per device
+            self.assertLess(threading.active_count() - n, 40)
+            self.assertFalse(
+                [t for t in threading.enumerate() if t.name.endswith(".io")]
+            )
+        finally:
+            for device in devices:
+                device.close()
+
+    def test_reconnect_without_thread(self):
+        n = threading.active_count()
+        self.assertIsNone(self._comm.ask("drop"))
+        self.assertTrue(self._wait_connected(self._comm))
+        self.assertLessEqual(threading.active_count(), n)
+
+    def test_aask(self):
+        async def gather():
+            return await asyncio.gather(
+                *(comm.aask(f"q{i}") for i, comm in enumerate(comms))
+            )
+
+        comms = [self._make() for _ in range(5)]
+        try:
+            resps = aio.run(gather())
+            self.assertEqual(resps, [f"echo:q{i}" for i in range(5)])
+        finally:
+            for comm in comms:
+                comm.close()
+
+    def test_aask_shared(self):
+        async def gather():
+            return await asyncio.gather(*(self._comm.aask(f"q{i}") for i in range(5)))
+
+        # the lock serializing one communicator is made on the transport loop
+        self.assertEqual(aio.run(gather()), [f"echo:q{i}" for i in range(5)])
+
+    def test_blocking_call_on_loop(self):
+        async def blocking():
+            return self._comm.ask("hello")
+
+        with self.assertRaises(RuntimeError):
+            aio.run(blocking())
+
+
+class AsyncUDPCommunicatorTestCase(UDPCommunicatorTestCase):
+    backend = "asyncio"
+
+
+class AsyncSerialCommunicatorTestCase(SerialCommunicatorTestCase):
+    backend = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()
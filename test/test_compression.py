@@ -0,0 +1,99 @@
+import unittest
+
+from numpy import arange, interp, sin, abs as nabs, array
+
+from db.compression import Compressor, Deadband, SwingingDoor
+from db.rollup import NS
+
+
+def run(f, t, v):
+    kept = []
+    for ti, vi in zip(t, v):
+        kept.extend(f.add(ti, vi))
+    kept.extend(f.flush())
+    return kept
+
+
+class DeadbandTestCase(unittest.TestCase):
+    def test_absolute(self):
+        kept = run(Deadband(absolute=0.5), range(6), [0, 0.1, 0.4, 0.6, 0.7, 1.2])
+        self.assertEqual([v for t, v in kept], [0, 0.6, 1.2])
+
+    def test_relative(self):
+        kept = run(Deadband(relative=0.1), range(4), [100, 105, 111, 115])
+        self.assertEqual([v for t, v in kept], [100, 111])
+
+    def test_heartbeat(self):
+        t = [i * NS for i in range(10)]
+        kept = run(Deadband(absolute=1, max_interval=3), t, [0] * 10)
+        self.assertEqual([t for t, v in kept], [0, 3 * NS, 6 * NS, 9 * NS])
+
+
+class SwingingDoorTestCase(unittest.TestCase):
+    def test_line(self):
+        # a straight line compresses to its end points
+        t = [i * NS for i in range(100)]
+        kept = run(SwingingDoor(0.01), t, [i * 0.5 for i in range(100)])
+        self.assertEqual([t for t, v in kept], [0, 99 * NS])
+
+    def test_shape(self):
+        t = arange(2000) * NS // 10
+        v = sin(arange(2000) / 100.0)
+        kept = run(SwingingDoor(0.01), t, v)
+        self.assertLess(len(kept), 200)
+
+        # the kept points reconstruct the signal. the error of swinging door trending is bounded by twice the
+        # deviation
+        kt, kv = array(kept).T
+        self.assertLessEqual(nabs(interp(t, kt, kv) - v).max(), 0.02)
+
+    def test_heartbeat(self):
+        t = [i * NS for i in range(10)]
+        kept = run(SwingingDoor(1, max_interval=4), t, [0] * 10)
+        # the held sample is kept before the heartbeat
+        self.assertEqual(
+            [t for t, v in kept], [0, 3 * NS, 4 * NS, 7 * NS, 8 * NS, 9 * NS]
+        )
+
+
+class CompressorTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self._c = Compressor(
+            {
+                "rules": [
+                    {"device": "adc", "datastream": "scan", "swinging_door": 0.1},
+                    {"device": "adc", "deadband": 0.5},
+                ]
+            }
+        )
+
+    def test_rules(self):
+        out = []
+        for i in range(10):
+            out += self._c.add("default", "adc", {"value": 0.1 * i, "t_ns": i * NS})
+        self.assertEqual([m["value"] for m in out], [0, 0.6000000000000001])
+
+        # no rule, no compression
+        for i in range(10):
+            self.assertEqual(
+                len(self._c.add("default", "mks", {"value": 0, "t_ns": i})), 1
+            )
+
+        # events pass through
+        self.assertEqual(
+            len(self._c.add("default", "adc", {"value": "on", "t_ns": 11 * NS})), 1
+        )
+
+    def test_flush(self):
+        out = []
+        for i in range(10):
+            out += self._c.add("scan", "adc", {"value": i, "t_ns": i * NS})
+        self.assertEqual(len(out), 1)
+
+        out = self._c.flush("scan", "adc")
+        self.assertEqual(out, [{"datastream": "scan", "value": 9, "t_ns": 9 * NS}])
+        self.assertEqual(self._c.stats()["adc.scan"], {"in": 10, "out": 2, "ratio": 5})
+
+
+if __name__ == "__main__":
+    unittest.main()
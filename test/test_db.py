@@ -0,0 +1,1229 @@
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+from threading import Event
+from pathlib import Path
+
+ROOT = tempfile.mkdtemp()
+os.environ["LABA_ROOT"] = ROOT
+
+import numpy as np
+from sqlalchemy import text
+
+from db.archive import Archive
+from db.backup import archive_path
+from db.db import DBClient, SampleTbl, EventTbl, DatastreamTbl
+from db.export import Exporter
+from db.importer import Importer, parse_times
+from db.spool import Spool, RECORD
+from db.maintenance import Maintenance
+from db.migrations import MIGRATIONS, latest_version
+from db.downsample import concatenate_chunks
+from db.rollup import NS, pick_resolution
+from db.writer import MeasurementWriter
+from persister import CSVPersister, ColumnarPersister, JSONPersister, open_compressed
+
+
+class DBTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self._path = Path(tempfile.mkdtemp(dir=ROOT), "recorder.db")
+        self._client = DBClient(path=self._path)
+        self._client.build()
+        self._client.add_device("adc")
+        self._client.add_datastream("default", "adc")
+
+    def _count(self, name="default", device_name="adc"):
+        with self._client.session() as sess:
+            d = self._client.get_datastream(name, device_name, sess=sess)
+            q = sess.query(SampleTbl)
+            q = q.filter(SampleTbl.datastream_id == d.id)
+            return q.count()
+
+
+class StorageProfileTestCase(DBTestCase):
+    def test_settings_in_effect(self):
+        settings = self._client.storage_settings()
+        self.assertEqual(settings["journal_mode"], "wal")
+        self.assertEqual(settings["synchronous"], 1)
+        self.assertEqual(settings["busy_timeout"], 5000)
+
+    def test_configured_profile(self):
+        client = DBClient(
+            {"storage": {"synchronous": "full", "busy_timeout": 100}}, path=self._path
+        )
+        settings = client.storage_settings()
+        self.assertEqual(settings["synchronous"], 2)
+        self.assertEqual(settings["busy_timeout"], 100)
+
+    def test_reader_does_not_block_writer(self):
+        self._client.add_measurement("default", "adc", value=1)
+        with self._client.session(readonly=True) as rsess:
+            d = self._client.get_datastream("default", "adc", sess=rsess)
+            self.assertEqual(len(d.samples), 1)
+
+            # an open read transaction must not stall the writer
+            self._client.add_measurement("default", "adc", value=2)
+            self.assertEqual(self._count(), 2)
+
+    def test_reader_is_readonly(self):
+        with self._client.session(readonly=True) as sess:
+            with self.assertRaises(Exception):
+                self._client.add_device("mks", sess=sess)
+
+
+class MigrationTestCase(DBTestCase):
+    def _indexes(self, client):
+        with client.session() as sess:
+            rows = sess.execute(
+                text("SELECT name FROM sqlite_master WHERE type='index'")
+            ).fetchall()
+            return {r[0] for r in rows}
+
+    def test_new_database(self):
+        self.assertIn("ix_sample_datastream_t_ns", self._indexes(self._client))
+        report = self._client.migrate()
+        self.assertEqual(report["from_version"], latest_version())
+        self.assertFalse(report["applied"])
+
+    def test_legacy_database(self):
+        path = Path(tempfile.mkdtemp(dir=ROOT), "legacy.db")
+        with sqlite3.connect(path) as conn:
+            conn.execute(
+                "CREATE TABLE DeviceTbl (id INTEGER PRIMARY KEY, name VARCHAR(80))"
+            )
+            conn.execute("INSERT INTO DeviceTbl (name) VALUES ('adc')")
+
+        client = DBClient(path=path)
+        report = client.migrate()
+        self.assertEqual(report["from_version"], 0)
+        self.assertEqual(
+            [a[0] for a in report["applied"]], [v for v, _, _ in MIGRATIONS]
+        )
+        self.assertIn("ix_datastream_device_name_id", self._indexes(client))
+        self.assertIsNotNone(client.get_device_id("adc"))
+
+    def test_measurements_migrated(self):
+        path = Path(tempfile.mkdtemp(dir=ROOT), "legacy.db")
+        with sqlite3.connect(path) as conn:
+            conn.execute(
+                "CREATE TABLE MeasurementTbl (id INTEGER PRIMARY KEY, datastream_id INTEGER, value FLOAT, "
+                "timestamp DATETIME, relative_time_seconds FLOAT, value_string VARCHAR(140))"
+            )
+            conn.execute(
+                "INSERT INTO MeasurementTbl (datastream_id, value, timestamp) "
+                "VALUES (1, 1.5, '2023-01-01 00:00:01')"
+            )
+            conn.execute(
+                "INSERT INTO MeasurementTbl (datastream_id, value_string, timestamp) "
+                "VALUES (1, 'open', '2023-01-01 00:00:02')"
+            )
+            conn.execute("PRAGMA user_version=2")
+
+        client = DBClient(path=path)
+        client.migrate()
+        with client.session() as sess:
+            sample = sess.query(SampleTbl).one()
+            self.assertEqual(sample.value, 1.5)
+            self.assertEqual(sample.t_ns, 1672531201 * 10**9)
+            event = sess.query(EventTbl).one()
+            self.assertEqual(event.value_string, "open")
+            self.assertEqual(event.t_ns, 1672531202 * 10**9)
+
+
+class CatalogTestCase(DBTestCase):
+    def test_register_devices(self):
+        self._client.register_devices(["mks", "adc"])
+        self.assertIsNotNone(self._client.catalog.get_device_id("mks"))
+        self.assertIsNotNone(self._client.catalog.get_datastream_id("default", "mks"))
+        with self._client.session() as sess:
+            self.assertEqual(
+                self._client.get_datastream_names("adc", sess=sess), ["default"]
+            )
+
+    def test_new_scan_stream(self):
+        a = self._client.add_datastream("scan", "adc", unique=False)
+        b = self._client.add_datastream("scan", "adc", unique=False)
+        self.assertNotEqual(a, b)
+        self.assertEqual(self._client.catalog.get_datastream_id("scan", "adc"), b)
+
+        self._client.add_measurement("scan", "adc", value=1)
+        with self._client.session() as sess:
+            d = self._client.get_datastream("scan", "adc", sess=sess)
+            self.assertEqual(d.id, b)
+            self.assertEqual(len(d.samples), 1)
+
+    def test_samples_and_events(self):
+        t = 1672531201 * 10**9
+        self._client.add_measurements(
+            [
+                ("default", "adc", {"value": 2, "t_ns": t + 200}),
+                ("default", "adc", {"value": 1, "t_ns": t + 100}),
+                ("default", "adc", {"value_string": "opened", "t_ns": t + 150}),
+                ("default", "adc", {"value": "error"}),
+            ]
+        )
+        with self._client.session() as sess:
+            d = self._client.get_datastream("default", "adc", sess=sess)
+            self.assertEqual([s.t_ns for s in d.samples], [t + 100, t + 200])
+            self.assertEqual([e.value_string for e in d.events], ["opened", "error"])
+
+    def test_cold_catalog(self):
+        a = self._client.add_datastream("scan", "adc", unique=False)
+        self._client.catalog.invalidate()
+        self.assertEqual(self._client.get_datastream_id("scan", "adc"), a)
+
+
+class HistoryQueryTestCase(DBTestCase):
+    def test_get_samples(self):
+        t0 = 1672531201 * 10**9
+        self._client.add_measurements(
+            [
+                ("default", "adc", {"value": i % 7, "t_ns": t0 + i * 1000})
+                for i in range(1000)
+            ]
+        )
+        t, v = self._client.get_samples("default", "adc", chunk_size=64)
+        self.assertEqual(len(t), 1000)
+        self.assertEqual(t[0], t0)
+
+        t, v = self._client.get_samples(
+            "default", "adc", start=t0 + 100000, end=t0 + 199000
+        )
+        self.assertEqual(len(t), 100)
+
+        t, v = self._client.get_samples("default", "adc", npoints=50, chunk_size=64)
+        self.assertLessEqual(len(t), 50)
+        self.assertEqual(v.max(), 6)
+
+        t, v = self._client.get_samples("default", "adc", npoints=50, method="lttb")
+        self.assertEqual(len(t), 50)
+
+    def test_iter_samples(self):
+        t0 = 1672531201 * 10**9
+        self._client.add_measurements(
+            [
+                ("default", "adc", {"value": i % 7, "t_ns": t0 + i * 1000})
+                for i in range(1000)
+            ]
+        )
+        results = list(
+            self._client.iter_samples("default", "adc", npoints=50, chunk_size=100)
+        )
+        self.assertEqual(len(results), 11)
+        self.assertLessEqual(len(results[0][0]), 14)
+
+        t, v = self._client.get_samples("default", "adc", npoints=50)
+        self.assertTrue((results[-1][0] == t).all())
+        self.assertTrue((results[-1][1] == v).all())
+
+    def test_iter_samples_cancel(self):
+        self._client.add_measurements(
+            [("default", "adc", {"value": i, "t_ns": i + 1}) for i in range(1000)]
+        )
+        cancel = Event()
+        results = []
+        for r in self._client.iter_samples(
+            "default", "adc", npoints=50, chunk_size=100, cancel=cancel
+        ):
+            results.append(r)
+            if len(results) == 2:
+                cancel.set()
+        self.assertEqual(len(results), 2)
+
+
+class RollupTestCase(DBTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        # 2 hours at 1 Hz, added in uneven batches
+        self._t0 = 1672531200 * NS
+        ms = [
+            ("default", "adc", {"value": float(i % 100), "t_ns": self._t0 + i * NS})
+            for i in range(7200)
+        ]
+        for i in range(0, len(ms), 333):
+            self._client.add_measurements(ms[i : i + 333])
+
+    def test_incremental(self):
+        r = self._client.get_rollups("default", "adc", resolution=60)
+        self.assertEqual(len(r), 120)
+        self.assertTrue((r["count"] == 60).all())
+        self.assertEqual(r["first_value"][1], 60)
+        self.assertEqual(r["last_value"][1], 19)
+        self.assertEqual(r["min_value"][1], 0)
+        self.assertEqual(r["max_value"][1], 99)
+
+        r = self._client.get_rollups("default", "adc", resolution=3600)
+        self.assertEqual(list(r["count"]), [3600, 3600])
+        self.assertAlmostEqual(r["mean"][0], 49.5)
+
+    def test_backfill_matches_incremental(self):
+        incremental = self._client.get_rollups("default", "adc", resolution=60)
+        with self._client.session() as sess:
+            sess.execute(text("DELETE FROM RollupTbl"))
+            sess.execute(text("PRAGMA user_version=3"))
+            sess.commit()
+
+        self._client.migrate()
+        backfill = self._client.get_rollups("default", "adc", resolution=60)
+        self.assertTrue((incremental == backfill).all())
+
+    def test_pick_resolution(self):
+        self.assertIsNone(pick_resolution(100 * NS, 1000))
+        self.assertEqual(pick_resolution(1000 * NS, 1000), 1)
+        self.assertEqual(pick_resolution(7200 * NS, 100), 60)
+        self.assertEqual(pick_resolution(30 * 86400 * NS, 500), 3600)
+
+    def test_get_samples_uses_rollups(self):
+        t, v = self._client.get_samples("default", "adc", npoints=100)
+        self.assertLessEqual(len(t), 100)
+        self.assertEqual(v.min(), 0)
+        self.assertEqual(v.max(), 99)
+
+        results = list(self._client.iter_samples("default", "adc", npoints=100))
+        self.assertEqual(len(results), 1)
+
+    def test_missing_rollups(self):
+        # the minute rollups of the second hour are gone. fall back to the hourly rollups
+        with self._client.session() as sess:
+            sess.execute(
+                text("DELETE FROM RollupTbl WHERE resolution=60 AND t_ns>=:t"),
+                {"t": self._t0 + 3600 * NS},
+            )
+            sess.commit()
+        t, v = self._client.get_samples("default", "adc", npoints=100)
+        self.assertEqual(len(t), 4)
+        self.assertEqual((v.min(), v.max()), (0, 99))
+
+        # no rollups at all. fall back to the samples
+        with self._client.session() as sess:
+            sess.execute(text("DELETE FROM RollupTbl"))
+            sess.commit()
+        t, v = self._client.get_samples("default", "adc", npoints=100)
+        self.assertGreater(len(t), 4)
+        self.assertEqual(t[-1], self._t0 + 7199 * NS)
+
+        results = list(self._client.iter_samples("default", "adc", npoints=100))
+        self.assertGreater(len(results), 1)
+        self.assertTrue((results[-1][1] == v).all())
+
+    def test_missing_rollup_inside_window(self):
+        # the edge buckets of the window hold 60 samples outside it, as many as the missing minute
+        with self._client.session() as sess:
+            sess.execute(
+                text("DELETE FROM RollupTbl WHERE resolution=60 AND t_ns=:t"),
+                {"t": self._t0 + 600 * NS},
+            )
+            sess.commit()
+        t, v = self._client.get_samples(
+            "default",
+            "adc",
+            start=self._t0 + 30 * NS,
+            end=self._t0 + 7169 * NS,
+            npoints=100,
+        )
+        # the hourly rollups, not the minute rollups with a gap
+        self.assertEqual(len(t), 4)
+
+
+class CalibrationTestCase(DBTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._client.add_datastream("pressure", "adc")
+        # 2 hours at 1 Hz of raw 0..9 volts, recorded with 2 V/unit then 4 V/unit from the second hour
+        self._t0 = 1672531200 * NS
+        self._t1 = self._t0 + 3600 * NS
+        self._client.add_calibration("adc", "pressure", "2,0", t_ns=self._t0)
+        self._client.add_calibration("adc", "pressure", "4,0", t_ns=self._t1)
+        self._raw = np.arange(7200) % 10
+        ms = [
+            (
+                "pressure",
+                "adc",
+                {
+                    "value": float(r * (2 if i < 3600 else 4)),
+                    "t_ns": self._t0 + i * NS,
+                },
+            )
+            for i, r in enumerate(self._raw)
+        ]
+        self._client.add_measurements(ms)
+
+    def test_versions(self):
+        self.assertEqual(self._client.add_calibration("adc", "pressure", "4,0"), 2)
+        self.assertEqual(self._client.add_calibration("adc", "pressure", "5,0"), 3)
+        versions = self._client.get_calibrations("adc", "pressure")
+        self.assertEqual([v for v, _, _ in versions], [1, 2, 3])
+        self.assertEqual(versions[0][1], self._t0)
+        self.assertEqual(versions[0][2].coefficients, (2, 0))
+
+    def test_recalibrate(self):
+        n = self._client.recalibrate(
+            "adc", "pressure", {"kind": "polynomial", "coefficients": [3, 1]}
+        )
+        self.assertEqual(n, 7200)
+        t, v = self._client.get_samples("pressure", "adc")
+        np.testing.assert_allclose(v, self._raw * 3 + 1)
+
+        r = self._client.get_rollups("pressure", "adc", resolution=3600)
+        self.assertEqual(list(r["count"]), [3600, 3600])
+        self.assertEqual(list(r["max_value"]), [28, 28])
+        self.assertEqual(list(r["min_value"]), [1, 1])
+
+        versions = self._client.get_calibrations("adc", "pressure")
+        self.assertEqual([(v, t) for v, t, _ in versions], [(3, 0)])
+
+    def test_recalibrate_from(self):
+        start = self._t1 + 1800 * NS
+        n = self._client.recalibrate("adc", "pressure", "1,0", start=start)
+        self.assertEqual(n, 1800)
+        t, v = self._client.get_samples("pressure", "adc")
+        np.testing.assert_allclose(v[t >= start], self._raw[t >= start])
+        np.testing.assert_allclose(v[t < start][-1], self._raw[t < start][-1] * 4)
+
+        r = self._client.get_rollups("pressure", "adc", resolution=60)
+        self.assertEqual(len(r), 120)
+        self.assertEqual(r["max_value"][-1], 9)
+        self.assertEqual(r["max_value"][89], 36)
+
+        versions = self._client.get_calibrations("adc", "pressure")
+        self.assertEqual(
+            [(v, t) for v, t, _ in versions],
+            [(1, self._t0), (2, self._t1), (3, start)],
+        )
+
+
+class BackupTestCase(DBTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._client.add_measurements(
+            [("default", "adc", {"value": i, "t_ns": i + 1}) for i in range(5000)]
+        )
+        for p in self._client.backups.get_backups():
+            p.unlink()
+
+    def test_backup(self):
+        self._client.backups.pages = 1
+        self._client.backups.sleep = 0
+        self._client.backup(block=True)
+        path = self._client.backups.last_path
+        self.assertTrue(path.is_file())
+        self.assertTrue(path.name.endswith(".backup.db"))
+        with sqlite3.connect(path) as conn:
+            n = conn.execute("SELECT COUNT(*) FROM SampleTbl").fetchone()[0]
+        self.assertEqual(n, 5000)
+
+    def test_backup_while_writing(self):
+        backups = self._client.backups
+        backups.trait_set(pages=1, sleep=0.001, max_restarts=2)
+        t = self._client.backup()
+        i = 0
+        while t.is_alive():
+            self._client.add_measurement("default", "adc", value=i)
+            i += 1
+        self.assertTrue(backups.last_path.is_file())
+
+    def test_retention(self):
+        self._client.backups.keep = 2
+        for i in range(4):
+            self._client.backup(block=True)
+            time.sleep(0.002)
+        backups = self._client.backups.get_backups()
+        self.assertEqual(len(backups), 2)
+        self.assertEqual(backups[0], self._client.backups.last_path)
+
+    def test_partial(self):
+        backups = self._client.backups
+        root = Path(ROOT, "backups")
+        stale = Path(root, "20000101T000000.backup.db.partial")
+        stale.touch()
+        writing = Path(root, "20000101T000001.backup.db.partial")
+        writing.touch()
+
+        backups._current = Path(root, "20000101T000001.backup.db")
+        backups.prune()
+        self.assertFalse(stale.exists())
+        self.assertTrue(writing.exists())
+
+        # left by an interrupted run, removed at the end of the next background backup
+        backups._current = None
+        self._client.backup().join()
+        self.assertFalse(writing.exists())
+
+    def test_archive(self):
+        archive = self._client.archive
+        archive.append(1, np.arange(10, dtype=np.int64), np.arange(10.0))
+        self._client.backup(block=True)
+        path = archive_path(self._client.backups.last_path)
+        self.assertTrue(Path(path, "1", "index.npy").is_file())
+
+        self._client.backups.keep = 0
+        self._client.backups.prune()
+        self.assertFalse(path.exists())
+
+
+class MaintenanceTestCase(DBTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._now = 1700000000 * NS
+        day = 86400 * NS
+        ms = [
+            ("default", "adc", {"value": i, "t_ns": self._now - 40 * day + i * NS})
+            for i in range(3000)
+        ]
+        ms += [
+            ("default", "adc", {"value": i, "t_ns": self._now - day + i * NS})
+            for i in range(1000)
+        ]
+        self._client.add_measurements(ms)
+        self._maintenance = Maintenance(
+            {
+                "batch_size": 500,
+                "batch_pause": 0,
+                "retention": [{"datastream": "default", "raw_days": 30}],
+            },
+            dbclient=self._client,
+        )
+
+    def test_retention(self):
+        rollups = len(self._client.get_rollups("default", "adc", resolution=60))
+        report = self._maintenance.run(now_ns=self._now)
+        self.assertEqual(report["deleted"]["SampleTbl"], 3000)
+        self.assertEqual(self._count(), 1000)
+        # downsample on age. the rollups of the deleted samples are kept
+        self.assertEqual(
+            len(self._client.get_rollups("default", "adc", resolution=60)), rollups
+        )
+        self.assertGreater(report["freed"], 0)
+        self.assertGreater(report["reclaimed"], 4096)
+        self.assertIn("analyze", report["timings"])
+
+    def test_rollup_retention(self):
+        self._maintenance.retention = [{"rollup_days": {1: 30}}]
+        self._maintenance.run(now_ns=self._now)
+        self.assertEqual(self._count(), 4000)
+        r = self._client.get_rollups("default", "adc", resolution=1)
+        self.assertEqual(len(r), 1000)
+
+    def test_archive_retention(self):
+        day = 86400 * NS
+        self._client.archive.enabled = True
+        self._client.archive.chunk_size = 1000
+        self._maintenance.retention = []
+        self._maintenance.run(now_ns=self._now - 35 * day)
+        self.assertEqual(self._client.archive.extent(1)[0], 3000)
+
+        # a cutoff in the middle of a chunk
+        archive = self._client.archive
+        cutoff = self._now - 40 * day + 1500 * NS
+        self.assertEqual(archive.prune(1, cutoff), 1500)
+        t, v = self._client.get_samples("default", "adc")
+        self.assertEqual(len(t), 2500)
+        self.assertEqual(t[0], cutoff)
+        self.assertEqual(archive.extent(1), (1500, cutoff, t[1499]))
+
+        self._maintenance.retention = [{"raw_days": 30}]
+        report = self._maintenance.run(now_ns=self._now)
+        self.assertEqual(report["deleted"]["archive"], 1500)
+        self.assertEqual(len(self._client.get_samples("default", "adc")[0]), 1000)
+
+    def test_prune_archived_datastream(self):
+        day = 86400 * NS
+        archive = self._client.archive
+        did = self._client.add_datastream("scan", "adc", unique=False)
+        self._client.add_datastream("scan", "adc", unique=False)
+        archive.append(did, np.array([self._now - 40 * day]), np.array([1.0]))
+        self._maintenance.prune_datastreams_days = 0.0001
+        now = time.time_ns() + 60 * NS
+
+        # archived samples keep the datastream
+        self._maintenance.retention = []
+        self.assertEqual(
+            self._maintenance.run(now_ns=now)["deleted"]["DatastreamTbl"], 0
+        )
+
+        self._maintenance.retention = [{"datastream": "scan", "raw_days": 30}]
+        report = self._maintenance.run(now_ns=now)
+        self.assertEqual(report["deleted"]["DatastreamTbl"], 1)
+        self.assertFalse(Path(archive.root, str(did)).exists())
+
+    def test_prune_datastreams(self):
+        old = self._client.add_datastream("scan", "adc", unique=False)
+        active = self._client.add_datastream("scan", "adc", unique=False)
+        self._maintenance.prune_datastreams_days = 0.0001
+        report = self._maintenance.run(now_ns=time.time_ns() + 60 * NS)
+        self.assertEqual(report["deleted"]["DatastreamTbl"], 1)
+        with self._client.session() as sess:
+            self.assertIsNone(sess.get(DatastreamTbl, old))
+            self.assertIsNotNone(sess.get(DatastreamTbl, active))
+
+
+class ArchiveTestCase(DBTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._archive = Archive(
+            {"chunk_size": 100}, root=str(self._path.parent / "archive")
+        )
+
+    def test_append(self):
+        t = np.arange(250, dtype=np.int64) * NS
+        v = np.arange(250, dtype=np.float64)
+        self.assertEqual(self._archive.append(1, t, v), 3)
+        self.assertEqual(self._archive.sealed_until(1), 249 * NS)
+
+        chunks = list(self._archive.iter_chunks(1, 50 * NS, 150 * NS))
+        self.assertEqual(len(chunks), 2)
+        # memory-mapped views, not copies
+        self.assertIsInstance(chunks[0][0].base, np.memmap)
+        self.assertEqual(sum(len(ct) for ct, cv in chunks), 101)
+        self.assertEqual(
+            self._archive.extent(1, 50 * NS, 150 * NS), (101, 50 * NS, 150 * NS)
+        )
+        self.assertEqual(self._archive.extent(1), (250, 0, 249 * NS))
+
+    def test_overview(self):
+        t = np.arange(250, dtype=np.int64)
+        self._archive.append(1, t, t * 2.0)
+        ot, ov = self._archive.overview(1)
+        self.assertEqual(len(ot), 6)
+        self.assertEqual(ov.max(), 498)
+
+    def test_seal(self):
+        day = 86400 * NS
+        now = 1700000000 * NS
+        today = now - now % day
+        ms = [
+            ("default", "adc", {"value": i, "t_ns": today - 3000 * NS + i * NS})
+            for i in range(4000)
+        ]
+        self._client.add_measurements(ms)
+        self._client.archive.enabled = True
+        self._client.archive.chunk_size = 1000
+        m = Maintenance(
+            {"batch_pause": 0, "prune_datastreams_days": 0}, dbclient=self._client
+        )
+
+        report = m.run(now_ns=now)
+        self.assertEqual(report["archived"], 3000)
+        self.assertEqual(self._count(), 1000)
+
+        # queries span the archive and the live rows
+        t, v = self._client.get_samples("default", "adc")
+        self.assertEqual(len(t), 4000)
+        self.assertTrue(np.all(np.diff(t) > 0))
+        self.assertTrue(np.array_equal(v, np.arange(4000)))
+
+        t, v = self._client.get_samples(
+            "default", "adc", start=today - 10 * NS, end=today + 9 * NS
+        )
+        self.assertEqual(len(t), 20)
+
+        t, v = self._client.get_samples("default", "adc", npoints=100, method="lttb")
+        self.assertEqual(len(t), 100)
+
+        *_, last = self._client.iter_samples("default", "adc", npoints=100000)
+        self.assertEqual(len(last[0]), 4000)
+
+        # sealing again is a no-op until the day rolls over
+        self.assertEqual(m.run(now_ns=now)["archived"], 0)
+        self.assertEqual(m.run(now_ns=now + day)["archived"], 1000)
+        self.assertEqual(self._count(), 0)
+        self.assertEqual(len(self._client.get_samples("default", "adc")[0]), 4000)
+
+    def test_merge(self):
+        t = np.arange(0, 300, 2, dtype=np.int64) * NS
+        self._archive.append(1, t, t / NS)
+        late = np.array([1, 151, 151, 299, 0], dtype=np.int64) * NS
+        # (0, 0) is already archived
+        self.assertEqual(self._archive.merge(1, late, late / NS), 4)
+        self.assertEqual(self._archive.merge(1, late, late / NS), 0)
+
+        at, av = concatenate_chunks(list(self._archive.iter_chunks(1)))
+        self.assertEqual(len(at), 154)
+        self.assertTrue(np.all(np.diff(at) >= 0))
+        self.assertTrue(np.array_equal(av, at / NS))
+        self.assertEqual(self._archive.extent(1), (154, 0, 299 * NS))
+
+    def test_late_rows(self):
+        day = 86400 * NS
+        now = 1700000000 * NS
+        today = now - now % day
+        ms = [
+            ("default", "adc", {"value": i, "t_ns": today - 100 * NS + i * NS})
+            for i in range(0, 100, 2)
+        ]
+        self._client.add_measurements(ms)
+        self._client.archive.enabled = True
+        m = Maintenance(
+            {"batch_pause": 0, "prune_datastreams_days": 0}, dbclient=self._client
+        )
+        m.run(now_ns=now)
+        self.assertEqual(self._count(), 0)
+
+        # an imported or replayed sample older than the archive
+        late = [
+            ("default", "adc", {"value": 9, "t_ns": today - 91 * NS}),
+            ("default", "adc", {"value": 200, "t_ns": today + NS}),
+        ]
+        self._client.add_measurements(late)
+        t, v = self._client.get_samples("default", "adc")
+        self.assertEqual(len(t), 52)
+        self.assertTrue(np.all(np.diff(t) > 0))
+        self.assertEqual(list(v[:6]), [0, 2, 4, 6, 8, 9])
+
+        report = m.run(now_ns=now)
+        self.assertEqual(report["archived"], 1)
+        self.assertEqual(self._count(), 1)
+        t2, v2 = self._client.get_samples("default", "adc")
+        self.assertTrue(np.array_equal(t, t2))
+        self.assertTrue(np.array_equal(v, v2))
+
+    def test_row_committed_while_sealing(self):
+        day = 86400 * NS
+        now = 1700000000 * NS
+        today = now - now % day
+        ms = [
+            ("default", "adc", {"value": i, "t_ns": today - 100 * NS + i * NS})
+            for i in range(0, 100, 2)
+        ]
+        self._client.add_measurements(ms)
+        archive = self._client.archive
+        archive.enabled = True
+        m = Maintenance(
+            {"batch_pause": 0, "prune_datastreams_days": 0}, dbclient=self._client
+        )
+        m.run(now_ns=now)
+        self._client.add_measurements(
+            [("default", "adc", {"value": 9, "t_ns": today - 91 * NS})]
+        )
+
+        # another late row is committed while the first one is being merged
+        merge = archive.merge
+
+        def merge_and_insert(*args):
+            archive.merge = merge
+            self._client.add_measurements(
+                [("default", "adc", {"value": 11, "t_ns": today - 89 * NS})]
+            )
+            return merge(*args)
+
+        archive.merge = merge_and_insert
+        self.assertEqual(m.run(now_ns=now)["archived"], 1)
+        # not archived, so not deleted
+        self.assertEqual(self._count(), 1)
+        self.assertEqual(m.run(now_ns=now)["archived"], 1)
+        self.assertEqual(self._count(), 0)
+        t, v = self._client.get_samples("default", "adc")
+        self.assertEqual(list(v[:8]), [0, 2, 4, 6, 8, 9, 10, 11])
+
+
+class AlignedQueryTestCase(DBTestCase):
+    def test_aligned(self):
+        self._client.add_device("mks")
+        self._client.add_datastream("default", "mks")
+        t0 = 1700000000 * NS
+        ms = [("default", "adc", {"value": i, "t_ns": t0 + i * NS}) for i in range(100)]
+        # jittery, slower stream
+        ms += [
+            ("default", "mks", {"value": i * 3, "t_ns": t0 + i * 3 * NS + 1000})
+            for i in range(34)
+        ]
+        self._client.add_measurements(ms)
+
+        streams = [("default", "adc"), ("default", "mks")]
+        grid, values = self._client.get_aligned(
+            streams, t0 + 10 * NS, t0 + 50 * NS, step=NS, method="asof"
+        )
+        self.assertEqual(len(grid), 41)
+        self.assertEqual(values.shape, (2, 41))
+        self.assertTrue(np.array_equal(values[0], np.arange(10, 51)))
+        self.assertEqual(list(values[1][:4]), [9, 9, 9, 12])
+
+        grid, values = self._client.get_aligned(streams, npoints=10, method="mean")
+        self.assertEqual(grid[0], t0)
+        self.assertEqual(len(grid), 10)
+        self.assertFalse(np.isnan(values[1]).any())
+
+        # downsampled before aligning
+        grid, values = self._client.get_aligned(
+            streams, npoints=10, method="linear", max_samples=20
+        )
+        self.assertEqual(len(grid), 10)
+        self.assertEqual((values[0][0], values[0][-1]), (0, 99))
+
+        cancel = Event()
+        cancel.set()
+        self.assertIsNone(self._client.get_aligned(streams, cancel=cancel))
+
+
+class ExportTestCase(DBTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._client.add_datastream("temp", "adc")
+        self._t0 = t0 = 1700000000 * NS
+        ms = [
+            ("default", "adc", {"value": i, "t_ns": t0 + i * NS}) for i in range(1000)
+        ]
+        ms += [("temp", "adc", {"value": -i, "t_ns": t0 + i * NS}) for i in range(500)]
+        ms.append(("default", "adc", {"value": "valve open", "t_ns": t0 + 10 * NS + 1}))
+        self._client.add_measurements(ms)
+        self._exporter = Exporter(
+            {"chunk_size": 64, "workers": 2}, dbclient=self._client
+        )
+
+    def test_csv(self):
+        results = self._exporter.export(["adc.default", "adc.temp"])
+        self.assertEqual([r[3] for r in results], [1001, 500])
+
+        path = results[0][2]
+        self.assertTrue(path.endswith(".csv.gz"))
+        with open_compressed(path) as rfile:
+            lines = rfile.read().splitlines()
+        self.assertEqual(lines[0], "t_ns,value")
+        self.assertEqual(len(lines), 1002)
+        # events are merged in time order
+        self.assertEqual(lines[12], f"{self._t0 + 10 * NS + 1},valve open")
+
+    def test_ndjson_range(self):
+        ((_, _, path, n),) = self._exporter.export(
+            [("temp", "adc")],
+            start=self._t0 + 100 * NS,
+            end=self._t0 + 199 * NS,
+            format="ndjson",
+            compression="xz",
+        )
+        self.assertEqual(n, 100)
+        with open_compressed(path) as rfile:
+            rows = [json.loads(line) for line in rfile]
+        self.assertEqual(rows[0], {"t_ns": self._t0 + 100 * NS, "value": -100.0})
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            self._exporter.export(["adc.default"], format="xml")
+        with self.assertRaises(ValueError):
+            self._exporter.export(["adc.default"], compression="zip")
+
+    def test_leaves_a_reader(self):
+        streams = ["adc.default", "adc.temp"]
+        for i in range(4):
+            self._client.add_datastream(f"s{i}", "adc")
+            self._client.add_measurements(
+                [
+                    (f"s{i}", "adc", {"value": j, "t_ns": self._t0 + j})
+                    for j in range(10)
+                ]
+            )
+            streams.append(f"adc.s{i}")
+
+        pool = self._client._get_reader_engine().pool
+        checkedout = []
+        iter_event_chunks = self._client.iter_event_chunks
+
+        def slow(*args, **kw):
+            checkedout.append(pool.checkedout())
+            time.sleep(0.05)
+            yield from iter_event_chunks(*args, **kw)
+
+        self._client.iter_event_chunks = slow
+        self._exporter.workers = 8
+        results = self._exporter.export(streams)
+        self.assertEqual(len(results), 6)
+        self.assertLessEqual(max(checkedout), self._client.profile.readers - 1)
+
+    def test_binary(self):
+        ((_, _, path, n),) = self._exporter.export(["adc.default"], format="binary")
+        self.assertEqual(n, 1000)
+        t, v = (np.concatenate(c) for c in zip(*ColumnarPersister.read(path)))
+        self.assertTrue(np.array_equal(t, self._t0 + np.arange(1000) * NS))
+        self.assertTrue(np.array_equal(v, np.arange(1000)))
+
+
+class ImportTestCase(DBTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._importer = Importer({"batch_size": 100}, dbclient=self._client)
+
+    def test_csv(self):
+        t0 = datetime(2024, 1, 1, 12)
+        with CSVPersister(path_name="datalog", compression="gzip") as writer:
+            writer.write(["time", "elapsed", "pressure"])
+            for i in range(250):
+                t = (t0 + timedelta(seconds=i)).isoformat()
+                writer.write([t, i, i * 2 if i != 5 else ""])
+
+        progress = []
+        report = self._importer.import_csv(
+            writer.path,
+            columns={"pressure": "mks.pressure", 1: "adc.elapsed"},
+            progress=lambda n, et: progress.append(n),
+        )
+        self.assertEqual(report["rows"], 250)
+        self.assertEqual(
+            report["datastreams"], {"mks.pressure": 249, "adc.elapsed": 250}
+        )
+        self.assertEqual(progress, [100, 200, 250])
+
+        t, v = self._client.get_samples("pressure", "mks")
+        self.assertEqual(len(t), 249)
+        self.assertEqual(t[0], int(t0.timestamp()) * NS)
+        self.assertEqual(v[-1], 498)
+        # rollups are maintained
+        r = self._client.get_rollups("pressure", "mks", resolution=60)
+        self.assertEqual(r["count"].sum(), 249)
+
+    def test_csv_without_header(self):
+        with CSVPersister(path_name="datalog") as writer:
+            for i in range(10):
+                writer.write([1700000000 + i, i])
+
+        report = self._importer.import_file(writer.path, device_name="adc")
+        self.assertEqual(report["datastreams"], {"adc.column1": 10})
+
+    def test_json(self):
+        with JSONPersister(path_name="measure") as persister:
+            for i in range(150):
+                payload = {
+                    "time": 1700000000 + i,
+                    "intensities": {"H1": i, "L1": [i, -i]},
+                }
+                persister.add("intensities", payload)
+
+        report = self._importer.import_file(persister.path, device_name="spectrometer")
+        self.assertEqual(
+            report["datastreams"],
+            {
+                "spectrometer.intensities.H1": 150,
+                "spectrometer.intensities.L1.0": 150,
+                "spectrometer.intensities.L1.1": 150,
+            },
+        )
+        t, v = self._client.get_samples("intensities.L1.1", "spectrometer")
+        self.assertEqual(v[-1], -149)
+
+    def test_no_samples(self):
+        with JSONPersister(path_name="measure", extension=".csv") as persister:
+            persister.add("intensities", {"time": 1700000000, "H1": 1})
+
+        with self.assertLogs(self._importer.logger, "WARNING"):
+            report = self._importer.import_file(persister.path, device_name="adc")
+        self.assertEqual(report["samples"], 0)
+
+    def test_parse_times(self):
+        t = parse_times(["1700000000.5", "1700000001"])
+        self.assertEqual(list(t), [1700000000500000000, 1700000001000000000])
+        t = parse_times(["2024-01-01T00:00:00+00:00"])
+        self.assertEqual(t[0], 1704067200 * NS)
+
+
+class SpoolTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self._path = str(Path(tempfile.mkdtemp(dir=ROOT), "measurements.spool"))
+        self._spool = Spool({"path": self._path})
+
+    def test_roundtrip(self):
+        items = [
+            ("default", "adc", {"value": 1.5, "t_ns": 1}),
+            ("scan", "adc", {"value": "valve open", "t_ns": 2}),
+        ]
+        self.assertEqual(self._spool.append(items), 2)
+        self.assertEqual(self._spool.pending(), 2)
+
+        read, offset = self._spool.read(10)
+        self.assertEqual(
+            read,
+            [
+                ("default", "adc", {"value": 1.5, "t_ns": 1}),
+                ("scan", "adc", {"value_string": "valve open", "t_ns": 2}),
+            ],
+        )
+        self._spool.commit(offset)
+        self.assertEqual(self._spool.pending(), 0)
+        self.assertEqual(os.path.getsize(self._path), 0)
+
+    def test_datastream_roundtrip(self):
+        self._spool.append(
+            [("scan", "adc", {"datastream": True, "unique": True, "t_ns": 1})]
+        )
+        read, offset = self._spool.read(10)
+        self.assertEqual(
+            read, [("scan", "adc", {"datastream": True, "unique": True, "t_ns": 1})]
+        )
+
+    def test_datastream_read_alone(self):
+        ds = ("scan", "adc", {"datastream": True, "unique": False, "t_ns": 2})
+        self._spool.append(
+            [("scan", "adc", {"value": 1.0, "t_ns": 1}), ds]
+            + [("scan", "adc", {"value": 2.0, "t_ns": 3})]
+        )
+        reads = []
+        while self._spool.pending():
+            items, offset = self._spool.read(10)
+            reads.append(len(items))
+            self._spool.commit(offset)
+        self.assertEqual(reads, [1, 1, 1])
+
+    def test_corrupt_and_torn(self):
+        self._spool.append(
+            [("default", "adc", {"value": i, "t_ns": i}) for i in range(3)]
+        )
+        with open(self._path, "r+b") as f:
+            f.seek(RECORD.size + 3)
+            f.write(b"\xff")
+        with open(self._path, "ab") as f:
+            f.write(b"partial")
+
+        spool = Spool({"path": self._path})
+        self.assertEqual(spool.pending(), 3)
+        read, offset = spool.read(10)
+        self.assertEqual([kw["value"] for _, _, kw in read], [0, 2])
+        self.assertEqual(spool.ncorrupt, 1)
+
+
+class FlakyClient(object):
+    """
+    a DBClient whose `failing` methods raise, e.g. while the database is locked
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.failing = set()
+
+    def __getattr__(self, name):
+        if name in self.failing:
+
+            def locked(*args, **kw):
+                raise sqlite3.OperationalError("database is locked")
+
+            return locked
+        return getattr(self.client, name)
+
+
+class MeasurementWriterTestCase(DBTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._spool_path = str(self._path.parent / "measurements.spool")
+        self._writer = MeasurementWriter(
+            {
+                "batch_size": 10,
+                "commit_interval": 0.05,
+                "retry_interval": 0.1,
+                "spool": {"path": self._spool_path},
+            },
+            dbclient=self._client,
+        )
+        self._writer.start()
+
+    def tearDown(self) -> None:
+        self._writer.close()
+
+    def test_batches(self):
+        for i in range(25):
+            self._writer.add_measurement("default", "adc", value=i)
+        self.assertTrue(self._writer.flush(5))
+        self.assertEqual(self._count(), 25)
+        self.assertEqual(self._writer.nwritten, 25)
+        self.assertGreaterEqual(self._writer.ncommits, 3)
+
+    def test_commit_interval(self):
+        self._writer.add_measurement("default", "adc", value=1)
+        for i in range(100):
+            if self._writer.nwritten:
+                break
+            self._writer._thread.join(0.01)
+        self.assertEqual(self._count(), 1)
+
+    def test_datastream_ordering(self):
+        self._writer.add_measurement("default", "adc", value=1)
+        self._writer.add_datastream("scan", "adc")
+        self._writer.add_measurement("scan", "adc", value=2)
+        self._writer.add_datastream("scan", "adc")
+        self._writer.add_measurement("scan", "adc", value=3)
+        self._writer.add_measurement("scan", "adc", value=4)
+        self._writer.flush(5)
+        self.assertEqual(self._count(), 1)
+        self.assertEqual(self._count("scan"), 2)
+
+    def test_close_flushes(self):
+        for i in range(5):
+            self._writer.add_measurement("default", "adc", value=i)
+        self._writer.close()
+        self.assertEqual(self._count(), 5)
+
+    def test_queue_full(self):
+        self._writer.close()
+        # an unstarted writer only buffers
+        self._writer = MeasurementWriter(
+            {"queue_size": 2, "spool": {"enabled": False}}, dbclient=self._client
+        )
+        for i in range(5):
+            self._writer.add_measurement("default", "adc", value=i)
+        self.assertEqual(self._writer.ndropped, 3)
+
+    def test_queue_full_spools(self):
+        self._writer.close()
+        writer = MeasurementWriter(
+            {
+                "queue_size": 2,
+                "commit_interval": 0.05,
+                "spool": {"path": self._spool_path},
+            },
+            dbclient=self._client,
+        )
+        for i in range(5):
+            writer.add_measurement("default", "adc", value=i)
+        self.assertEqual(writer.ndropped, 0)
+        self.assertEqual(writer.nspooled, 3)
+
+        writer.start()
+        for i in range(100):
+            if not writer.spool.pending():
+                break
+            time.sleep(0.02)
+        writer.close()
+        self.assertEqual(self._count(), 5)
+
+    def test_queue_full_datastream(self):
+        self._writer.close()
+        writer = MeasurementWriter(
+            {
+                "queue_size": 4,
+                "commit_interval": 0.05,
+                "spool": {"path": self._spool_path},
+            },
+            dbclient=self._client,
+        )
+        for i in range(4):
+            writer.add_measurement("default", "adc", value=i)
+        # an unstarted writer with a full queue must not block
+        st = time.perf_counter()
+        writer.add_datastream("scan", "adc")
+        self.assertLess(time.perf_counter() - st, 0.05)
+
+        writer.add_measurement("scan", "adc", value=3)
+        writer.add_datastream("scan", "adc")
+        writer.add_measurement("scan", "adc", value=4)
+        # what waits behind the queue is bounded by queue_size too
+        writer.add_measurement("scan", "adc", value=5)
+        self.assertEqual(writer.ndropped, 1)
+        self.assertEqual(writer.spool.pending(), 0)
+
+        writer.start()
+        writer.flush(5)
+        writer.close()
+        self.assertEqual(self._count(), 4)
+        self.assertEqual(self._samples_by_datastream("scan"), [[3], [4]])
+
+    def test_failed_commit_datastream(self):
+        client = FlakyClient(self._client)
+        self._writer.dbclient = client
+        self._writer.add_datastream("scan", "adc")
+        self._writer.flush(5)
+
+        # scan 1 cannot be committed, so it is spooled. scan 2 is created behind it
+        client.failing = {"add_measurements", "add_datastream"}
+        for i in range(3):
+            self._writer.add_measurement("scan", "adc", value=i)
+        self._writer.flush(5)
+        self._writer.add_datastream("scan", "adc")
+        self._writer.add_measurement("scan", "adc", value=99)
+        self._writer.flush(5)
+        self.assertEqual(self._samples_by_datastream("scan"), [[]])
+
+        client.failing = set()
+        self._wait_replayed()
+        self.assertEqual(self._samples_by_datastream("scan"), [[0, 1, 2], [99]])
+
+    def test_failed_datastream(self):
+        client = FlakyClient(self._client)
+        self._writer.dbclient = client
+        client.failing = {"add_datastream"}
+        self._writer.add_datastream("scan", "adc")
+        self._writer.add_measurement("scan", "adc", value=1)
+        self._writer.flush(5)
+        self.assertEqual(self._writer.spool.pending(), 2)
+
+        client.failing = set()
+        self._wait_replayed()
+        self.assertEqual(self._samples_by_datastream("scan"), [[1]])
+
+    def _wait_replayed(self):
+        for i in range(100):
+            if not self._writer.spool.pending():
+                break
+            time.sleep(0.02)
+        self.assertEqual(self._writer.spool.pending(), 0)
+
+    def _samples_by_datastream(self, name, device_name="adc"):
+        with self._client.session() as sess:
+            ds = (
+                sess.query(DatastreamTbl)
+                .filter(DatastreamTbl.name == name)
+                .order_by(DatastreamTbl.id)
+                .all()
+            )
+            return [
+                [
+                    s.value
+                    for s in sess.query(SampleTbl)
+                    .filter(SampleTbl.datastream_id == d.id)
+                    .order_by(SampleTbl.t_ns)
+                ]
+                for d in ds
+            ]
+
+    def test_replay_under_load(self):
+        self._writer.close()
+        writer = MeasurementWriter(
+            {
+                "batch_size": 10,
+                "commit_interval": 0.05,
+                "replay_batch_size": 20,
+                "spool": {"path": self._spool_path},
+            },
+            dbclient=self._client,
+        )
+        writer.spool.append(
+            [("default", "adc", {"value": i, "t_ns": i + 1}) for i in range(100)]
+        )
+        writer.start()
+        # the queue is never idle for a whole commit interval
+        for i in range(50):
+            writer.add_measurement("default", "adc", value=i)
+            time.sleep(0.01)
+        self.assertEqual(writer.nreplayed, 100)
+        self.assertEqual(writer.spool.pending(), 0)
+        writer.close()
+        self.assertEqual(self._count(), 150)
+
+    def test_locked_database_spools(self):
+        client = DBClient({"storage": {"busy_timeout": 50}}, path=self._path)
+        self._writer.dbclient = client
+
+        # an external writer holds the database lock
+        conn = sqlite3.connect(self._path)
+        conn.execute("BEGIN IMMEDIATE")
+        st = time.perf_counter()
+        for i in range(30):
+            self._writer.add_measurement("default", "adc", value=i)
+        # acquisition is never held up by the lock
+        self.assertLess(time.perf_counter() - st, 0.05)
+
+        self._writer.flush(5)
+        self.assertEqual(self._writer.nspooled, 30)
+        self.assertEqual(self._count(), 0)
+
+        conn.rollback()
+        conn.close()
+        for i in range(100):
+            if self._writer.nreplayed == 30:
+                break
+            time.sleep(0.02)
+        self.assertEqual(self._count(), 30)
+        self.assertEqual(self._writer.spool.pending(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
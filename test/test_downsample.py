@@ -0,0 +1,61 @@
+import unittest
+
+from numpy import arange, sin, zeros, array_equal, int64, diff
+
+from db.downsample import MinMaxBuckets, minmax, lttb
+
+
+class MinMaxTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self._t = arange(10000, dtype=int64) * 1000
+        self._v = sin(arange(10000) / 100.0)
+
+    def test_npoints(self):
+        t, v = minmax(self._t, self._v, 100)
+        self.assertLessEqual(len(t), 100)
+        self.assertTrue((diff(t) > 0).all())
+
+    def test_preserves_spike(self):
+        v = zeros(10000)
+        v[1234] = 10
+        v[8765] = -10
+        t, vv = minmax(self._t, v, 20)
+        self.assertIn(10, vv)
+        self.assertIn(-10, vv)
+        self.assertIn(self._t[1234], t)
+
+    def test_streaming_matches_single_pass(self):
+        mm = MinMaxBuckets(self._t[0], self._t[-1], 50)
+        for i in range(0, 10000, 777):
+            mm.add(self._t[i : i + 777], self._v[i : i + 777])
+        t, v = mm.result()
+
+        tt, vv = minmax(self._t, self._v, 100)
+        self.assertTrue(array_equal(t, tt))
+        self.assertTrue(array_equal(v, vv))
+
+    def test_short_series(self):
+        t, v = minmax(self._t[:10], self._v[:10], 100)
+        self.assertEqual(len(t), 10)
+
+
+class LTTBTestCase(unittest.TestCase):
+    def test_npoints(self):
+        t = arange(5000, dtype=int64)
+        v = sin(t / 50.0)
+        tt, vv = lttb(t, v, 200)
+        self.assertEqual(len(tt), 200)
+        self.assertEqual(tt[0], 0)
+        self.assertEqual(tt[-1], 4999)
+        self.assertTrue((diff(tt) > 0).all())
+
+    def test_preserves_spike(self):
+        t = arange(5000, dtype=int64)
+        v = zeros(5000)
+        v[2500] = 5
+        tt, vv = lttb(t, v, 50)
+        self.assertIn(2500, tt)
+
+
+if __name__ == "__main__":
+    unittest.main()
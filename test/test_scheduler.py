@@ -0,0 +1,177 @@
+import threading
+import time
+import unittest
+
+from scheduler import Scheduler, compatible
+
+
+class Counter(object):
+    def __init__(self, duration=0):
+        self.duration = duration
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def read(self, *args, **kw):
+        with self._lock:
+            self.calls.append(time.monotonic())
+        time.sleep(self.duration)
+        return len(self.calls)
+
+
+class Device(object):
+    """
+    reads channels singly or in one batch
+    """
+
+    name = "dev"
+
+    def __init__(self):
+        self.batches = []
+
+    def read(self, channel, datastream="default"):
+        return channel
+
+    def read_batch(self, calls):
+        self.batches.append([args[0] for args, kw in calls])
+        return [self.read(*args, **kw) for args, kw in calls]
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self._scheduler = Scheduler({"workers": 2})
+        self._scheduler.start()
+
+    def tearDown(self) -> None:
+        self._scheduler.stop()
+
+    def test_compatible(self):
+        self.assertTrue(compatible(0.2, 0.1))
+        self.assertTrue(compatible(0.1, 0.1))
+        self.assertFalse(compatible(0.15, 0.1))
+        self.assertFalse(compatible(0.05, 0.1))
+
+    def test_results(self):
+        c = Counter()
+        results = []
+        sub = self._scheduler.subscribe(c.read, 0.02, results.append)
+        time.sleep(0.1)
+        sub.cancel()
+        self.assertTrue(results)
+        self.assertEqual(results, sorted(results))
+
+    def test_drift_free(self):
+        # the read takes 40% of the period. a sleep(period) loop would only manage ~7 runs
+        c = Counter(duration=0.02)
+        sub = self._scheduler.subscribe(c.read, 0.05, lambda v: None)
+        time.sleep(0.52)
+        sub.cancel()
+        self.assertGreaterEqual(len(c.calls), 10)
+        self.assertLessEqual(len(c.calls), 12)
+
+        stats = self._scheduler.stats()
+        self.assertEqual(stats, [])
+
+    def test_merge(self):
+        c = Counter()
+        fast, slow = [], []
+        s1 = self._scheduler.subscribe(
+            c.read, 0.1, slow.append, kw={"datastream": "scan"}
+        )
+        s2 = self._scheduler.subscribe(
+            c.read, 0.05, fast.append, kw={"datastream": "scan"}
+        )
+        self.assertIs(s1.job, s2.job)
+        self.assertEqual(s1.job.period, 0.05)
+        self.assertEqual(len(self._scheduler.stats()), 1)
+
+        time.sleep(0.52)
+        s1.cancel()
+        s2.cancel()
+        self.assertEqual(len(c.calls), len(fast))
+        self.assertAlmostEqual(len(slow), len(fast) / 2, delta=1.5)
+        self.assertTrue(set(slow) <= set(fast))
+
+    def test_merge_device(self):
+        d = Device()
+        results = {0: [], 1: [], 2: []}
+        subs = [
+            self._scheduler.subscribe(d.read, 0.05, results[0].append, args=(0,)),
+            self._scheduler.subscribe(
+                d.read, 0.1, results[1].append, args=(1,), kw={"datastream": "scan"}
+            ),
+            self._scheduler.subscribe(d.read, 0.05, results[2].append, args=(2,)),
+        ]
+        self.assertTrue(all(s.job is subs[0].job for s in subs))
+        self.assertEqual(self._scheduler.stats()[0]["calls"], 3)
+
+        time.sleep(0.32)
+        for s in subs:
+            s.cancel()
+        # one read per run. the slower channel is only read every other run
+        self.assertEqual(len(d.batches), len(results[0]))
+        self.assertEqual(set(results[0]), {0})
+        self.assertEqual(set(results[1]), {1})
+        self.assertAlmostEqual(len(results[1]), len(results[0]) / 2, delta=1.5)
+        self.assertIn([0, 1, 2], d.batches)
+        self.assertIn([0, 2], d.batches)
+        self.assertEqual(self._scheduler.stats(), [])
+
+    def test_no_merge(self):
+        c = Counter()
+        s1 = self._scheduler.subscribe(c.read, 0.1, lambda v: None)
+        s2 = self._scheduler.subscribe(c.read, 0.15, lambda v: None)
+        s3 = self._scheduler.subscribe(c.read, 0.1, lambda v: None, args=(1,))
+        self.assertIsNot(s1.job, s2.job)
+        self.assertIsNot(s1.job, s3.job)
+        self.assertEqual(len(self._scheduler.stats()), 3)
+
+    def test_unsubscribe_slows_job(self):
+        c = Counter()
+        s1 = self._scheduler.subscribe(c.read, 0.1, lambda v: None)
+        s2 = self._scheduler.subscribe(c.read, 0.05, lambda v: None)
+        s2.cancel()
+        self.assertEqual(s1.job.period, 0.1)
+        s1.cancel()
+        self.assertEqual(self._scheduler.stats(), [])
+
+        n = len(c.calls)
+        time.sleep(0.15)
+        self.assertEqual(len(c.calls), n)
+
+    def test_missed_deadlines(self):
+        c = Counter(duration=0.05)
+        sub = self._scheduler.subscribe(c.read, 0.02, lambda v: None)
+        time.sleep(0.3)
+        stats = self._scheduler.stats()[0]
+        sub.cancel()
+        self.assertGreater(stats["missed"], 0)
+        self.assertGreater(stats["runs"], 0)
+        # a job never overlaps itself
+        self.assertLessEqual(stats["runs"], 0.3 / 0.05 + 1)
+
+    def test_stats(self):
+        c = Counter()
+        sub = self._scheduler.subscribe(c.read, 0.02, lambda v: None)
+        time.sleep(0.11)
+        stats = self._scheduler.stats()[0]
+        sub.cancel()
+        self.assertTrue(stats["name"].endswith("read"))
+        self.assertGreaterEqual(stats["runs"], 4)
+        self.assertGreaterEqual(stats["max_jitter"], 0)
+        self.assertLess(stats["mean_jitter"], 0.02)
+
+    def test_errors(self):
+        def fail():
+            raise IOError("bus error")
+
+        results = []
+        sub = self._scheduler.subscribe(fail, 0.02, results.append)
+        time.sleep(0.07)
+        stats = self._scheduler.stats()[0]
+        sub.cancel()
+        self.assertGreater(stats["errors"], 0)
+        self.assertEqual(results, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+
+import bezier
+from numpy import linspace
+from numpy.testing import assert_allclose
+
+from hardware.switch import RampSwitch
+
+
+def solve(nodes, nsteps):
+    """
+    the voltages found by intersecting the curve with a vertical line at every step
+    """
+    curve = bezier.Curve(nodes, degree=nodes.shape[1] - 1)
+    ma = nodes.max()
+    values = []
+    for i in linspace(0.0, 1.0, nsteps + 1)[1:]:
+        line = bezier.Curve([[i, i], [0, ma]], degree=1)
+        intersections = curve.intersect(line)
+        values.append(curve.evaluate_multi(intersections[0, :])[1][0])
+    return values
+
+
+class RampSwitchTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self._switch = RampSwitch(
+            {
+                "name": "A",
+                "channel": "01",
+                "ramp": {
+                    "nsteps": 10,
+                    "open": {"control_points": ["0, 0", "0.25, 10", "1, 10"]},
+                    "close": {"control_points": ["0, 10", "0.5, 10", "1, 0"]},
+                },
+            }
+        )
+
+    def test_matches_intersections(self):
+        s = self._switch
+        assert_allclose(list(s.ramp(True)), solve(s.open_nodes, 10), atol=1e-4)
+        assert_allclose(list(s.ramp(False)), solve(s.close_nodes, 10), atol=1e-4)
+
+    def test_profile(self):
+        x, y = self._switch.profile(True)
+        self.assertEqual(len(x), 1001)
+        self.assertEqual(y[0], 0)
+        self.assertAlmostEqual(y[-1], 10)
+
+    def test_config_change(self):
+        s = self._switch
+        s.nsteps = 4
+        self.assertEqual(len(list(s.ramp(True))), 4)
+
+        s.resolution = 11
+        self.assertEqual(len(s.profile(False)[0]), 11)
+
+        s.open_nodes = s.close_nodes
+        assert_allclose(list(s.ramp(True)), list(s.ramp(False)))
+
+    def test_not_monotonic(self):
+        with self.assertRaises(ValueError):
+            RampSwitch(
+                {
+                    "channel": "01",
+                    "ramp": {
+                        "open": {"control_points": ["0, 0", "1.5, 5", "1, 10"]},
+                        "close": {"control_points": ["0, 10", "1, 0"]},
+                    },
+                }
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
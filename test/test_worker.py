@@ -0,0 +1,185 @@
+import asyncio
+import threading
+import time
+import unittest
+from concurrent.futures import CancelledError
+
+from hardware.device import Device
+from hardware import aio
+from hardware.worker import IOWorker, AsyncIOWorker, HIGH, NORMAL, LOW
+
+
+class IOWorkerTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self._worker = IOWorker(name="test.io")
+
+    def tearDown(self) -> None:
+        self._worker.stop(timeout=1)
+
+    def _block(self):
+        """
+        occupy the worker until the returned event is set
+        """
+        release = threading.Event()
+        started = threading.Event()
+
+        def hold():
+            started.set()
+            release.wait(5)
+
+        self._worker.submit(hold)
+        started.wait(1)
+        return release
+
+    def test_future_result(self):
+        f = self._worker.submit(lambda a, b=0: a + b, 1, b=2)
+        self.assertEqual(f.result(1), 3)
+
+    def test_call(self):
+        self.assertEqual(self._worker.call(max, 1, 5, timeout=1), 5)
+
+    def test_exception(self):
+        f = self._worker.submit(lambda: 1 / 0)
+        with self.assertRaises(ZeroDivisionError):
+            f.result(1)
+        self.assertEqual(self._worker.stats()["normal"]["failed"], 1)
+
+    def test_priority_order(self):
+        order = []
+        release = self._block()
+        fs = [
+            self._worker.submit(order.append, "low1", priority=LOW),
+            self._worker.submit(order.append, "normal", priority=NORMAL),
+            self._worker.submit(order.append, "low2", priority=LOW),
+            self._worker.submit(order.append, "high", priority=HIGH),
+        ]
+        release.set()
+        for f in fs:
+            f.result(1)
+        self.assertEqual(order, ["high", "normal", "low1", "low2"])
+
+    def test_serialized(self):
+        active = []
+        overlap = []
+
+        def io():
+            active.append(1)
+            if len(active) > 1:
+                overlap.append(1)
+            time.sleep(0.001)
+            active.pop()
+
+        threads = [
+            threading.Thread(
+                target=lambda: [self._worker.call(io, timeout=5) for _ in range(10)]
+            )
+            for _ in range(4)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertFalse(overlap)
+        self.assertEqual(self._worker.stats()["normal"]["completed"], 40)
+
+    def test_reentrant(self):
+        f = self._worker.submit(lambda: self._worker.call(lambda: 7, timeout=1))
+        self.assertEqual(f.result(1), 7)
+
+    def test_stats(self):
+        release = self._block()
+        fs = [self._worker.submit(time.sleep, 0, priority=LOW) for _ in range(3)]
+        stats = self._worker.stats()
+        self.assertEqual(stats["low"]["depth"], 3)
+        self.assertEqual(self._worker.queue_depth, 3)
+
+        release.set()
+        for f in fs:
+            f.result(1)
+        stats = self._worker.stats()["low"]
+        self.assertEqual(stats["depth"], 0)
+        self.assertEqual(stats["submitted"], 3)
+        self.assertEqual(stats["completed"], 3)
+        self.assertGreater(stats["max_wait"], 0)
+
+    def test_stop(self):
+        self._worker.call(int, timeout=1)
+        self._worker.stop(timeout=1)
+        self.assertFalse(self._worker.is_alive())
+
+    def test_stop_cancels_pending(self):
+        release = self._block()
+        fs = [self._worker.submit(int) for _ in range(3)]
+        t = threading.Thread(target=self._worker.stop, kwargs={"timeout": 1})
+        t.start()
+        time.sleep(0.05)
+        release.set()
+        t.join(2)
+
+        for f in fs:
+            with self.assertRaises(CancelledError):
+                f.result(1)
+        self.assertEqual(self._worker.stats()["normal"]["depth"], 0)
+
+    def test_submit_after_stop(self):
+        self._worker.stop(timeout=1)
+        with self.assertRaises(RuntimeError):
+            self._worker.submit(int)
+
+
+class AsyncIOWorkerTestCase(IOWorkerTestCase):
+    def setUp(self) -> None:
+        self._worker = AsyncIOWorker(name="test.io")
+
+    def test_no_thread(self):
+        aio.get_loop()
+        n = threading.active_count()
+        workers = [AsyncIOWorker(name=f"test{i}.io") for i in range(10)]
+        try:
+            for i, w in enumerate(workers):
+                self.assertEqual(w.call(abs, -i, timeout=1), i)
+            # executor threads are shared by all workers. no thread per worker
+            self.assertLess(threading.active_count() - n, 10)
+            self.assertFalse(
+                [t for t in threading.enumerate() if t.name.endswith(".io")]
+            )
+        finally:
+            for w in workers:
+                w.stop(timeout=1)
+
+    def test_coroutine(self):
+        async def read(x):
+            await asyncio.sleep(0)
+            return x * 2
+
+        self.assertEqual(self._worker.call(read, 4, timeout=1), 8)
+        # a coroutine command made inside a plain one
+        f = self._worker.submit(lambda: self._worker.call(read, 3, timeout=1))
+        self.assertEqual(f.result(1), 6)
+
+    def test_acall_reentrant(self):
+        async def outer():
+            return await self._worker.acall(abs, -5)
+
+        self.assertEqual(aio.run(self._worker.acall(outer), 1), 5)
+
+    def test_blocking_call_on_loop(self):
+        async def blocking():
+            return self._worker.call(int)
+
+        with self.assertRaises(RuntimeError):
+            aio.run(blocking(), 1)
+
+
+class DeviceIOTestCase(unittest.TestCase):
+    def test_device_io(self):
+        device = Device(name="dev")
+        try:
+            self.assertEqual(device.io(pow, 2, 3, priority=HIGH, timeout=1), 8)
+            self.assertEqual(device.io_stats()["high"]["completed"], 1)
+        finally:
+            device.close()
+
+
+if __name__ == "__main__":
+    unittest.main()